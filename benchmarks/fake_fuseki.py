@@ -0,0 +1,156 @@
+import json
+import time
+import threading
+from urlparse import urlparse, parse_qs
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+TRIPLE = '<http://bench.example/s/{0}> <http://bench.example/p> "value {0}" .\n'
+
+
+def ntriples(size):
+    """N-Triples document of about size bytes."""
+    lines = []
+    total = 0
+    while total < size:
+        line = TRIPLE.format(len(lines))
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines)
+
+
+def rdfxml(size):
+    """RDF/XML document of about size bytes."""
+    lines = ['<?xml version="1.0"?>\n<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns:b="http://bench.example/">\n']
+    total = len(lines[0])
+    while total < size:
+        line = '<rdf:Description rdf:about="http://bench.example/s/{0}"><b:p>value {0}</b:p></rdf:Description>\n'.format(len(lines))
+        lines.append(line)
+        total += len(line)
+    lines.append('</rdf:RDF>\n')
+    return ''.join(lines)
+
+
+def select_json(size):
+    """SPARQL JSON results of about size bytes."""
+    bindings = []
+    total = 0
+    while total < size:
+        binding = {"s": {"type": "uri", "value": "http://bench.example/s/{0}".format(len(bindings))}}
+        bindings.append(binding)
+        total += 60
+    return json.dumps({"head": {"vars": ["s"]}, "results": {"bindings": bindings}})
+
+
+def graph_counts(graphs):
+    """SPARQL JSON results of the named graph triple count query."""
+    bindings = [{"g": {"type": "uri", "value": "http://bench.example/graph/{0}".format(i)},
+                 "count": {"type": "literal", "value": "1000"}} for i in range(graphs)]
+    return json.dumps({"head": {"vars": ["g", "count"]}, "results": {"bindings": bindings}})
+
+
+class FakeFusekiHandler(BaseHTTPRequestHandler):
+    """Answer Fuseki requests from prepared payloads."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        """Keep quiet, the benchmark output is what matters."""
+        pass
+
+    def _reply(self, body, content_type, status=200):
+        """Send a response after the configured latency."""
+        time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        """Read and return the request body."""
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else ''
+
+    def _query(self, params):
+        """Answer a SPARQL query in the format asked for."""
+        query = (params.get('query') or [''])[0].upper()
+        accept = self.headers.get('Accept') or ''
+        if 'CONSTRUCT' in query or 'DESCRIBE' in query:
+            if 'rdf+xml' in accept or not accept or '*/*' in accept:
+                self._reply(self.server.payloads['rdfxml'], 'application/rdf+xml')
+            else:
+                self._reply(self.server.payloads['ntriples'], accept.split(',')[0].split(';')[0])
+        elif 'GROUP BY ?G' in query:
+            self._reply(self.server.payloads['counts'], 'application/sparql-results+json')
+        else:
+            self._reply(self.server.payloads['select'], 'application/sparql-results+json')
+
+    def do_GET(self):
+        """Ping, graph retrieve and the graph list query."""
+        url = urlparse(self.path)
+        if url.path == '/$/ping':
+            self._reply('ok', 'text/plain')
+        elif url.path.endswith('/data'):
+            self._reply(self.server.payloads['ntriples'], 'application/n-triples')
+        elif url.path.endswith('/sparql') or url.path.endswith('/query'):
+            self._query(parse_qs(url.query))
+        elif url.path.startswith('/$/stats'):
+            self._reply(json.dumps({"datasets": {}}), 'application/json')
+        else:
+            self._reply('not found', 'text/plain', 404)
+
+    def do_POST(self):
+        """Queries, graph updates and SPARQL updates."""
+        url = urlparse(self.path)
+        body = self._read_body()
+        if url.path.endswith('/query'):
+            self._query(parse_qs(body))
+        elif url.path.endswith('/data'):
+            self._reply(self._count(body), 'application/json')
+        elif url.path.endswith('/update'):
+            self._reply('', 'text/plain')
+        else:
+            self._reply('not found', 'text/plain', 404)
+
+    def do_PUT(self):
+        """Graph replace."""
+        self._reply(self._count(self._read_body()), 'application/json')
+
+    def _count(self, body):
+        """Fuseki's answer to a graph upload, counting lines as triples."""
+        triples = body.count('\n') + (1 if body and not body.endswith('\n') else 0)
+        return json.dumps({"count": triples, "tripleCount": triples, "quadCount": 0})
+
+
+class FakeFuseki(ThreadingMixIn, HTTPServer):
+    """Stand-in for Fuseki answering the requests the Graph Manager sends.
+
+    Every response waits latency seconds and graph or query results are
+    about payload_size bytes, so the API can be measured without a real
+    Graph Store.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, port=0, latency=0.0, payload_size=65536, graphs=10):
+        """Prepare the payloads and bind, port 0 picks a free port."""
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeFusekiHandler)
+        self.latency = latency
+        self.payloads = {'ntriples': ntriples(payload_size),
+                         'rdfxml': rdfxml(payload_size),
+                         'select': select_json(payload_size),
+                         'counts': graph_counts(graphs)}
+
+    @property
+    def port(self):
+        """The port the server listens on."""
+        return self.server_address[1]
+
+    def start(self):
+        """Serve on a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import time
+import click
+import socket
+import threading
+import subprocess
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_fuseki import FakeFuseki  # noqa: E402
+
+api_version = "0.2"
+GRAPH = "http://bench.example/graph/0"
+
+# Method, path and JSON body of the request measured for each endpoint.
+endpoints = {
+    'health': ('GET', '/health', None),
+    'graph': ('GET', '/{0}/graph?uri={1}'.format(api_version, GRAPH), None),
+    'list': ('GET', '/{0}/graph/list'.format(api_version), None),
+    'query': ('POST', '/{0}/graph/query'.format(api_version),
+              {"targetGraph": [GRAPH], "query": "SELECT ?s WHERE {?s ?p ?o}", "contentType": "application/sparql-results+json"}),
+    'construct': ('POST', '/{0}/graph/construct'.format(api_version),
+                  {"targetGraph": [GRAPH], "query": "CONSTRUCT {?s ?p ?o} WHERE {?s ?p ?o}", "contentType": "text/turtle"}),
+    'update': ('POST', '/{0}/graph/update'.format(api_version),
+               {"targetGraph": GRAPH, "triples": "<http://bench.example/s> <http://bench.example/p> <http://bench.example/o> .",
+                "contentType": "application/n-triples"})}
+
+
+def free_port():
+    """A port nothing listens on."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def process_tree(pid):
+    """The process and all its descendants, read from /proc."""
+    children = dict()
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{0}/stat'.format(name)) as f:
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(name))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+def rss(pids):
+    """Resident memory in bytes of the processes."""
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/{0}/status'.format(pid)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except IOError:
+            continue
+    return total
+
+
+def percentile(latencies, fraction):
+    """Latency below which the fraction of requests fall."""
+    if not latencies:
+        return None
+    index = min(int(round(fraction * (len(latencies) - 1))), len(latencies) - 1)
+    return latencies[index]
+
+
+def run_endpoint(base, name, requests_count, concurrency, server_pid):
+    """Send requests_count requests to an endpoint from concurrency threads."""
+    method, path, body = endpoints[name]
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    remaining = [requests_count]
+    peak = [rss(process_tree(server_pid))]
+    done = threading.Event()
+
+    def sample():
+        """Track the peak memory of the server processes."""
+        while not done.is_set():
+            peak[0] = max(peak[0], rss(process_tree(server_pid)))
+            done.wait(0.1)
+
+    def worker():
+        """Send requests until none are left."""
+        session = requests.Session()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            start = time.time()
+            try:
+                response = session.request(method, base + path, json=body, timeout=300)
+                response.content
+                failed = response.status_code >= 400
+            except requests.RequestException:
+                failed = True
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                errors[0] += failed
+
+    sampler = threading.Thread(target=sample)
+    sampler.daemon = True
+    sampler.start()
+    started = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - started
+    done.set()
+    sampler.join()
+    latencies.sort()
+    return dict([('requests', len(latencies)),
+                 ('errors', errors[0]),
+                 ('requestsPerSecond', round(len(latencies) / duration, 2)),
+                 ('p50', round(percentile(latencies, 0.50), 5)),
+                 ('p95', round(percentile(latencies, 0.95), 5)),
+                 ('p99', round(percentile(latencies, 0.99), 5)),
+                 ('peakRssBytes', peak[0])])
+
+
+def wait_ready(base, server, timeout=30):
+    """Wait for the API to answer."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise click.ClickException('The API exited with status {0}.'.format(server.returncode))
+        try:
+            requests.get(base + '/health', timeout=5)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise click.ClickException('The API did not start within {0} seconds.'.format(timeout))
+
+
+def git_version():
+    """Commit the benchmark runs against, if known."""
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.group()
+def cli():
+    """Benchmark the Graph Manager HTTP API."""
+    pass
+
+
+@cli.command('serve')
+@click.option('--port', default=4302, help='gmAPI server port.')
+@click.option('--workers', default=2, help='gunicorn workers.')
+@click.option('--gunicorn-option', '-o', multiple=True, help='extra gunicorn setting as name=value.')
+def serve(port, workers, gunicorn_option):
+    """Run the API under gunicorn in the foreground."""
+    from graph_manager.app import init_api
+    from graph_manager.graphservice import GMApplication
+    options = {'bind': '127.0.0.1:{0}'.format(port), 'workers': workers, 'errorlog': '-', 'loglevel': 'warning'}
+    for option in gunicorn_option:
+        name, value = option.split('=', 1)
+        options[name] = value
+    GMApplication(init_api(), options).run()
+
+
+@cli.command('run')
+@click.option('--endpoint', '-e', multiple=True, type=click.Choice(sorted(endpoints)), help='endpoints to measure, all by default.')
+@click.option('--requests', 'requests_count', default=500, help='requests per endpoint.')
+@click.option('--concurrency', default=10, help='concurrent clients.')
+@click.option('--warmup', default=20, help='requests per endpoint before measuring.')
+@click.option('--workers', default=2, help='gunicorn workers.')
+@click.option('--gunicorn-option', '-o', multiple=True, help='extra gunicorn setting as name=value, e.g. worker_class=gthread.')
+@click.option('--fuseki-latency', default=0.0, help='seconds the fake Fuseki waits before each response.')
+@click.option('--payload-size', default=65536, help='bytes of the graphs and query results the fake Fuseki returns.')
+@click.option('--output', type=click.File('w'), default='-', help='file for the JSON results.')
+def run(endpoint, requests_count, concurrency, warmup, workers, gunicorn_option, fuseki_latency, payload_size, output):
+    """Start a fake Fuseki and the API, measure each endpoint and print JSON results."""
+    fuseki = FakeFuseki(latency=fuseki_latency, payload_size=payload_size).start()
+    port = free_port()
+    env = dict(os.environ, GHOST='127.0.0.1', GPORT=str(fuseki.port))
+    command = [sys.executable, os.path.abspath(__file__), 'serve', '--port', str(port), '--workers', str(workers)]
+    for option in gunicorn_option:
+        command.extend(['-o', option])
+    server = subprocess.Popen(command, env=env)
+    base = 'http://127.0.0.1:{0}'.format(port)
+    results = dict()
+    try:
+        wait_ready(base, server)
+        for name in endpoint or sorted(endpoints):
+            if warmup:
+                run_endpoint(base, name, warmup, concurrency, server.pid)
+            results[name] = run_endpoint(base, name, requests_count, concurrency, server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+        fuseki.shutdown()
+    report = dict([('version', git_version()),
+                   ('settings', dict([('requests', requests_count), ('concurrency', concurrency), ('workers', workers),
+                                      ('gunicornOptions', list(gunicorn_option)), ('fusekiLatency', fuseki_latency),
+                                      ('payloadSize', payload_size)])),
+                   ('results', results)])
+    output.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,94 @@
+import zlib
+import mimeparse
+from os import environ
+
+compression = {'level': int(environ['COMPRESSIONLEVEL']) if 'COMPRESSIONLEVEL' in environ else 6,
+               'minSize': int(environ['COMPRESSIONMINSIZE']) if 'COMPRESSIONMINSIZE' in environ else 1024}
+
+# zlib window bits of each encoding, gzip adds 16 for the gzip header.
+encodings = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def accepted_encoding(accept_encoding):
+    """The encoding the Accept-Encoding header prefers, gzip over deflate, or None."""
+    if not accept_encoding:
+        return None
+    qualities = dict()
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    for coding in ('gzip', 'deflate'):
+        if qualities.get(coding, qualities.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+
+def compress_chunks(chunks, encoding):
+    """Compress an iterable of chunks as they come, closing it at the end."""
+    compressor = zlib.compressobj(compression['level'], zlib.DEFLATED, encodings[encoding])
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def read_chunks(stream, chunk_size=65536):
+    """Iterate over a file-like response stream."""
+    try:
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            yield chunk
+    finally:
+        if hasattr(stream, 'close'):
+            stream.close()
+
+
+class CompressionMiddleware(object):
+    """Compress responses with gzip or deflate when the client accepts it.
+
+    Streamed responses are compressed chunk by chunk, others only from
+    the minimum size on. Responses that already have an encoding, or
+    formats that are compressed themselves, are left alone.
+    """
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        """Encode the response body."""
+        encoding = accepted_encoding(req.get_header('Accept-Encoding'))
+        resp.append_header('Vary', 'Accept-Encoding')
+        if encoding is None or resp.get_header('Content-Encoding') or not self._compressible(resp.content_type):
+            return
+        if resp.stream is not None:
+            chunks = read_chunks(resp.stream) if hasattr(resp.stream, 'read') else resp.stream
+            resp.stream = compress_chunks(chunks, encoding)
+            resp.stream_len = None
+        else:
+            body = resp.data if resp.data is not None else resp.body
+            if body is None:
+                return
+            if isinstance(body, unicode):
+                body = body.encode('utf-8')
+            if len(body) < compression['minSize']:
+                return
+            resp.data = b''.join(compress_chunks([body], encoding))
+            resp.body = None
+        resp.set_header('Content-Encoding', encoding)
+
+    def _compressible(self, content_type):
+        """Whether a content type is worth compressing."""
+        if not content_type:
+            return False
+        try:
+            kind, subtype, _ = mimeparse.parse_mime_type(content_type)
+        except ValueError:
+            return False
+        return kind == 'text' or subtype in ('json', 'xml', 'n-triples', 'n-quads', 'trig') or subtype.endswith(('+json', '+xml'))
@@ -1,10 +1,17 @@
 import json
 import falcon
+import jsonschema
+import threading
+from os import environ
 from graph_manager.schemas import load_schema
-from graph_manager.utils.validate import validate
+from graph_manager.utils.workers import thread_pool
+from graph_manager.utils.validate import validate, compiled_validator
 from graph_manager.utils.logs import app_logger
+from graph_manager.utils.negotiation import negotiate, query_content_type, rdf_types, ntriples_to_nquads
 from graph_manager.applib.graph_store import GraphStore
 
+bulk = {'workers': int(environ['BULKWORKERS']) if 'BULKWORKERS' in environ else 8}
+
 
 class GraphStatistics(object):
     """Retrieve basic Graph Store statistics."""
@@ -34,13 +41,21 @@ class GraphResource(object):
     """Retrieve or delete named graph."""
 
     def on_get(self, req, resp):
-        """Execution of the GET named graph request."""
+        """Execution of the GET named graph request.
+
+        The format is negotiated from the Accept header, N-Quads are made
+        from the N-Triples of the Graph Store.
+        """
         graph_uri = req.get_param('uri')
+        content_type = negotiate(req, rdf_types)
         fuseki = GraphStore()
-        response = fuseki._graph_retrieve(graph_uri)
+        if content_type == 'application/n-quads':
+            response = fuseki._graph_retrieve(graph_uri, stream=True, content_type='application/n-triples')
+        else:
+            response = fuseki._graph_retrieve(graph_uri, stream=True, content_type=content_type)
         if response is not None:
-            resp.data = str(response)
-            resp.content_type = 'text/turtle'
+            resp.stream = ntriples_to_nquads(response, graph_uri) if content_type == 'application/n-quads' else response
+            resp.content_type = content_type
             app_logger.info('Retrieved: {0}.'.format(graph_uri))
             resp.status = falcon.HTTP_200
         else:
@@ -70,16 +85,75 @@ class GraphUpdate(object):
         app_logger.info('Finished operations on /graph/update POST Request.')
 
 
+class GraphBulkUpdate(object):
+    """Add data to many named graphs in one request.
+
+    The body is NDJSON, each line an object as accepted by /graph/update.
+    The graphs are sent to the Graph Store concurrently.
+    """
+
+    validator = compiled_validator(load_schema('update'))
+
+    def _add(self, line_number, line):
+        """Add one line of the body to its named graph."""
+        result = dict([('line', line_number)])
+        try:
+            parsed = json.loads(line.decode('utf-8'))
+            self.validator.validate(parsed)
+            result['targetGraph'] = parsed['targetGraph']
+            response = GraphStore()._graph_add(parsed['targetGraph'], parsed['triples'], parsed["contentType"])
+        except jsonschema.ValidationError as error:
+            result['status'] = "error"
+            result['statusMessage'] = error.message
+        except Exception as error:
+            result['status'] = "error"
+            result['statusMessage'] = "Error Type: {0}, with message: {1}".format(error.__class__.__name__, error)
+        else:
+            result['status'] = "success"
+            result['tripleCount'] = response.get('tripleCount')
+        return result
+
+    def _lines(self, stream):
+        """Read the body line by line without buffering all of it."""
+        remainder = b''
+        for chunk in iter(lambda: stream.read(65536), b''):
+            lines = (remainder + chunk).split(b'\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield line
+        if remainder:
+            yield remainder
+
+    def on_post(self, req, resp):
+        """Execution of the POST bulk update request."""
+        pool = thread_pool('bulk', bulk['workers'])
+        # Only as many lines as there are workers are held in memory.
+        slots = threading.BoundedSemaphore(bulk['workers'])
+        pending = []
+        for line_number, line in enumerate(self._lines(req.bounded_stream), 1):
+            if not line.strip():
+                continue
+            slots.acquire()
+            pending.append(pool.apply_async(self._add, (line_number, line), callback=lambda result: slots.release()))
+        results = [task.get() for task in pending]
+        failed = len([result for result in results if result['status'] != "success"])
+        summary = dict([('graphsCount', len(results)), ('failedCount', failed), ('results', results)])
+        resp.data = json.dumps(summary, indent=1, sort_keys=True)
+        resp.content_type = 'application/json'
+        resp.status = falcon.HTTP_200
+        app_logger.info('Finished operations on /graph/bulk POST Request with {0} graphs.'.format(len(results)))
+
+
 class GraphSPARQL(object):
     """Execute SPARQL Query on Graph Store."""
 
     @validate(load_schema('query'))
     def on_post(self, req, resp, parsed):
         """Execution of the POST SPARQL query request."""
+        content_type = query_content_type(req, parsed)
         fuseki = GraphStore()
-        data = fuseki._graph_sparql(parsed['targetGraph'], parsed['query'], parsed["contentType"])
-        resp.data = str(data)
-        resp.content_type = parsed["contentType"]
+        resp.stream = fuseki._graph_sparql(parsed['targetGraph'], parsed['query'], content_type, stream=True)
+        resp.content_type = content_type
         resp.status = falcon.HTTP_200
         app_logger.info('Finished operations on /graph/query POST Request.')
 
@@ -90,9 +164,9 @@ class GraphSPARQLConstruct(object):
     @validate(load_schema('query'))
     def on_post(self, req, resp, parsed):
         """Execution of the POST SPARQL query request."""
+        content_type = query_content_type(req, parsed)
         fuseki = GraphStore()
-        data = fuseki._graph_construct(parsed['targetGraph'], parsed['query'], parsed["contentType"])
-        resp.data = str(data)
-        resp.content_type = parsed["contentType"]
+        resp.stream = fuseki._graph_construct(parsed['targetGraph'], parsed['query'], content_type, stream=True)
+        resp.content_type = content_type
         resp.status = falcon.HTTP_200
         app_logger.info('Finished operations on /graph/construct POST Request.')
@@ -1,41 +1,126 @@
+import os
 import json
+import time
 import falcon
+import threading
+from os import environ
+from multiprocessing import TimeoutError
+from graph_manager.utils.workers import thread_pool
 from graph_manager.utils.logs import app_logger
 from graph_manager.applib.graph_store import GraphStore
 from amqpstorm.management import ManagementApi
 from graph_manager.utils.broker import broker
 
-# TO DO More detailed response from the health endpoint with statistics
-# For now the endpoint responds with a simple 200
+health = {'timeout': float(environ['HEALTHTIMEOUT']) if 'HEALTHTIMEOUT' in environ else 2.0,
+          'ttl': float(environ['HEALTHTTL']) if 'HEALTHTTL' in environ else 5.0}
 
 
-def healthcheck_response(api_status, graph):
-    """Content and format health status response."""
-    health_status = dict([('graphManagerService', api_status)])
+def graph_store_probe(graph):
+    """Check the Graph Store is responding."""
+    graph._graph_health(timeout=health['timeout'])
+
+
+def message_broker_probe():
+    """Check the message broker is responding."""
+    API = ManagementApi('http://{0}:15672'.format(broker['host']), broker['user'], broker['pass'], timeout=health['timeout'])
+    result = API.aliveness_test('/')
+    if result['status'] != 'ok':
+        raise ValueError('Aliveness test returned: {0}'.format(result['status']))
+
+
+def timed_probe(probe, *args):
+    """Run a probe and measure how long it took in milliseconds."""
+    start = time.time()
     try:
-        graph._graph_health()
-    except Exception:
-        health_status['graphStore'] = "Not Running"
+        probe(*args)
+    except Exception as error:
+        app_logger.error('Health probe failed: {0}'.format(error))
+        status = "Not Running"
     else:
-        health_status['graphStore'] = "Running"
-    API = ManagementApi('http://{0}:15672'.format(broker['host']), broker['user'], broker['pass'])
-    try:
-        result = API.aliveness_test('/')
-        if result['status'] == 'ok':
-            health_status['messageBroker'] = "Running"
-    except Exception:
-        health_status['messageBroker'] = "Not Running"
+        status = "Running"
+    return status, int((time.time() - start) * 1000)
+
+
+def healthcheck_response(api_status, graph):
+    """Content and format health status response.
+
+    The backends are probed concurrently, each within the health timeout.
+    """
+    health_status = dict([('graphManagerService', api_status)])
+    health_status['latency'] = dict()
+    deadline = time.time() + health['timeout']
+    pool = thread_pool('health', 4)
+    probes = [('graphStore', pool.apply_async(timed_probe, (graph_store_probe, graph))),
+              ('messageBroker', pool.apply_async(timed_probe, (message_broker_probe,)))]
+    for name, probe in probes:
+        try:
+            status, latency = probe.get(max(deadline - time.time(), 0))
+        except TimeoutError:
+            status, latency = "Not Running", int(health['timeout'] * 1000)
+        health_status[name] = status
+        health_status['latency'][name] = latency
     return json.dumps(health_status, indent=1, sort_keys=True)
 
 
 class HealthCheck(object):
-    """Create HealthCheck class."""
+    """Create HealthCheck class.
+
+    The health status is cached and kept fresh by a background thread,
+    so polling the endpoint does not reach the backends.
+    """
+
+    def __init__(self):
+        """Set up the cached health status."""
+        self._status = {'pid': None, 'time': 0, 'response': None}
+        self._lock = threading.Lock()
+        self._refreshing = threading.Lock()
+
+    def _refresh(self):
+        """Probe the backends and cache the response.
+
+        One refresh runs at a time, callers arriving meanwhile get the
+        cached response, so a hanging backend does not pile up probes.
+        """
+        if not self._refreshing.acquire(False):
+            if self._status['response'] is not None:
+                return self._status['response']
+            self._refreshing.acquire()
+        try:
+            fuseki = GraphStore()
+            # if you manange to call this it means the API is running
+            response = healthcheck_response("Running", fuseki)
+            self._status['response'], self._status['time'] = response, time.time()
+            return response
+        finally:
+            self._refreshing.release()
+
+    def _refresh_loop(self):
+        """Keep the cached health status fresh."""
+        while True:
+            time.sleep(health['ttl'] / 2)
+            try:
+                self._refresh()
+            except Exception as error:
+                app_logger.error('Health refresh failed: {0}'.format(error))
+
+    def _response(self):
+        """Return the cached response, starting the refresher once per process."""
+        pid = os.getpid()
+        if self._status['pid'] != pid:
+            with self._lock:
+                if self._status['pid'] != pid:
+                    self._status['pid'] = pid
+                    self._status['time'] = 0
+                    thread = threading.Thread(target=self._refresh_loop)
+                    thread.daemon = True
+                    thread.start()
+        if time.time() - self._status['time'] > health['ttl']:
+            return self._refresh()
+        return self._status['response']
 
     def on_get(self, req, resp):
         """Respond on GET request to map endpoint."""
-        fuseki = GraphStore()
-        # if you manange to call this it means the API is running
-        resp.data = healthcheck_response("Running", fuseki)
+        resp.data = self._response()
         resp.content_type = 'application/json'
         resp.status = falcon.HTTP_200
         app_logger.info('Finished operations on /health GET Request.')
@@ -0,0 +1,53 @@
+import time
+import falcon
+from graph_manager.utils import metrics
+from graph_manager.api.compression import read_chunks
+
+
+def observed_stream(chunks, observe):
+    """Pass a response body through and call observe once it has been sent or closed."""
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        observe()
+
+
+class MetricsMiddleware(object):
+    """Count and time requests per resource and method.
+
+    Streamed responses are timed until the body has been sent.
+    """
+
+    def process_request(self, req, resp):
+        """Note when the request started."""
+        req.context['metricsStart'] = time.time()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        """Record the request."""
+        start = req.context.get('metricsStart')
+        if start is None:
+            return
+        name = resource.__class__.__name__ if resource is not None else "None"
+        metrics.inc('graphmanager_http_requests_total', resource=name, method=req.method, status=resp.status.split(' ')[0])
+
+        def observe():
+            """Record the latency."""
+            metrics.observe('graphmanager_http_request_seconds', time.time() - start, resource=name, method=req.method)
+        if resp.stream is None:
+            observe()
+        else:
+            chunks = read_chunks(resp.stream) if hasattr(resp.stream, 'read') else resp.stream
+            resp.stream = observed_stream(chunks, observe)
+
+
+class Metrics(object):
+    """Create Metrics class."""
+
+    def on_get(self, req, resp):
+        """Respond on GET request to metrics endpoint."""
+        resp.body = metrics.exposition()
+        resp.content_type = 'text/plain; version=0.0.4'
+        resp.status = falcon.HTTP_200
@@ -1,11 +1,14 @@
 import json
-import requests
+import time
+from os import environ
 from graph_manager.utils.logs import app_logger
 from datetime import datetime
 from graph_manager.applib.graph_store import GraphStore
 from graph_manager.utils.broker import broker
-from graph_manager.applib.messaging_publish import Publisher
-from graph_manager.utils.file import results_path, file_extension
+from graph_manager.applib.messaging_publish import background_publisher
+from graph_manager.utils.file import results_path, file_extension, open_results
+from graph_manager.utils.session import shared_session
+from graph_manager.utils.workers import thread_pool
 from urlparse import urlparse
 from requests_file import FileAdapter
 from rdflib.graph import Graph
@@ -13,104 +16,274 @@ from rdflib.graph import Graph
 artifact_id = "GraphManager"  # Define the GraphManager agent
 agent_role = "storage"  # Define Agent type
 output_key = "graphManagerOutput"
+sources = {'workers': int(environ['SOURCEWORKERS']) if 'SOURCEWORKERS' in environ else 4}
+# Formats for which N-Triples from the Graph Store can be passed through.
+ntriples_compatible = ('application/n-triples', 'application/n-quads', 'application/trig', 'text/turtle', 'text/n3')
 
 
-def add_message(message_data):
+def add_message(envelope):
     """Store data in the Graph Store."""
     startTime = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
     storage = GraphStore()
-    target_graph = message_data["payload"]["graphManagerInput"]["targetGraph"]
-    source_graphs = message_data["payload"]["graphManagerInput"]["sourceData"]
-    PUBLISHER = Publisher(broker['host'], broker['user'], broker['pass'], broker['provqueue'])
+    target_graph = envelope.task_input.target_graph
+    source_graphs = envelope.task_input.source_data
+    PUBLISHER = background_publisher(broker['host'], broker['user'], broker['pass'], broker['provqueue'])
+    timings = []
     try:
-        for graph in source_graphs:
-            content_type = graph["contentType"]
-            data = retrieve_data(graph["inputType"], graph["input"])
-            storage._graph_add(target_graph, data, content_type)
+        load_sources(storage, target_graph, source_graphs, timings)
         endTime = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
-        PUBLISHER.push(prov_message(message_data, "success", startTime, endTime))
+        PUBLISHER.emit(prov_message(envelope, "success", startTime, endTime, timings))
         app_logger.info('Stored graph data in: {0} graph'.format(target_graph))
-        return json.dumps(response_message(message_data["provenance"], "success"), indent=4, separators=(',', ': '))
+        return json.dumps(response_message(envelope.provenance, "success"), indent=4, separators=(',', ': '))
     except Exception as error:
         endTime = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
-        PUBLISHER.push(prov_message(message_data, "error", startTime, endTime))
+        PUBLISHER.emit(prov_message(envelope, "error", startTime, endTime, timings))
         app_logger.error('Something is wrong: {0}'.format(error))
         raise
 
 
-def query_message(message_data):
+def query_message(envelope):
     """Query named graph in Graph Store."""
-    storage = GraphStore()
-    source_graphs = message_data["payload"]["graphManagerInput"]["sourceGraphs"]
-    query = message_data["payload"]["graphManagerInput"]["input"]
-    output_type = message_data["payload"]["graphManagerInput"]["outputType"]
-    content_type = message_data["payload"]["graphManagerInput"]["outputContentType"]
-    request = storage._graph_sparql(source_graphs, query, content_type)
+    output = query_output(GraphStore(), envelope.task_input)
+    return json.dumps(response_message(envelope.provenance, status="success", output=output), sort_keys=True, indent=4, separators=(',', ': '))
+
+
+def query_output(storage, task_input):
+    """Run a query task and return its output."""
+    output_type = task_input.output_type
+    content_type = task_input.output_content_type
+    request = storage._graph_sparql(task_input.source_graphs, task_input.input, content_type, stream=(output_type == "URI"))
     if output_type == "URI":
         output = results_path(request, file_extension(content_type))
     elif output_type == "Data":
         output = request
-    return json.dumps(response_message(message_data["provenance"], status="success", output=output), sort_keys=True, indent=4, separators=(',', ': '))
+    return output
 
 
-def construct_message(message_data):
+def construct_message(envelope):
     """Query named graph in Graph Store."""
-    storage = GraphStore()
-    source_graphs = message_data["payload"]["graphManagerInput"]["sourceGraphs"]
-    query = message_data["payload"]["graphManagerInput"]["input"]
-    output_type = message_data["payload"]["graphManagerInput"]["outputType"]
-    content_type = message_data["payload"]["graphManagerInput"]["outputContentType"]
-    request = storage._graph_construct(source_graphs, query, content_type)
+    output = construct_output(GraphStore(), envelope.task_input)
+    return json.dumps(response_message(envelope.provenance, status="success", output=output), sort_keys=True, indent=4, separators=(',', ': '))
+
+
+def construct_output(storage, task_input):
+    """Run a construct task and return its output."""
+    output_type = task_input.output_type
+    content_type = task_input.output_content_type
+    request = storage._graph_construct(task_input.source_graphs, task_input.input, content_type, stream=(output_type == "URI"))
     if output_type == "URI":
         output = results_path(request, file_extension(content_type))
     elif output_type == "Data":
         output = request
-    return json.dumps(response_message(message_data["provenance"], status="success", output=output), sort_keys=True, indent=4, separators=(',', ': '))
+    return output
 
 
-def retrieve_message(message_data):
+def retrieve_message(envelope):
     """Retrieve named graph from Graph Store."""
-    storage = GraphStore()
-    result_graph = Graph()
-    source_graphs = message_data["payload"]["graphManagerInput"]["sourceGraphs"]
-    output_type = message_data["payload"]["graphManagerInput"]["outputType"]
-    content_type = message_data["payload"]["graphManagerInput"]["outputContentType"]
-    for graph in source_graphs:
-        result_graph.parse(data=storage._graph_retrieve(graph), format="turtle")
+    output = retrieve_output(GraphStore(), envelope.task_input)
+    return json.dumps(response_message(envelope.provenance, status="success", output=output), indent=4, separators=(',', ': '))
+
+
+def retrieve_output(storage, task_input):
+    """Run a retrieve task and return its output.
+
+    Formats that accept N-Triples syntax are streamed from the Graph Store
+    as they are, other formats are converted with rdflib.
+    """
+    source_graphs = task_input.source_graphs
+    output_type = task_input.output_type
+    content_type = task_input.output_content_type
+    if content_type in ntriples_compatible:
+        content = retrieve_ntriples(storage, source_graphs)
+    else:
+        result_graph = Graph()
+        for graph in source_graphs:
+            result_graph.parse(data=b''.join(retrieve_ntriples(storage, [graph])), format="nt")
+        content = result_graph.serialize(format=content_type)
     if output_type == "URI":
-        output = results_path(result_graph.serialize(format=content_type), file_extension(content_type))
+        output = results_path(content, file_extension(content_type))
     elif output_type == "Data":
-        output = result_graph.serialize(format=content_type)
-    return json.dumps(response_message(message_data["provenance"], status="success", output=output), indent=4, separators=(',', ': '))
+        output = content if isinstance(content, basestring) else b''.join(content)
+    return output
 
 
-def replace_message(message_data):
+def retrieve_ntriples(storage, source_graphs):
+    """Stream named graphs from the Graph Store one after the other as N-Triples."""
+    for graph in source_graphs:
+        response = storage._graph_retrieve(graph, stream=True, content_type='application/n-triples')
+        if response is None:
+            raise ValueError("Named graph: {0} does not exist.".format(graph))
+        chunk = b''
+        for chunk in response:
+            yield chunk
+        if chunk and not chunk.endswith(b'\n'):
+            yield b'\n'
+
+
+def replace_message(envelope):
     """Store data in the Graph Store."""
     startTime = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
     storage = GraphStore()
-    target_graph = message_data["payload"]["graphManagerInput"]["targetGraph"]
-    source_graphs = message_data["payload"]["graphManagerInput"]["sourceData"]
-    PUBLISHER = Publisher(broker['host'], broker['user'], broker['pass'], broker['provqueue'])
+    target_graph = envelope.task_input.target_graph
+    source_graphs = envelope.task_input.source_data
+    PUBLISHER = background_publisher(broker['host'], broker['user'], broker['pass'], broker['provqueue'])
+    timings = []
     try:
-        first_graph = next(iter(source_graphs or []), None)
-        first_graph_content_type = first_graph["contentType"]
-        first_graph_data = retrieve_data(first_graph["inputType"], first_graph["input"])
-        storage._graph_replace(target_graph, first_graph_data, first_graph_content_type)
-        for graph in source_graphs[1:]:
-            content_type = graph["contentType"]
-            data = retrieve_data(graph["inputType"], graph["input"])
-            storage._graph_add(target_graph, data, content_type)
+        load_sources(storage, target_graph, source_graphs, timings, replace=True)
         endTime = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
-        PUBLISHER.push(prov_message(message_data, "success", startTime, endTime))
+        PUBLISHER.emit(prov_message(envelope, "success", startTime, endTime, timings))
         app_logger.info('Replaced graph data in: {0} graph'.format(target_graph))
-        return json.dumps(response_message(message_data["provenance"], status="success"), indent=4, separators=(',', ': '))
+        return json.dumps(response_message(envelope.provenance, status="success"), indent=4, separators=(',', ': '))
     except Exception as error:
         endTime = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
-        PUBLISHER.push(prov_message(message_data, "error", startTime, endTime))
+        PUBLISHER.emit(prov_message(envelope, "error", startTime, endTime, timings))
         app_logger.error('Something is wrong: {0}'.format(error))
         raise
 
 
+def batch_message(envelope):
+    """Run an ordered list of operations from one message.
+
+    A source with inputType Output takes the output of an earlier operation,
+    given by its position. Consecutive add and replace operations on the same
+    graph are loaded together and one provenance message covers all writes.
+    Operations stop at the first failure, earlier writes are kept.
+    """
+    startTime = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    storage = GraphStore()
+    operations = envelope.task_input.operations
+    PUBLISHER = background_publisher(broker['host'], broker['user'], broker['pass'], broker['provqueue'])
+    results, writes, timings = [], [], []
+    index = 0
+    try:
+        while index < len(operations):
+            operation = operations[index]
+            if operation.task in ("add", "replace"):
+                group = write_group(operations, index)
+                sources = coalesce_sources([resolve_source(source, results) for position in group for source in operations[position].source_data])
+                writes.append((operation.target_graph, sources))
+                load_sources(storage, operation.target_graph, sources, timings,
+                             replace=(operation.task == "replace"), key_offset=sum(len(w[1]) for w in writes[:-1]))
+                results.extend(dict([('task', operations[position].task), ('status', "success")]) for position in group)
+                index = group[-1] + 1
+                continue
+            output = batch_tasks[operation.task](storage, operation)
+            results.append(dict([('task', operation.task), ('status', "success"), (output_key, output)]))
+            index += 1
+    except Exception as error:
+        app_logger.error('Batch operation {0} failed: {1}'.format(index, error))
+        raise ValueError('Batch operation {0} ({1}) failed: {2}'.format(index, operations[index].task, error))
+    finally:
+        if writes:
+            endTime = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+            status = "success" if len(results) == len(operations) else "error"
+            PUBLISHER.emit(prov_message(envelope, status, startTime, endTime, timings, writes))
+    return json.dumps(response_message(envelope.provenance, status="success", output=results), indent=4, separators=(',', ': '))
+
+
+def write_group(operations, start):
+    """Positions of the consecutive writes to one graph starting at start.
+
+    A replace can only start a group, it drops what came before.
+    """
+    group = [start]
+    target = operations[start].target_graph
+    for position in range(start + 1, len(operations)):
+        operation = operations[position]
+        if operation.task != "add" or operation.target_graph != target:
+            break
+        group.append(position)
+    return group
+
+
+def resolve_source(source, results):
+    """Replace a reference to an earlier output with that output."""
+    if source["inputType"] != "Output":
+        return source
+    position = int(source["input"])
+    if not 0 <= position < len(results) or output_key not in results[position]:
+        raise ValueError("Operation {0} has no output to use.".format(position))
+    output = results[position][output_key]
+    input_type = "URI" if isinstance(output, basestring) and output.startswith("file://") else "Data"
+    return dict([('contentType', source["contentType"]), ('inputType', input_type), ('input', output)])
+
+
+def coalesce_sources(sources):
+    """Join consecutive inline N-Triples sources so they are sent in one request.
+
+    Sources with blank nodes are kept apart, their labels are only
+    distinct between documents.
+    """
+    result = []
+    for source in sources:
+        joinable = (source["inputType"] == "Data" and source["contentType"] == "application/n-triples" and "_:" not in source["input"])
+        if joinable and result and result[-1].get('joinable'):
+            previous = result[-1]
+            previous["input"] = "{0}\n{1}".format(previous["input"].rstrip("\n"), source["input"])
+        else:
+            result.append(dict(source, joinable=joinable))
+    for source in result:
+        del source['joinable']
+    return result
+
+
+def timed_retrieve(graph):
+    """Retrieve source data and measure the download time in seconds."""
+    start = time.time()
+    data = retrieve_data(graph["inputType"], graph["input"])
+    return data, time.time() - start
+
+
+def load_sources(storage, target_graph, source_graphs, timings, replace=False, key_offset=0):
+    """Load source data into the target graph.
+
+    Up to SOURCEWORKERS sources are downloaded concurrently while the ones
+    already downloaded are uploaded in order. The download pool is shared by
+    every task in the process, so SOURCEWORKERS caps them together. With
+    replace the first source replaces the graph content. Per source timings
+    are appended to timings, numbered from key_offset. After a failure the
+    downloads still queued are waited for and closed.
+    """
+    pool = thread_pool('sources', sources['workers'])
+    window = sources['workers']
+    downloads = [pool.apply_async(timed_retrieve, (graph,)) for graph in source_graphs[:window]]
+    try:
+        for index, graph in enumerate(source_graphs):
+            data, download_time = downloads[index].get()
+            downloads[index] = None
+            # Keep a bounded number of downloads going while this one is uploaded.
+            if index + window < len(source_graphs):
+                downloads.append(pool.apply_async(timed_retrieve, (source_graphs[index + window],)))
+            start = time.time()
+            try:
+                if replace and index == 0:
+                    storage._graph_replace(target_graph, data, graph["contentType"])
+                else:
+                    storage._graph_add(target_graph, data, graph["contentType"])
+            finally:
+                if hasattr(data, 'close'):
+                    data.close()
+            timings.append(dict([('key', "inputGraphs_{0}".format(key_offset + index)),
+                                 ('downloadTime', round(download_time, 3)),
+                                 ('uploadTime', round(time.time() - start, 3))]))
+    finally:
+        discard_downloads(downloads)
+
+
+def discard_downloads(downloads):
+    """Wait for downloads nobody will upload and close what they opened."""
+    for download in downloads:
+        if download is None:
+            continue
+        try:
+            data, _ = download.get()
+        except Exception as error:
+            app_logger.error('Discarded source download failed: {0}'.format(error))
+            continue
+        if hasattr(data, 'close'):
+            data.close()
+
+
 def handle_file_adapter(request, input_data):
     """Handle file adapter response."""
     if request.status_code == 404:
@@ -120,12 +293,25 @@ def handle_file_adapter(request, input_data):
     elif request.status_code == 400:
         raise IOError("Something went wrong with retrieving the file: {0}. General IOError!".format(input_data))
     elif request.status_code == 200:
-        return request.content
+        # The open file itself, so it can be streamed without reading it into memory.
+        # Compressed results of earlier tasks are decompressed as they are read.
+        return open_results(request.raw, urlparse(input_data).path)
+
+
+def source_session():
+    """Session shared by all source downloads, also reading file:// URIs."""
+    session = shared_session('sources')
+    if 'file://' not in session.adapters:
+        session.mount('file://', FileAdapter())
+    return session
 
 
 def retrieve_data(input_type, input_data):
-    """Retrieve data from a specific URI."""
-    s = requests.Session()
+    """Retrieve data from a specific URI.
+
+    Local files are returned as an open file to be streamed to the Graph Store.
+    """
+    s = source_session()
     allowed = ('http', 'https', 'ftp')
     local = ('file')
     if input_type == "Data":
@@ -136,32 +322,34 @@ def retrieve_data(input_type, input_data):
                 request = s.get(input_data, timeout=1)
                 return request.text
             elif urlparse(input_data).scheme in local:
-                s.mount('file://', FileAdapter())
-                request = s.get(input_data)
+                request = s.get(input_data, stream=True)
                 return handle_file_adapter(request, input_data)
         except Exception as error:
             app_logger.error('Something is wrong: {0}'.format(error))
             raise
 
 
-def prov_message(message_data, status, start_time, end_time):
-    """Construct GM related provenance message."""
+def prov_message(envelope, status, start_time, end_time, timings=None, writes=None):
+    """Construct GM related provenance message.
+
+    Writes are (target graph, source data) pairs, by default the ones of the task.
+    """
     message = dict()
     message["provenance"] = dict()
     message["provenance"]["agent"] = dict()
     message["provenance"]["agent"]["ID"] = artifact_id
     message["provenance"]["agent"]["role"] = agent_role
 
-    activity_id = message_data["provenance"]["context"]["activityID"]
-    workflow_id = message_data["provenance"]["context"]["workflowID"]
+    activity_id = envelope.provenance["context"]["activityID"]
+    workflow_id = envelope.provenance["context"]["workflowID"]
 
     prov_message = message["provenance"]
 
     prov_message["context"] = dict()
     prov_message["context"]["activityID"] = str(activity_id)
     prov_message["context"]["workflowID"] = str(workflow_id)
-    if message_data["provenance"]["context"].get('stepID'):
-        prov_message["context"]["stepID"] = message_data["provenance"]["context"]["stepID"]
+    if envelope.provenance["context"].get('stepID'):
+        prov_message["context"]["stepID"] = envelope.provenance["context"]["stepID"]
 
     prov_message["activity"] = dict()
     prov_message["activity"]["type"] = "ServiceExecution"
@@ -169,28 +357,35 @@ def prov_message(message_data, status, start_time, end_time):
     prov_message["activity"]["status"] = status
     prov_message["activity"]["startTime"] = start_time
     prov_message["activity"]["endTime"] = end_time
+    if timings:
+        prov_message["activity"]["sourceTimings"] = timings
     message["provenance"]["input"] = []
     message["provenance"]["output"] = []
     message["payload"] = {}
-    output_data = {
-        "key": "outputGraph",
-        "role": "Dataset"
-    }
-    source_graphs = message_data["payload"]["graphManagerInput"]["sourceData"]
+    if writes is None:
+        writes = [(envelope.task_input.target_graph, envelope.task_input.source_data)]
 
-    for graph in source_graphs:
-        input_data = {
-            "key": "inputGraphs_{0}".format(source_graphs.index(graph)),
-            "role": "tempDataset"
+    input_index = 0
+    for position, (target_graph, source_graphs) in enumerate(writes):
+        for graph in source_graphs:
+            key = "inputGraphs_{0}".format(input_index)
+            input_data = {
+                "key": key,
+                "role": "tempDataset"
+            }
+            if graph["inputType"] == "Data":
+                message["payload"][key] = "attx:tempDataset"
+            if graph["inputType"] == "URI":
+                message["payload"][key] = graph["input"]
+            message["provenance"]["input"].append(input_data)
+            input_index += 1
+        output = "outputGraph" if len(writes) == 1 else "outputGraph_{0}".format(position)
+        output_data = {
+            "key": output,
+            "role": "Dataset"
         }
-        key = "inputGraphs_{0}".format(source_graphs.index(graph))
-        if graph["inputType"] == "Data":
-            message["payload"][key] = "attx:tempDataset"
-        if graph["inputType"] == "URI":
-            message["payload"][key] = graph["input"]
-        message["provenance"]["input"].append(input_data)
-    message["payload"]["outputGraph"] = message_data["payload"]["graphManagerInput"]["targetGraph"]
-    message["provenance"]["output"].append(output_data)
+        message["payload"][output] = target_graph
+        message["provenance"]["output"].append(output_data)
     app_logger.info('Construct provenance metadata for Graph Manager.')
     return json.dumps(message)
 
@@ -220,3 +415,7 @@ def response_message(provenance_data, status, status_messsage=None, output=None)
     if output:
         message["payload"][output_key] = output
     return message
+
+
+# Tasks with an output that can run in a batch.
+batch_tasks = {'query': query_output, 'construct': construct_output, 'retrieve': retrieve_output}
@@ -0,0 +1,54 @@
+import time
+from gevent import monkey
+from gevent.pool import Pool
+from graph_manager.utils.logs import app_logger
+from graph_manager.applib.messaging import ScalableRpcServer, Consumer
+
+
+def patch():
+    """Make sockets, sleeps and threads cooperative.
+
+    The graphservice entry point patches before anything else is imported.
+    Patching here is a late fallback for other callers: locks, pools and
+    sockets created before it stay blocking.
+    """
+    if not monkey.is_module_patched('socket'):
+        app_logger.warning('gevent patched late, import graph_manager.cooperative_patch first.')
+        monkey.patch_all()
+
+
+class CooperativeRpcServer(ScalableRpcServer):
+    """Graph Manger RPC server keeping many messages in flight on one gevent loop."""
+
+    def __init__(self, hostname='127.0.0.1',
+                 username='guest', password='guest',
+                 rpc_queue='base.rpc_queue',
+                 number_of_consumers=1, max_retries=None, in_flight=100):
+        """Server init function."""
+        super(CooperativeRpcServer, self).__init__(hostname, username, password, rpc_queue,
+                                                   number_of_consumers, max_retries, autoscale=False)
+        self.in_flight = in_flight
+        # Shared by all consumers, a full pool holds back consuming.
+        self._pool = Pool(in_flight)
+        app_logger.info('Cooperative RPC server with up to {0} messages in flight.'.format(in_flight))
+
+    def _create_consumer(self):
+        """Create a consumer handing messages to the greenlet pool.
+
+        :return:
+        """
+        return Consumer(self.rpc_queue, prefetch=self.in_flight, spawn=self._pool.spawn)
+
+    def drain(self, timeout=30):
+        """Stop taking messages and wait for the greenlets in progress, then stop.
+
+        :param timeout: seconds to wait for messages in progress
+        :return:
+        """
+        deadline = time.time() + timeout
+        self._stopped.set()
+        for consumer in self._consumers:
+            consumer.drain()
+        self._pool.join(timeout=max(deadline - time.time(), 0))
+        app_logger.info('Drained cooperative RPC consumers, stopping.')
+        self.stop()
@@ -0,0 +1,332 @@
+import os
+import uuid
+import errno
+import fcntl
+import hashlib
+import threading
+from os import environ
+from rdflib import ConjunctiveGraph, Graph, URIRef
+from rdflib.graph import ReadOnlyGraphAggregate
+from graph_manager.utils.logs import app_logger
+from graph_manager.utils.file import data
+from graph_manager.utils.metrics import timed
+from graph_manager.applib.graph_store import GraphStore
+from graph_manager.applib.query_cache import shared_cache
+
+embedded = {'directory': environ['GEMBEDDEDDIR'] if 'GEMBEDDEDDIR' in environ else "{0}/graphmanager/embedded".format(data['directory'])}
+
+# rdflib names of the SPARQL results formats, other content types are RDF serializations.
+result_formats = {'application/sparql-results+json': 'json',
+                  'application/json': 'json',
+                  'application/sparql-results+xml': 'xml',
+                  'text/csv': 'csv'}
+
+# rdflib names of the RDF serializations offered, quad formats need a named graph.
+rdf_formats = {'text/turtle': 'turtle',
+               'application/n-triples': 'nt',
+               'application/n-quads': 'nquads',
+               'application/ld+json': 'json-ld',
+               'application/rdf+xml': 'xml',
+               'application/trig': 'trig',
+               'text/n3': 'n3'}
+
+# Triple formats the quad formats fall back to for triples outside a named graph.
+triple_formats = {'nquads': 'nt', 'trig': 'turtle'}
+
+_lock = threading.Lock()
+_datasets = {'pid': None, 'datasets': dict()}
+
+
+def _graph_file(named_graph):
+    """File name of a named graph in the store directory."""
+    return "{0}.nt".format(hashlib.sha1(named_graph.encode('utf-8')).hexdigest())
+
+
+class EmbeddedDataset(object):
+    """Named graphs held in memory by an rdflib ConjunctiveGraph.
+
+    With a directory every named graph is also kept in its own N-Triples
+    file, the first line a comment with the graph URI. Writes append to
+    or replace that file under an exclusive lock and then change the
+    generation file; before each operation a process whose generation is
+    behind reloads the files changed by the others.
+    """
+
+    def __init__(self, directory=None):
+        """Open the store, loading the graphs kept in the directory."""
+        self.directory = directory
+        self.graph = ConjunctiveGraph()
+        self.lock = threading.RLock()
+        self._files = dict()
+        self._generation = None
+        if directory is not None and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _path(self, name):
+        """Path of a file in the store directory."""
+        return os.path.join(self.directory, name)
+
+    def _stat(self, name):
+        """What identifies the version of a file, None if it does not exist."""
+        try:
+            stat = os.stat(self._path(name))
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            return None
+        return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+    def _flock(self, operation):
+        """Lock the store directory against the other processes."""
+        handle = open(self._path("lock"), "a")
+        fcntl.flock(handle.fileno(), operation)
+        return handle
+
+    def sync(self):
+        """Reload the graph files other processes changed. Call with the lock held."""
+        if self.directory is None or self._stat("generation") == self._generation:
+            return
+        handle = self._flock(fcntl.LOCK_SH)
+        try:
+            self._reload()
+        finally:
+            handle.close()
+
+    def _reload(self):
+        """Load changed graph files and forget the removed ones."""
+        self._generation = self._stat("generation")
+        names = set(name for name in os.listdir(self.directory) if name.endswith(".nt"))
+        for name in set(self._files) - names:
+            self.graph.remove_context(self.graph.get_context(self._files.pop(name)[0]))
+        for name in names:
+            version = self._stat(name)
+            known = self._files.get(name)
+            if known is not None and known[1] == version:
+                continue
+            with open(self._path(name), "rb") as f:
+                identifier = URIRef(f.readline()[1:].strip().decode('utf-8'))
+                context = self.graph.get_context(identifier)
+                context.remove((None, None, None))
+                context.parse(f, format="nt")
+            self._files[name] = (identifier, version)
+        app_logger.info('Loaded {0} named graph(s) from {1}.'.format(len(names), self.directory))
+
+    def write(self, named_graph, triples, replace=False):
+        """Add the triples of a graph to a named graph, or replace it with them.
+
+        An empty graph with replace drops the named graph.
+        """
+        identifier = URIRef(named_graph)
+        if self.directory is None:
+            self._apply(identifier, triples, replace)
+            return
+        handle = self._flock(fcntl.LOCK_EX)
+        try:
+            self._reload()
+            name = _graph_file(named_graph)
+            path = self._path(name)
+            if replace and not len(triples):
+                if os.path.exists(path):
+                    os.remove(path)
+                self._files.pop(name, None)
+            else:
+                content = triples.serialize(format="nt")
+                if replace or name not in self._files:
+                    temp = "{0}.{1}.tmp".format(path, uuid.uuid4().hex)
+                    with open(temp, "wb") as f:
+                        f.write(u"#{0}\n".format(named_graph).encode('utf-8'))
+                        f.write(content)
+                    os.rename(temp, path)
+                else:
+                    with open(path, "ab") as f:
+                        f.write(content)
+                self._files[name] = (identifier, self._stat(name))
+            self._apply(identifier, triples, replace)
+            temp = "{0}.{1}.tmp".format(self._path("generation"), uuid.uuid4().hex)
+            with open(temp, "wb") as f:
+                f.write(uuid.uuid4().hex)
+            os.rename(temp, self._path("generation"))
+            self._generation = self._stat("generation")
+        finally:
+            handle.close()
+
+    def _apply(self, identifier, triples, replace):
+        """Change the named graph in memory."""
+        if replace:
+            self.graph.remove_context(self.graph.get_context(identifier))
+        if len(triples):
+            context = self.graph.get_context(identifier)
+            for triple in triples:
+                context.add(triple)
+
+
+def serialize_graph(triples, content_type, identifier=None):
+    """Serialize triples, as the named graph identifier for the quad formats.
+
+    Without an identifier the quad formats are written as the triple
+    formats they extend.
+    """
+    rdf_format = rdf_formats.get(content_type, content_type)
+    if rdf_format in triple_formats:
+        if identifier is None:
+            return triples.serialize(format=triple_formats[rdf_format])
+        dataset = ConjunctiveGraph()
+        context = dataset.get_context(identifier)
+        for triple in triples:
+            context.add(triple)
+        return dataset.serialize(format=rdf_format)
+    return triples.serialize(format=rdf_format)
+
+
+def results_tsv(result):
+    """SPARQL SELECT or ASK results in the TSV format, rdflib has no serializer for it."""
+    if result.type == 'ASK':
+        return 'true\n' if result.askAnswer else 'false\n'
+    lines = [u'\t'.join(u'?{0}'.format(var) for var in result.vars)]
+    for row in result:
+        lines.append(u'\t'.join(term.n3() if term is not None else u'' for term in row))
+    return u'\n'.join(lines).encode('utf-8') + '\n'
+
+
+def shared_dataset(directory):
+    """Return the process wide dataset kept in a directory."""
+    pid = os.getpid()
+    with _lock:
+        if _datasets['pid'] != pid:
+            _datasets['pid'] = pid
+            _datasets['datasets'] = dict()
+        if directory not in _datasets['datasets']:
+            _datasets['datasets'][directory] = EmbeddedDataset(directory)
+        return _datasets['datasets'][directory]
+
+
+class EmbeddedGraphStore(GraphStore):
+    """Serve the Graph Store operations from an in-process rdflib dataset.
+
+    Chosen with GBACKEND=embedded, it avoids the HTTP round trip to Fuseki.
+    Every process holds the whole dataset in memory.
+    """
+
+    def __init__(self):
+        """Open the dataset of this process."""
+        self.dataset = "embedded"
+        self.store = shared_dataset(embedded['directory'])
+        self.index = None
+        self.cache = shared_cache()
+
+    def _context(self, named_graph):
+        """Named graph in the dataset, None if it is empty."""
+        context = self.store.graph.get_context(URIRef(named_graph))
+        return context if len(context) else None
+
+    def _graph_health(self, timeout=None):
+        """The embedded store is always available."""
+        return True
+
+    @timed('graphmanager_graph_store_seconds', 'graphmanager_graph_store_errors_total', operation='graph_counts')
+    def _graph_counts(self):
+        """Count the triples of every named graph in the dataset."""
+        with self.store.lock:
+            self.store.sync()
+            return [(unicode(context.identifier), str(len(context))) for context in self.store.graph.contexts()
+                    if isinstance(context.identifier, URIRef) and len(context)]
+
+    @timed('graphmanager_graph_store_seconds', 'graphmanager_graph_store_errors_total', operation='graph_statistics')
+    def _graph_statistics(self):
+        """Dataset statistics, there are no request counts without Fuseki."""
+        result = {}
+        result['dataset'] = "/{0}".format(self.dataset)
+        result['totalTriples'] = sum(int(count) for _, count in self._graph_counts())
+        app_logger.info('Constructed statistics list for dataset: "/{0}".'.format(self.dataset))
+        return result
+
+    @timed('graphmanager_graph_store_seconds', 'graphmanager_graph_store_errors_total', operation='graph_retrieve')
+    def _graph_retrieve(self, named_graph, stream=False, content_type='text/turtle'):
+        """Serialize a named graph, with stream=True as an iterable."""
+        with self.store.lock:
+            self.store.sync()
+            context = self._context(named_graph)
+            if context is None:
+                app_logger.info('Retrived named graph: {0} does not exist.'.format(named_graph))
+                return None
+            content = serialize_graph(context, content_type, context.identifier)
+        app_logger.info('Retrived named graph: {0}.'.format(named_graph))
+        return [content] if stream else content
+
+    def _query(self, source_graphs, query):
+        """Run a query over the union of the source graphs, or the whole dataset. Call with the lock held."""
+        self.store.sync()
+        if source_graphs:
+            target = ReadOnlyGraphAggregate([self.store.graph.get_context(URIRef(graph)) for graph in source_graphs])
+        else:
+            target = self.store.graph
+        return target.query(query)
+
+    @timed('graphmanager_graph_store_seconds', 'graphmanager_graph_store_errors_total', operation='graph_sparql')
+    def _graph_sparql(self, source_graphs, query, content_type, stream=False):
+        """Execute SPARQL query on the dataset, results in the requested content type."""
+        key, tokens, cached = self._cache_lookup('query', source_graphs, query, content_type)
+        if cached is None:
+            with self.store.lock:
+                result = self._query(source_graphs, query)
+                if result.type == 'CONSTRUCT' or result.type == 'DESCRIBE':
+                    cached = serialize_graph(result.graph, content_type)
+                elif content_type == 'text/tab-separated-values':
+                    cached = results_tsv(result)
+                else:
+                    cached = result.serialize(format=result_formats.get(content_type, 'json'))
+            if key is not None and len(cached) <= self.cache.entry_size:
+                self.cache.put(key, tokens, cached)
+        app_logger.info('Execture SPARQL query on named graphs: {0}.'.format(source_graphs))
+        return [cached] if stream else cached
+
+    @timed('graphmanager_graph_store_seconds', 'graphmanager_graph_store_errors_total', operation='graph_construct')
+    def _graph_construct(self, source_graphs, query, content_type, stream=False):
+        """Execute SPARQL Construct on the dataset, with stream=True as an iterable."""
+        key, tokens, cached = self._cache_lookup('construct', source_graphs, query, content_type)
+        if cached is None:
+            with self.store.lock:
+                cached = serialize_graph(self._query(source_graphs, query).graph, content_type)
+            if key is not None:
+                self.cache.put(key, tokens, cached)
+        app_logger.info('Execture SPARQL Construct on named graphs: {0}.'.format(source_graphs))
+        return [cached] if stream else cached
+
+    def _write(self, named_graph, data, content_type, replace):
+        """Parse the data and write it to a named graph, answering like Fuseki."""
+        triples = Graph()
+        if hasattr(data, 'read'):
+            triples.parse(file=data, format=content_type)
+        else:
+            triples.parse(data=data, format=content_type)
+        try:
+            with self.store.lock:
+                self.store.write(named_graph, triples, replace)
+        finally:
+            self._invalidate(named_graph)
+        return dict([('count', len(triples)), ('tripleCount', len(triples)), ('quadCount', 0)])
+
+    @timed('graphmanager_graph_store_seconds', 'graphmanager_graph_store_errors_total', operation='graph_add')
+    def _graph_add(self, named_graph, data, content_type):
+        """Add data, a string or an open file, to a named graph."""
+        result = self._write(named_graph, data, content_type, replace=False)
+        app_logger.info('Updated named graph: {0}.'.format(named_graph))
+        return result
+
+    @timed('graphmanager_graph_store_seconds', 'graphmanager_graph_store_errors_total', operation='graph_replace')
+    def _graph_replace(self, named_graph, data, content_type):
+        """Replace a named graph with data, a string or an open file."""
+        result = self._write(named_graph, data, content_type, replace=True)
+        app_logger.info('Replaced named graph: {0}.'.format(named_graph))
+        return result
+
+    @timed('graphmanager_graph_store_seconds', 'graphmanager_graph_store_errors_total', operation='drop_graph')
+    def _drop_graph(self, named_graph):
+        """Drop a named graph from the dataset."""
+        try:
+            with self.store.lock:
+                self.store.write(named_graph, Graph(), replace=True)
+        finally:
+            self._invalidate(named_graph)
+        app_logger.info('Deleted named graph: {0}.'.format(named_graph))
+        return ""
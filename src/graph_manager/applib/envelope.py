@@ -0,0 +1,32 @@
+class TaskInput(object):
+    """The graphManagerInput of a message, with its fields looked up once."""
+
+    __slots__ = ('task', 'target_graph', 'source_data', 'source_graphs', 'input',
+                 'output_type', 'output_content_type', 'operations')
+
+    def __init__(self, task_input):
+        """Take the fields a task can have, missing ones are None."""
+        self.task = task_input.get("task")
+        self.target_graph = task_input.get("targetGraph")
+        self.source_data = task_input.get("sourceData")
+        self.source_graphs = task_input.get("sourceGraphs")
+        self.input = task_input.get("input")
+        self.output_type = task_input.get("outputType")
+        self.output_content_type = task_input.get("outputContentType")
+        self.operations = [TaskInput(operation) for operation in task_input.get("operations", ())]
+
+
+class Envelope(object):
+    """A Graph Manager RPC message, parsed once and passed to the task."""
+
+    __slots__ = ('provenance', 'task_input')
+
+    def __init__(self, message_data):
+        """Wrap a parsed and validated message."""
+        self.provenance = message_data["provenance"]
+        self.task_input = TaskInput(message_data["payload"]["graphManagerInput"])
+
+    @property
+    def task(self):
+        """The task to run."""
+        return self.task_input.task
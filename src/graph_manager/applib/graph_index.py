@@ -0,0 +1,134 @@
+import os
+import time
+import sqlite3
+import threading
+from os import environ
+from contextlib import contextmanager
+from graph_manager.utils.logs import app_logger
+
+index = {'path': environ['GINDEX'] if 'GINDEX' in environ else None,
+         'interval': int(environ['GINDEXINTERVAL']) if 'GINDEXINTERVAL' in environ else 600}
+
+_lock = threading.Lock()
+_index = {'pid': None, 'index': None}
+
+
+class GraphIndex(object):
+    """Per named graph statistics kept next to the Graph Store.
+
+    The index lives in a SQLite file so the API workers and the RPC
+    server share it; writes go through the Graph Store methods and a
+    periodic reconciliation corrects any drift.
+    """
+
+    def __init__(self, path):
+        """Create the index tables if needed."""
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS graphs (graph TEXT PRIMARY KEY, triples INTEGER NOT NULL, bytes INTEGER, modified REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL)')
+
+    @contextmanager
+    def _connect(self):
+        """Open a connection for one transaction."""
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level='IMMEDIATE')
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def graph_added(self, named_graph, triples, size=None):
+        """Account for triples added to a named graph."""
+        with self._connect() as conn:
+            conn.execute('INSERT OR IGNORE INTO graphs (graph, triples, bytes) VALUES (?, 0, 0)', (named_graph,))
+            conn.execute('UPDATE graphs SET triples = triples + ?, bytes = COALESCE(bytes, 0) + ?, modified = ? WHERE graph = ?',
+                         (triples, size or 0, time.time(), named_graph))
+
+    def graph_replaced(self, named_graph, triples, size=None):
+        """Account for a named graph whose content was replaced."""
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO graphs (graph, triples, bytes, modified) VALUES (?, ?, ?, ?)',
+                         (named_graph, triples, size, time.time()))
+
+    def graph_dropped(self, named_graph):
+        """Remove a dropped named graph."""
+        with self._connect() as conn:
+            conn.execute('DELETE FROM graphs WHERE graph = ?', (named_graph,))
+
+    def graphs(self):
+        """List indexed graphs as (graph, triples, bytes, modified) tuples."""
+        with self._connect() as conn:
+            return conn.execute('SELECT graph, triples, bytes, modified FROM graphs ORDER BY graph').fetchall()
+
+    def total_triples(self):
+        """Sum of the triples in all named graphs."""
+        with self._connect() as conn:
+            return conn.execute('SELECT COALESCE(SUM(triples), 0) FROM graphs').fetchone()[0]
+
+    def reconciled(self):
+        """Check if the index was ever reconciled with the Graph Store."""
+        with self._connect() as conn:
+            return conn.execute("SELECT value FROM meta WHERE key = 'reconciled'").fetchone() is not None
+
+    def claim_reconcile(self, interval):
+        """Claim the next reconciliation, so only one process runs it per interval."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('claimed', 0)")
+            cursor = conn.execute("UPDATE meta SET value = ? WHERE key = 'claimed' AND value <= ?", (now, now - interval))
+            return cursor.rowcount == 1
+
+    def reconcile(self, counts, started):
+        """Replace triple counts with the ones counted by the Graph Store.
+
+        Graphs written after the count started keep their indexed values.
+        """
+        with self._connect() as conn:
+            for named_graph, triples in counts.items():
+                conn.execute('INSERT OR IGNORE INTO graphs (graph, triples) VALUES (?, 0)', (named_graph,))
+                conn.execute('UPDATE graphs SET triples = ? WHERE graph = ? AND (modified IS NULL OR modified < ?)',
+                             (triples, named_graph, started))
+            for row in conn.execute('SELECT graph FROM graphs WHERE modified IS NULL OR modified < ?', (started,)).fetchall():
+                if row[0] not in counts:
+                    conn.execute('DELETE FROM graphs WHERE graph = ?', (row[0],))
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('reconciled', ?)", (time.time(),))
+        app_logger.info('Reconciled graph index with {0} named graphs.'.format(len(counts)))
+
+
+def _reconcile_loop(graph_index, reconcile):
+    """Periodically reconcile the index with the Graph Store."""
+    while True:
+        time.sleep(index['interval'])
+        try:
+            if graph_index.claim_reconcile(index['interval']):
+                reconcile()
+        except Exception as error:
+            app_logger.error('Graph index reconciliation failed: {0}'.format(error))
+
+
+def shared_index(reconcile):
+    """Return the process wide graph index, or None if it is not configured.
+
+    The first call in a process starts the background reconciliation
+    which runs the reconcile callable.
+    """
+    if index['path'] is None:
+        return None
+    pid = os.getpid()
+    if _index['pid'] != pid:
+        with _lock:
+            if _index['pid'] != pid:
+                graph_index = GraphIndex(index['path'])
+                thread = threading.Thread(target=_reconcile_loop, args=(graph_index, reconcile))
+                thread.daemon = True
+                thread.start()
+                _index['index'] = graph_index
+                _index['pid'] = pid
+    return _index['index']
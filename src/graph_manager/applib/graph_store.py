@@ -1,13 +1,95 @@
-import requests
+import os
+import time
 from os import environ
+from datetime import datetime
 from urllib import quote
 from graph_manager.utils.logs import app_logger
-from SPARQLWrapper import SPARQLWrapper, JSON, XML
+from graph_manager.utils.metrics import timed
+from graph_manager.utils.session import shared_session, request_timeout, pool
+from graph_manager.applib.graph_index import shared_index
+from graph_manager.applib.query_cache import shared_cache, cache_key
 from requests.exceptions import ConnectionError
 
+store = {'backend': environ['GBACKEND'] if 'GBACKEND' in environ else "fuseki"}
+
+
+class ResponseStream(object):
+    """Iterate over a Graph Store response in chunks without buffering it.
+
+    The underlying connection goes back to the pool once the
+    iteration ends or the WSGI server closes the iterable, then the
+    callables in on_close are called.
+    """
+
+    def __init__(self, response, chunk_size=None, on_complete=None, limit=0):
+        """Wrap a response opened with stream=True.
+
+        If the body is at most limit bytes, on_complete is called
+        with the whole body once it has been read to the end.
+        """
+        self.response = response
+        self.chunk_size = chunk_size or pool['chunkSize']
+        self.content_type = response.headers.get('content-type')
+        self.on_complete = on_complete
+        self.limit = limit
+        self.on_close = []
+        self._closed = False
+
+    def __iter__(self):
+        """Yield the response body chunk by chunk."""
+        kept = [] if self.on_complete is not None else None
+        size = 0
+        try:
+            for chunk in self.response.iter_content(self.chunk_size):
+                if chunk:
+                    if kept is not None:
+                        size += len(chunk)
+                        if size <= self.limit:
+                            kept.append(chunk)
+                        else:
+                            kept = None
+                    yield chunk
+            if kept is not None:
+                self.on_complete(b''.join(kept))
+        finally:
+            self.close()
+
+    def close(self):
+        """Release the connection."""
+        self.response.close()
+        if not self._closed:
+            self._closed = True
+            for callback in self.on_close:
+                callback()
+
+
+def data_size(data):
+    """Size in bytes of data sent to the Graph Store, a string or an open file.
+
+    None for a stream of unknown size.
+    """
+    if hasattr(data, 'fileno'):
+        return os.fstat(data.fileno()).st_size
+    if hasattr(data, 'read'):
+        return None
+    return len(data)
+
 
 class GraphStore(object):
-    """Handle requests to the Provenance Graph Store."""
+    """Handle requests to the Provenance Graph Store.
+
+    With GBACKEND=embedded an EmbeddedGraphStore, serving the same
+    operations in process, is created instead of the Fuseki client.
+    """
+
+    def __new__(cls):
+        """Pick the class of the configured backend."""
+        if cls is GraphStore and store['backend'] != "fuseki":
+            if store['backend'] != "embedded":
+                raise ValueError('Unknown Graph Store backend: {0}'.format(store['backend']))
+            from graph_manager.applib.embedded_store import EmbeddedGraphStore
+            cls = EmbeddedGraphStore
+        return super(GraphStore, cls).__new__(cls)
 
     def __init__(self):
         """Check if we have everything to work with the Graph Store."""
@@ -18,12 +100,21 @@ class GraphStore(object):
 
         self.server_address = "http://{0}:{1}/$/".format(self.host, self.port)
         self.request_address = "http://{0}:{1}/{2}".format(self.host, self.port, self.dataset)
+        self.session = shared_session()
+        self.timeout = request_timeout()
+        self.index = shared_index(self._index_reconcile)
+        self.cache = shared_cache()
+
+    def _graph_health(self, timeout=None):
+        """Do the Health check for Graph Store.
 
-    def _graph_health(self):
-        """Do the Health check for Graph Store."""
+        The ping is a single attempt on its own session, so the timeout
+        bounds the whole check.
+        """
         status = None
+        timeout = (timeout, timeout) if timeout else self.timeout
         try:
-            request = requests.get("{0}ping".format(self.server_address))
+            request = shared_session('health', retries=0).get("{0}ping".format(self.server_address), timeout=timeout)
         except Exception as error:
             app_logger.error('Something is wrong: {0}'.format(error))
             status = False
@@ -33,30 +124,54 @@ class GraphStore(object):
             status = True
         return status
 
-    def _graph_list(self):
-        """List Graph Store Named Graphs."""
-        result = {}
-        temp_list = []
+    @timed('graphmanager_graph_store_seconds', 'graphmanager_graph_store_errors_total', operation='graph_counts')
+    def _graph_counts(self):
+        """Count the triples of every named graph in the Graph Store."""
         list_query = quote("select ?g (count(*) as ?count) {graph ?g {?s ?p ?o}} group by ?g")
         try:
-            request = requests.get("{0}/sparql?query={1}".format(self.request_address, list_query))
+            request = self.session.get("{0}/sparql?query={1}".format(self.request_address, list_query), timeout=self.timeout)
         except Exception as error:
             app_logger.error('Something is wrong: {0}'.format(error))
             raise
         graphs = request.json()
-        result['graphsCount'] = len(graphs['results']['bindings'])
-        for g in graphs['results']['bindings']:
-            temp_graph = dict([('graphURI', g['g']['value']), ('tripleCount', g['count']['value'])])
-            temp_list.append(temp_graph)
+        return [(g['g']['value'], g['count']['value']) for g in graphs['results']['bindings']]
+
+    def _index_reconcile(self):
+        """Reconcile the graph index with the triple counts in the Graph Store."""
+        started = time.time()
+        counts = dict((named_graph, int(count)) for named_graph, count in self._graph_counts())
+        self.index.reconcile(counts, started)
+
+    @timed('graphmanager_graph_store_seconds', 'graphmanager_graph_store_errors_total', operation='graph_list')
+    def _graph_list(self):
+        """List Graph Store Named Graphs.
+
+        Served from the graph index when one is configured.
+        """
+        result = {}
+        temp_list = []
+        if self.index is not None:
+            if not self.index.reconciled():
+                self._index_reconcile()
+            for named_graph, triples, size, modified in self.index.graphs():
+                temp_graph = dict([('graphURI', named_graph), ('tripleCount', str(triples)), ('byteSize', size)])
+                if modified is not None:
+                    temp_graph['lastModified'] = datetime.utcfromtimestamp(modified).strftime('%Y-%m-%dT%H:%M:%SZ')
+                temp_list.append(temp_graph)
+        else:
+            for named_graph, count in self._graph_counts():
+                temp_list.append(dict([('graphURI', named_graph), ('tripleCount', count)]))
+        result['graphsCount'] = len(temp_list)
         result['graphs'] = temp_list
         app_logger.info('Constructed list of Named graphs from "/{0}" dataset.'.format(self.dataset))
         return result
 
+    @timed('graphmanager_graph_store_seconds', 'graphmanager_graph_store_errors_total', operation='graph_statistics')
     def _graph_statistics(self):
         """Graph Store statistics agregated."""
         result = {}
         try:
-            request = requests.get("{0}stats/{1}".format(self.server_address, self.dataset), auth=('admin', self.key))
+            request = self.session.get("{0}stats/{1}".format(self.server_address, self.dataset), auth=('admin', self.key), timeout=self.timeout)
         except Exception as error:
             app_logger.error('Something is wrong: {0}'.format(error))
             raise
@@ -65,91 +180,156 @@ class GraphStore(object):
         result['requests'] = {}
         result['requests']['totalRequests'] = stats['datasets']['/{0}'.format(self.dataset)]['Requests']
         result['requests']['failedRequests'] = stats['datasets']['/{0}'.format(self.dataset)]['RequestsBad']
-        triples = 0
-        graphs = self._graph_list()
-        for e in graphs['graphs']:
-            triples += int(e['tripleCount'])
-        result['totalTriples'] = triples
+        if self.index is not None and self.index.reconciled():
+            result['totalTriples'] = self.index.total_triples()
+        else:
+            triples = 0
+            graphs = self._graph_list()
+            for e in graphs['graphs']:
+                triples += int(e['tripleCount'])
+            result['totalTriples'] = triples
         app_logger.info('Constructed statistics list for dataset: "/{0}".'.format(self.dataset))
         return result
 
-    def _graph_retrieve(self, named_graph):
-        """Retrieve named graph from Graph Store."""
+    @timed('graphmanager_graph_store_seconds', 'graphmanager_graph_store_errors_total', operation='graph_retrieve')
+    def _graph_retrieve(self, named_graph, stream=False, content_type='text/turtle'):
+        """Retrieve named graph from Graph Store.
+
+        With stream=True a ResponseStream is returned instead of the content.
+        """
+        headers = {'accept': content_type}
         try:
-            request = requests.get("{0}/data?graph={1}".format(self.request_address, named_graph))
+            request = self.session.get("{0}/data?graph={1}".format(self.request_address, named_graph), headers=headers,
+                                       timeout=self.timeout, stream=stream)
         except Exception as error:
             app_logger.error('Something is wrong: {0}'.format(error))
             raise
         if request.status_code == 200:
             app_logger.info('Retrived named graph: {0}.'.format(named_graph))
-            return request.content
+            return ResponseStream(request) if stream else request.content
         elif request.status_code == 404:
             app_logger.info('Retrived named graph: {0} does not exist.'.format(named_graph))
-            return None
+        request.close()
+        return None
 
-    def _graph_sparql(self, source_graphs, query, content_type):
-        """Execute SPARQL query on the Graph Store."""
+    def _sparql_request(self, source_graphs, query, content_type, stream=False):
+        """Send a SPARQL query to the Graph Store asking for content_type."""
         store_api = "{0}/query".format(self.request_address)
-        return_type = {'application/sparql-results+xml': XML,
-                       'application/sparql-results+json': JSON}
-        try:
-            sparql = SPARQLWrapper(store_api)
-            # add a default graph, though that can also be in the query string
-            for named_graph in source_graphs:
-                sparql.addDefaultGraph(named_graph)
-            sparql.setReturnFormat(return_type[content_type])
-            sparql.setQuery(query)
-            data = sparql.query().convert()
-        except Exception as error:
-            app_logger.error('Something is wrong: {0}'.format(error))
-            raise
-        app_logger.info('Execture SPARQL query on named graphs: {0}.'.format(source_graphs))
-        if return_type[content_type] == JSON:
-            return data
-        else:
-            return data.toxml()
+        # add a default graph, though that can also be in the query string
+        payload = [('query', query)] + [('default-graph-uri', named_graph) for named_graph in source_graphs]
+        headers = {'accept': content_type}
+        request = self.session.post(store_api, data=payload, headers=headers, timeout=self.timeout, stream=stream)
+        if request.status_code != 200:
+            request.close()
+            request.raise_for_status()
+        return request
 
-    def _graph_construct(self, source_graphs, query, content_type):
-        """Execute SPARQL query on the Graph Store."""
-        store_api = "{0}/query".format(self.request_address)
+    def _cache_lookup(self, kind, source_graphs, query, content_type):
+        """Look up a query result in the cache.
+
+        Returns the key, the graph tokens to cache a fresh result with and the cached result if any.
+        """
+        if self.cache is None:
+            return None, None, None
+        key = cache_key(kind, source_graphs, query, content_type)
+        tokens = self.cache.tokens(source_graphs)
+        return key, tokens, self.cache.get(key, source_graphs)
+
+    def _cache_store(self, key, tokens):
+        """Callback storing a result in the cache."""
+        def store(content):
+            self.cache.put(key, tokens, content)
+        return store
+
+    def _invalidate(self, named_graph):
+        """Invalidate cached query results depending on a written graph."""
+        if self.cache is not None:
+            self.cache.invalidate(named_graph)
+
+    def _query_result(self, kind, source_graphs, query, content_type, stream):
+        """Run a query and pass the Graph Store results through, with stream=True as an iterable.
+
+        Results are looked up in and stored to the cache under kind.
+        """
+        key, tokens, cached = self._cache_lookup(kind, source_graphs, query, content_type)
+        if cached is not None:
+            app_logger.info('Served SPARQL {0} on named graphs: {1} from cache.'.format(kind, source_graphs))
+            return [cached] if stream else cached
         try:
-            sparql = SPARQLWrapper(store_api)
-            # add a default graph, though that can also be in the query string
-            for named_graph in source_graphs:
-                sparql.addDefaultGraph(named_graph)
-            sparql.setReturnFormat(XML)
-            sparql.setQuery(query)
-            data = sparql.query().convert().serialize(format=content_type)
+            request = self._sparql_request(source_graphs, query, content_type, stream)
         except Exception as error:
             app_logger.error('Something is wrong: {0}'.format(error))
             raise
-        app_logger.info('Execture SPARQL Construct on named graphs: {0}.'.format(source_graphs))
-        return data
+        app_logger.info('Execture SPARQL {0} on named graphs: {1}.'.format(kind, source_graphs))
+        if stream:
+            if key is None:
+                return ResponseStream(request)
+            return ResponseStream(request, on_complete=self._cache_store(key, tokens), limit=self.cache.entry_size)
+        if key is not None:
+            self.cache.put(key, tokens, request.content)
+        return request.content
+
+    @timed('graphmanager_graph_store_seconds', 'graphmanager_graph_store_errors_total', operation='graph_sparql')
+    def _graph_sparql(self, source_graphs, query, content_type, stream=False):
+        """Execute SPARQL query on the Graph Store.
+
+        The results are passed through unchanged in the requested content type,
+        with stream=True as an iterable.
+        """
+        return self._query_result('query', source_graphs, query, content_type, stream)
+
+    @timed('graphmanager_graph_store_seconds', 'graphmanager_graph_store_errors_total', operation='graph_construct')
+    def _graph_construct(self, source_graphs, query, content_type, stream=False):
+        """Execute SPARQL Construct on the Graph Store.
 
+        The Graph Store serializes the graph in the requested content type,
+        its bytes are passed through, with stream=True as an iterable.
+        """
+        return self._query_result('construct', source_graphs, query, content_type, stream)
+
+    @timed('graphmanager_graph_store_seconds', 'graphmanager_graph_store_errors_total', operation='graph_add')
     def _graph_add(self, named_graph, data, content_type):
-        """Update named graph in Graph Store."""
+        """Update named graph in Graph Store.
+
+        Data is a string or an open file, which is streamed.
+        """
         headers = {'content-type': content_type,
                    'cache-control': "no-cache"}
         try:
-            request = requests.post("{0}/data?graph={1}".format(self.request_address, named_graph), data=data, headers=headers)
+            request = self.session.post("{0}/data?graph={1}".format(self.request_address, named_graph), data=data, headers=headers, timeout=self.timeout)
         except Exception as error:
             app_logger.error('Something is wrong: {0}'.format(error))
             raise
+        finally:
+            self._invalidate(named_graph)
         app_logger.info('Updated named graph: {0}.'.format(named_graph))
-        return request.json()
+        result = request.json()
+        if self.index is not None and request.ok:
+            self.index.graph_added(named_graph, result.get('tripleCount', 0), data_size(data))
+        return result
 
+    @timed('graphmanager_graph_store_seconds', 'graphmanager_graph_store_errors_total', operation='graph_replace')
     def _graph_replace(self, named_graph, data, content_type):
-        """Update named graph in Graph Store."""
+        """Update named graph in Graph Store.
+
+        Data is a string or an open file, which is streamed.
+        """
         headers = {'content-type': content_type,
                    'cache-control': "no-cache"}
         try:
-            request = requests.put("{0}?graph={1}".format(self.request_address, named_graph), data=data, headers=headers)
+            request = self.session.put("{0}?graph={1}".format(self.request_address, named_graph), data=data, headers=headers, timeout=self.timeout)
         except Exception as error:
             app_logger.error('Something is wrong: {0}'.format(error))
             raise
+        finally:
+            self._invalidate(named_graph)
         app_logger.info('Replaced named graph: {0}.'.format(named_graph))
-        return request.json()
+        result = request.json()
+        if self.index is not None and request.ok:
+            self.index.graph_replaced(named_graph, result.get('tripleCount', 0), data_size(data))
+        return result
 
+    @timed('graphmanager_graph_store_seconds', 'graphmanager_graph_store_errors_total', operation='drop_graph')
     def _drop_graph(self, named_graph):
         """Drop named graph from Graph Store."""
         drop_query = quote(" DROP GRAPH <{0}>".format(named_graph))
@@ -157,9 +337,13 @@ class GraphStore(object):
         headers = {'content-type': "application/x-www-form-urlencoded",
                    'cache-control': "no-cache"}
         try:
-            request = requests.post("{0}/update".format(self.request_address), data=payload, headers=headers)
+            request = self.session.post("{0}/update".format(self.request_address), data=payload, headers=headers, timeout=self.timeout)
         except Exception as error:
             app_logger.error('Something is wrong: {0}'.format(error))
             raise
+        finally:
+            self._invalidate(named_graph)
         app_logger.info('Deleted named graph: {0}.'.format(named_graph))
+        if self.index is not None and request.ok:
+            self.index.graph_dropped(named_graph)
         return request.text
@@ -2,34 +2,69 @@ import time
 import json
 import threading
 import amqpstorm
+from multiprocessing.pool import ThreadPool
+from os import environ
 from amqpstorm import Message
 from amqpstorm import Connection
 from graph_manager.utils.logs import app_logger
+from graph_manager.utils import metrics
 from graph_manager.applib.construct_message import retrieve_message, query_message
 from graph_manager.applib.construct_message import replace_message, add_message
-from graph_manager.applib.construct_message import construct_message
+from graph_manager.applib.construct_message import construct_message, batch_message
 from graph_manager.applib.construct_message import response_message
 from graph_manager.utils.validate import valid_message
+from graph_manager.applib.envelope import Envelope
 from graph_manager.schemas import load_schema
 
+scaling = {'min': int(environ['RPCMINCONSUMERS']) if 'RPCMINCONSUMERS' in environ else 1,
+           'max': int(environ['RPCMAXCONSUMERS']) if 'RPCMAXCONSUMERS' in environ else 20,
+           'interval': float(environ['RPCSCALEINTERVAL']) if 'RPCSCALEINTERVAL' in environ else 10.0,
+           'backlog': int(environ['RPCSCALEBACKLOG']) if 'RPCSCALEBACKLOG' in environ else 5,
+           'wait': float(environ['RPCSCALEWAIT']) if 'RPCSCALEWAIT' in environ else 30.0,
+           'idle': float(environ['RPCSCALEIDLE']) if 'RPCSCALEIDLE' in environ else 0.5,
+           'checks': int(environ['RPCSCALECHECKS']) if 'RPCSCALECHECKS' in environ else 3}
+consuming = {'workers': int(environ['RPCWORKERS']) if 'RPCWORKERS' in environ else 1,
+             'prefetch': int(environ['RPCPREFETCH']) if 'RPCPREFETCH' in environ else None}
+
 
 class ScalableRpcServer(object):
-    """Graph Manger RPC server."""
+    """Graph Manger RPC server.
+
+    With autoscaling the number of consumers follows the backlog on the RPC
+    queue, between the configured minimum and maximum.
+    """
 
     def __init__(self, hostname='127.0.0.1',
                  username='guest', password='guest',
                  rpc_queue='base.rpc_queue',
-                 number_of_consumers=5, max_retries=None):
-        """Server init function."""
+                 number_of_consumers=5, max_retries=None,
+                 min_consumers=None, max_consumers=None, autoscale=True,
+                 workers=None, prefetch=None):
+        """Server init function.
+
+        Each consumer handles up to workers messages at a time and has up to
+        prefetch unacknowledged messages, by default as many as workers.
+        """
         self.hostname = hostname
         self.username = username
         self.password = password
         self.rpc_queue = rpc_queue
+        self.min_consumers = scaling['min'] if min_consumers is None else min_consumers
+        self.max_consumers = scaling['max'] if max_consumers is None else max_consumers
         self.number_of_consumers = number_of_consumers
         self.max_retries = max_retries
+        self.workers = workers or consuming['workers']
+        self.prefetch = prefetch or consuming['prefetch'] or self.workers
+        self.autoscale = autoscale and scaling['interval'] > 0
+        self.last_scaling = None
         self._connection = None
+        self._monitor = None
         self._consumers = []
+        self._draining = []
+        self._retired = []
+        self._scaling = {'time': time.time(), 'up': 0, 'down': 0}
         self._stopped = threading.Event()
+        self._drain = {'requested': False, 'timeout': 30}
 
     def start_server(self):
         """Start the RPC Server.
@@ -40,14 +75,22 @@ class ScalableRpcServer(object):
         if not self._connection or self._connection.is_closed:
             self._create_connection()
         while not self._stopped.is_set():
+            if self._drain['requested']:
+                self.drain(self._drain['timeout'])
+                break
             try:
                 # Check our connection for errors.
                 self._connection.check_for_errors()
+                if self.autoscale and time.time() - self._scaling['time'] >= scaling['interval']:
+                    self._autoscale()
                 self._update_consumers()
+                metrics.set_gauge('graphmanager_rpc_consumers', len(self._consumers))
+                metrics.set_gauge('graphmanager_rpc_in_flight', sum(consumer.busy for consumer in self._consumers))
             except amqpstorm.AMQPError as why:
                 # If an error occurs, re-connect and let update_consumers
                 # re-open the channels.
                 app_logger.error(why)
+                self._monitor = None
                 self._stop_consumers()
                 self._create_connection()
             time.sleep(1)
@@ -57,7 +100,7 @@ class ScalableRpcServer(object):
 
         :return:
         """
-        if self.number_of_consumers <= 20:
+        if self.number_of_consumers < self.max_consumers:
             self.number_of_consumers += 1
 
     def decrease_consumers(self):
@@ -65,9 +108,92 @@ class ScalableRpcServer(object):
 
         :return:
         """
-        if self.number_of_consumers > 0:
+        if self.number_of_consumers > self.min_consumers:
             self.number_of_consumers -= 1
 
+    def queue_depth(self):
+        """Number of messages waiting on the RPC queue.
+
+        :return:
+        """
+        if self._monitor is None or not self._monitor.is_open:
+            self._monitor = self._connection.channel(rpc_timeout=10)
+        return self._monitor.queue.declare(self.rpc_queue, passive=True)['message_count']
+
+    def _consumer_stats(self):
+        """Utilization of the consumers and messages handled, with the time spent, since the last check.
+
+        Consumers stopped since the last check still count for what they handled.
+        """
+        handled, handling = 0, 0.0
+        for consumer in self._consumers + self._retired:
+            consumer_handled, consumer_handling = consumer.take_stats()
+            handled += consumer_handled
+            handling += consumer_handling
+        self._retired = []
+        capacity = sum(consumer.capacity for consumer in self._consumers)
+        busy = sum(consumer.busy for consumer in self._consumers)
+        return float(busy) / capacity if capacity else 0.0, handled, handling
+
+    def _autoscale(self):
+        """Scale the consumers on the queue depth, utilization and handling latency.
+
+        Scale up when the backlog per consumer, or the time it would take to
+        work through it, is too long. Scale down when the queue is empty and
+        few consumers are busy. A decision needs the same signal on several
+        consecutive checks.
+
+        :return:
+        """
+        depth = self.queue_depth()
+        utilization, handled, handling = self._consumer_stats()
+        self._scaling['time'] = time.time()
+        consumers = max(self.number_of_consumers, 1)
+        latency = handling / handled if handled else 0.0
+        wait = depth * latency / consumers
+        if depth > 0 and (float(depth) / consumers > scaling['backlog'] or wait > scaling['wait']):
+            self._scaling['up'], self._scaling['down'] = self._scaling['up'] + 1, 0
+        elif depth == 0 and utilization < scaling['idle']:
+            self._scaling['up'], self._scaling['down'] = 0, self._scaling['down'] + 1
+        else:
+            self._scaling['up'], self._scaling['down'] = 0, 0
+        before = self.number_of_consumers
+        if self._scaling['up'] >= scaling['checks']:
+            self._scaling['up'] = 0
+            self.increase_consumers()
+        elif self._scaling['down'] >= scaling['checks']:
+            self._scaling['down'] = 0
+            self.decrease_consumers()
+        self.last_scaling = {'queueDepth': depth, 'utilization': utilization, 'latency': latency,
+                             'consumers': self.number_of_consumers}
+        if self.number_of_consumers != before:
+            app_logger.info('Scaled RPC consumers from {0} to {1}: queue depth {2}, utilization {3:.2f}, latency {4:.3f}s.'.format(
+                            before, self.number_of_consumers, depth, utilization, latency))
+
+    def request_drain(self, timeout=30):
+        """Ask the server loop to drain, safe to call from a signal handler.
+
+        :param timeout: seconds to wait for messages in progress
+        :return:
+        """
+        self._drain['timeout'] = timeout
+        self._drain['requested'] = True
+
+    def drain(self, timeout=30):
+        """Stop taking messages and wait for those in progress, then stop.
+
+        :param timeout: seconds to wait for messages in progress
+        :return:
+        """
+        self._stopped.set()
+        for consumer in self._consumers:
+            consumer.drain()
+        deadline = time.time() + timeout
+        while any(consumer.active for consumer in self._consumers) and time.time() < deadline:
+            time.sleep(0.1)
+        app_logger.info('Drained RPC consumers, stopping.')
+        self.stop()
+
     def stop(self):
         """Stop all consumers.
 
@@ -76,6 +202,7 @@ class ScalableRpcServer(object):
         while self._consumers:
             consumer = self._consumers.pop()
             consumer.stop()
+        self._draining = []
         self._stopped.set()
         self._connection.close()
 
@@ -108,27 +235,56 @@ class ScalableRpcServer(object):
 
             - Add more if requested.
             - Make sure the consumers are healthy.
-            - Remove excess consumers.
+            - Drain excess consumers and remove those that stopped.
 
         :return:
         """
         # Do we need to start more consumers.
+        serving = len(self._consumers) - len(self._draining)
         consumer_to_start = \
-            min(max(self.number_of_consumers - len(self._consumers), 0), 2)
+            min(max(self.number_of_consumers - serving, 0), 2)
         for _ in range(consumer_to_start):
-            consumer = Consumer(self.rpc_queue)
+            consumer = self._create_consumer()
             self._start_consumer(consumer)
             self._consumers.append(consumer)
 
         # Check that all our consumers are active.
         for consumer in self._consumers:
-            if consumer.active:
+            if consumer.active or consumer in self._draining:
                 continue
             self._start_consumer(consumer)
             break
 
         # Do we have any overflow of consumers.
-        self._stop_consumers(self.number_of_consumers)
+        self._drain_consumers(self.number_of_consumers)
+
+    def _create_consumer(self):
+        """Create a consumer for the RPC queue.
+
+        :return:
+        """
+        return Consumer(self.rpc_queue, prefetch=self.prefetch, workers=self.workers)
+
+    def _drain_consumers(self, number_of_consumers):
+        """Drain the consumers above a number, idle ones first.
+
+        A draining consumer takes no new messages, acknowledges those in
+        progress and is only removed once it has stopped.
+
+        :param number_of_consumers:
+        :return:
+        """
+        serving = [consumer for consumer in self._consumers if consumer not in self._draining]
+        excess = max(len(serving) - number_of_consumers, 0)
+        for consumer in sorted(reversed(serving), key=lambda consumer: consumer.busy)[:excess]:
+            self._draining.append(consumer)
+        for consumer in list(self._draining):
+            if consumer.active:
+                consumer.drain()
+                continue
+            self._draining.remove(consumer)
+            self._consumers.remove(consumer)
+            self._retired.append(consumer)
 
     def _stop_consumers(self, number_of_consumers=0):
         """Stop a specific number of consumers.
@@ -139,6 +295,8 @@ class ScalableRpcServer(object):
         while len(self._consumers) > number_of_consumers:
             consumer = self._consumers.pop()
             consumer.stop()
+            self._retired.append(consumer)
+        self._draining = [draining for draining in self._draining if draining in self._consumers]
 
     def _start_consumer(self, consumer):
         """Start a consumer as a new Thread.
@@ -155,23 +313,44 @@ class ScalableRpcServer(object):
 class Consumer(object):
     """Handle requests in a consumer."""
 
-    def __init__(self, rpc_queue):
-        """Consumer init function."""
+    def __init__(self, rpc_queue, prefetch=1, spawn=None, workers=1):
+        """Consumer init function.
+
+        With a spawn function messages are handed to it instead of being
+        processed on the consuming thread, up to prefetch at a time. Without
+        one, more than one worker gives the consumer its own thread pool.
+        """
         self.rpc_queue = rpc_queue
+        self.prefetch = prefetch
+        self.spawn = spawn
+        self.workers = workers
+        self.capacity = prefetch if spawn is not None else workers
+        self._pool = None
         self.channel = None
         self.active = False
+        self.busy = 0
+        self.handled = 0
+        self.handling = 0.0
+        self._lock = threading.Lock()
 
     def start(self, connection):
         """Start the Consumers."""
         self.channel = None
         try:
             self.active = True
+            if self.spawn is None and self.workers > 1 and self._pool is None:
+                self._pool = ThreadPool(self.workers)
             self.channel = connection.channel(rpc_timeout=10)
-            self.channel.basic.qos(1)
+            self.channel.basic.qos(self.prefetch)
             self.channel.queue.declare(self.rpc_queue)
             self.channel.basic.consume(self, self.rpc_queue, no_ack=False)
             self.channel.start_consuming(to_tuple=False)
-            app_logger.info('Connected to queue {0}'.format(self.queue))
+            if self._pool is not None:
+                # Let pooled messages finish while the channel is still open.
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+            app_logger.info('Connected to queue {0}'.format(self.rpc_queue))
             if not self.channel.consumer_tags:
                 # Only close the channel if there is nothing consuming.
                 # This is to allow messages that are still being processed
@@ -182,26 +361,65 @@ class Consumer(object):
         finally:
             self.active = False
 
+    def drain(self):
+        """Stop taking messages, those in progress are still acknowledged."""
+        if self.channel:
+            try:
+                self.channel.stop_consuming()
+            except amqpstorm.AMQPError:
+                pass
+
     def stop(self):
-        """Stop the Consumers."""
+        """Stop the Consumers.
+
+        Messages still in the worker pool are not acknowledged, the broker
+        delivers them again.
+        """
         if self.channel:
             self.channel.close()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def take_stats(self):
+        """Return and reset the messages handled and the time spent on them."""
+        with self._lock:
+            stats = (self.handled, self.handling)
+            self.handled, self.handling = 0, 0.0
+        return stats
 
     @valid_message(load_schema('message'))
-    def _handle_message(self, message):
+    def _handle_message(self, message, parsed=None):
         """Handle graph manager messages."""
-        message_data = json.loads(message.body)
-        action = message_data["payload"]["graphManagerInput"]["task"]
+        envelope = Envelope(parsed)
+        action = envelope.task
+        start = time.time()
+        try:
+            result = self._dispatch(envelope)
+        except Exception:
+            metrics.inc('graphmanager_rpc_tasks_total', task=action, status="error")
+            raise
+        else:
+            metrics.inc('graphmanager_rpc_tasks_total', task=action, status="success")
+            return result
+        finally:
+            metrics.observe('graphmanager_rpc_task_seconds', time.time() - start, task=action)
+
+    def _dispatch(self, envelope):
+        """Run the task of a message."""
+        action = envelope.task
         if action == "add":
-            return str(add_message(message_data))
+            return str(add_message(envelope))
         elif action == "query":
-            return str(query_message(message_data))
+            return str(query_message(envelope))
         elif action == "retrieve":
-            return str(retrieve_message(message_data))
+            return str(retrieve_message(envelope))
         elif action == "replace":
-            return str(replace_message(message_data))
+            return str(replace_message(envelope))
         elif action == "construct":
-            return str(construct_message(message_data))
+            return str(construct_message(envelope))
+        elif action == "batch":
+            return str(batch_message(envelope))
         else:
             raise KeyError("Missing action or task not specified.")
 
@@ -211,15 +429,60 @@ class Consumer(object):
         :param Message message:
         :return:
         """
+        if self.spawn is not None:
+            self.spawn(self._process, message)
+        elif self._pool is not None:
+            self._pool.apply_async(self._pooled, (message,))
+        else:
+            self._process(message)
+
+    def _pooled(self, message):
+        """Process a message on the worker pool, where errors are only logged.
+
+        :param Message message:
+        :return:
+        """
+        try:
+            self._process(message)
+        except Exception as why:
+            app_logger.error('Could not reply to message {0}: {1}'.format(message.delivery_tag, why))
+
+    def _process(self, message):
+        """Handle the message and publish the reply, keeping handling statistics.
+
+        :param Message message:
+        :return:
+        """
+        with self._lock:
+            self.busy += 1
+        start = time.time()
         try:
-            processed_message = self._handle_message(message)
+            self._reply(message)
+        finally:
+            with self._lock:
+                self.busy -= 1
+                self.handled += 1
+                self.handling += time.time() - start
+
+    def _reply(self, message):
+        """Handle the message and publish the reply.
+
+        :param Message message:
+        :return:
+        """
+        message_data = None
+        try:
+            # Parsed once here, also for the error reply.
+            message_data = json.loads(message.body)
+            processed_message = self._handle_message(message, parsed=message_data)
         except Exception as e:
             app_logger.error('Something went wrong: {0}'.format(e))
+            if message_data is None:
+                raise
             properties = {
                 'correlation_id': message.correlation_id
             }
             error_message = "Error Type: {0}, with message: {1}".format(e.__class__.__name__, e.message)
-            message_data = json.loads(message.body)
             processed_message = response_message(message_data["provenance"], status="error", status_messsage=error_message)
             response = Message.create(message.channel, str(json.dumps(processed_message, indent=4, separators=(',', ': '))), properties)
             response.publish(message.reply_to)
@@ -1,35 +1,320 @@
-# import threading
+import os
+import re
+import time
+import errno
+import uuid
+import Queue
+import atexit
+import threading
+import amqpstorm
+from os import environ
 from amqpstorm import Message
 from amqpstorm import Connection
 from graph_manager.utils.logs import app_logger
+from graph_manager.utils.file import data
+
+buffering = {'size': int(environ['PROVBUFFER']) if 'PROVBUFFER' in environ else 1000,
+             'batch': int(environ['PROVBATCH']) if 'PROVBATCH' in environ else 100,
+             'overflow': environ['PROVOVERFLOW'] if 'PROVOVERFLOW' in environ else "block",
+             'directory': environ['PROVSPILLDIR'] if 'PROVSPILLDIR' in environ else "{0}/graphmanager/provenance".format(data['directory'])}
+
+_lock = threading.Lock()
+_publishers = {'pid': None, 'publishers': dict(), 'background': dict()}
 
 
 class Publisher(object):
-    """Provenance message pubblisher."""
+    """Provenance message pubblisher.
+
+    Keeps one connection open and a pool of channels shared by all threads.
+    The queue is declared once per connection. The channels are in
+    publisher confirm mode, each message is published once the broker
+    has confirmed the one before.
+    """
 
     def __init__(self, hostname='127.0.0.1',
                  username='guest', password='guest',
-                 queue='base.queue'):
+                 queue='base.queue', channels=4, max_retries=2):
         """Consumer init function."""
         self.hostname = hostname
         self.username = username
         self.password = password
         self.queue = queue
+        self.channels = channels
+        self.max_retries = max_retries
+        self._connection = None
+        self._declared = False
+        self._pool = Queue.Queue()
+        self._lock = threading.Lock()
+
+    def _channel(self):
+        """Take a channel from the pool or open a new one."""
+        try:
+            channel = self._pool.get_nowait()
+        except Queue.Empty:
+            channel = None
+        if channel is None or not channel.is_open:
+            with self._lock:
+                if self._connection is None or not self._connection.is_open:
+                    self._connection = Connection(self.hostname, self.username, self.password)
+                    self._declared = False
+                    app_logger.info('Established connection with AMQP server {0}'.format(self._connection))
+                connection = self._connection
+            channel = connection.channel()
+            channel.confirm_deliveries()
+        if not self._declared:
+            channel.queue.declare(self.queue)
+            self._declared = True
+        return channel
 
-    # def push(self, message):
-    #     """Push message."""
-    #     thread = threading.Thread(target=self.start(message))
-    #     thread.daemon = True
-    #     thread.start()
+    def _release(self, channel):
+        """Return a channel to the pool, closing any above the pool size."""
+        if self._pool.qsize() < self.channels:
+            self._pool.put(channel)
+        else:
+            channel.close()
+
+    def _discard(self, channel):
+        """Close a channel after an error."""
+        try:
+            if channel is not None:
+                channel.close()
+        except amqpstorm.AMQPError:
+            pass
+
+    def push_batch(self, messages):
+        """Publish messages to the queue, each confirmed by the broker.
+
+        Reconnects after a failure and publishes the messages not yet
+        confirmed again.
+        """
+        properties = {
+            'content_type': 'application/json'
+        }
+        attempts = 0
+        confirmed = 0
+        while True:
+            attempts += 1
+            channel = None
+            try:
+                channel = self._channel()
+                for message in messages[confirmed:]:
+                    if not Message.create(channel, message, properties).publish(self.queue):
+                        raise amqpstorm.AMQPMessageError('Broker refused a message.')
+                    confirmed += 1
+            except amqpstorm.AMQPError as why:
+                app_logger.error('Publishing failed: {0}'.format(why))
+                self._discard(channel)
+                if attempts > self.max_retries:
+                    raise
+                time.sleep(min(attempts - 1, 5))
+            else:
+                self._release(channel)
+                app_logger.info('Pushed {0} message(s) to: {1}.'.format(len(messages), self.queue))
+                return
 
     def push(self, message):
-        """Start channel to provenance inbox."""
-        with Connection(self.hostname, self.username, self.password) as connection:
-            with connection.channel() as channel:
-                channel.queue.declare(self.queue)
-                properties = {
-                    'content_type': 'application/json'
-                }
-                message = Message.create(channel, message, properties)
-                message.publish(self.queue)
-                app_logger.info('Pushed message: {0}.'.format(message))
+        """Publish one message to the queue."""
+        self.push_batch([message])
+
+    def close(self):
+        """Close the channels and the connection."""
+        with self._lock:
+            while not self._pool.empty():
+                self._discard(self._pool.get_nowait())
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+class BackgroundPublisher(object):
+    """Publish messages from a bounded in-process buffer on a background thread.
+
+    Messages are sent in batches. When the buffer is full the overflow
+    policy applies: block the caller, spill the message to disk or drop it.
+    With spilling, batches the broker refuses are also written to disk and
+    sent again once the buffer has been emptied.
+    """
+
+    def __init__(self, publisher, size=1000, batch=100, overflow="block", directory=None):
+        """Start the background sender."""
+        if overflow not in ("block", "spill", "drop"):
+            raise ValueError('Unknown overflow policy: {0}'.format(overflow))
+        self.publisher = publisher
+        self.batch = batch
+        self.overflow = overflow
+        self.directory = directory if overflow == "spill" else None
+        self.sent = 0
+        self.spilled = 0
+        self.dropped = 0
+        self._queue = Queue.Queue(size)
+        self._stopped = threading.Event()
+        if self.directory is not None:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            self._release_claims()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, message):
+        """Hand a message to the background sender."""
+        if self.overflow == "block":
+            self._queue.put(message)
+            return
+        try:
+            self._queue.put_nowait(message)
+        except Queue.Full:
+            if self.overflow == "spill":
+                self._spill([message])
+            else:
+                self.dropped += 1
+                app_logger.warning('Provenance buffer full, dropped {0} message(s) so far.'.format(self.dropped))
+
+    def close(self, timeout=10):
+        """Send what is buffered and stop the background sender."""
+        self._stopped.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            app_logger.error('Provenance sender did not finish, {0} message(s) left.'.format(self._queue.qsize()))
+
+    def _next_batch(self):
+        """Wait briefly for a message and take up to a batch."""
+        messages = []
+        try:
+            messages.append(self._queue.get(timeout=0.5))
+            while len(messages) < self.batch:
+                messages.append(self._queue.get_nowait())
+        except Queue.Empty:
+            pass
+        return messages
+
+    def _run(self):
+        """Send batches until stopped and the buffer is empty."""
+        while not (self._stopped.is_set() and self._queue.empty()):
+            messages = self._next_batch()
+            if messages:
+                self._send(messages)
+            elif self.directory is not None:
+                self._send_spilled()
+
+    def _send(self, messages):
+        """Send a batch, retrying until it is sent, spilled or we are stopping."""
+        attempts = 0
+        while True:
+            try:
+                self.publisher.push_batch(messages)
+            except Exception as error:
+                app_logger.error('Sending provenance failed: {0}'.format(error))
+                if self.directory is not None:
+                    self._spill(messages)
+                    return False
+                if self._stopped.is_set():
+                    self.dropped += len(messages)
+                    return False
+                attempts += 1
+                time.sleep(min(attempts, 30))
+            else:
+                self.sent += len(messages)
+                return True
+
+    def _spill(self, messages):
+        """Write messages to the spill directory."""
+        for message in messages:
+            name = "{0:017.6f}-{1}.json".format(time.time(), uuid.uuid4().hex)
+            temp = os.path.join(self.directory, "{0}.tmp".format(name))
+            with open(temp, "wb") as f:
+                f.write(message)
+            os.rename(temp, os.path.join(self.directory, name))
+        self.spilled += len(messages)
+
+    def _send_spilled(self):
+        """Send spilled messages in order, claiming each file first.
+
+        The claimed files are removed once the broker has the messages and
+        put back to be sent again otherwise.
+        """
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".json"))[:self.batch]
+        claimed = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                os.rename(path, "{0}.{1}".format(path, os.getpid()))
+            except OSError:
+                continue
+            claimed.append(path)
+        if not claimed:
+            return
+        try:
+            messages = []
+            for path in claimed:
+                with open("{0}.{1}".format(path, os.getpid()), "rb") as f:
+                    messages.append(f.read())
+            self.publisher.push_batch(messages)
+        except Exception as error:
+            app_logger.error('Sending spilled provenance failed: {0}'.format(error))
+            for path in claimed:
+                os.rename("{0}.{1}".format(path, os.getpid()), path)
+            return
+        for path in claimed:
+            os.remove("{0}.{1}".format(path, os.getpid()))
+        self.sent += len(messages)
+
+    def _release_claims(self):
+        """Put back the spill files claimed by processes that are gone."""
+        for name in os.listdir(self.directory):
+            match = re.match(r'^(.+\.json)\.(\d+)$', name)
+            if match is None:
+                continue
+            pid = int(match.group(2))
+            if pid != os.getpid():
+                try:
+                    os.kill(pid, 0)
+                    continue
+                except OSError as error:
+                    if error.errno != errno.ESRCH:
+                        continue
+            try:
+                os.rename(os.path.join(self.directory, name), os.path.join(self.directory, match.group(1)))
+            except OSError:
+                pass
+
+
+def shared_publisher(hostname, username, password, queue):
+    """Return the process wide publisher for a queue."""
+    pid = os.getpid()
+    with _lock:
+        if _publishers['pid'] != pid:
+            _publishers['pid'] = pid
+            _publishers['publishers'] = dict()
+            _publishers['background'] = dict()
+        if queue not in _publishers['publishers']:
+            _publishers['publishers'][queue] = Publisher(hostname, username, password, queue)
+        return _publishers['publishers'][queue]
+
+
+def background_publisher(hostname, username, password, queue):
+    """Return the process wide background publisher for a queue.
+
+    It is flushed when the process exits.
+    """
+    publisher = shared_publisher(hostname, username, password, queue)
+    with _lock:
+        if queue not in _publishers['background']:
+            background = BackgroundPublisher(publisher, buffering['size'], buffering['batch'],
+                                             buffering['overflow'], buffering['directory'])
+            atexit.register(background.close)
+            _publishers['background'][queue] = background
+        return _publishers['background'][queue]
+
+
+def close_publishers():
+    """Flush and stop the background publishers of this process.
+
+    For processes that exit without running the exit handlers.
+    """
+    with _lock:
+        if _publishers['pid'] != os.getpid():
+            return
+        backgrounds = list(_publishers['background'].values())
+    for background in backgrounds:
+        background.close()
@@ -0,0 +1,212 @@
+import os
+import re
+import time
+import uuid
+import errno
+import hashlib
+import threading
+import cPickle as pickle
+from os import environ
+from collections import OrderedDict
+from graph_manager.utils.logs import app_logger
+
+cache = {'size': int(environ['GCACHESIZE']) if 'GCACHESIZE' in environ else 0,
+         'entrySize': int(environ['GCACHEENTRYSIZE']) if 'GCACHEENTRYSIZE' in environ else 8388608,
+         'ttl': int(environ['GCACHETTL']) if 'GCACHETTL' in environ else 300,
+         'directory': environ['GCACHEDIR'] if 'GCACHEDIR' in environ else None,
+         'diskSize': int(environ['GCACHEDISKSIZE']) if 'GCACHEDISKSIZE' in environ else 1073741824,
+         'multiProcess': False}
+
+# Every write also changes this token, it covers queries without explicit source graphs.
+ANY_GRAPH = '*'
+
+_lock = threading.Lock()
+_cache = {'pid': None, 'cache': None}
+
+
+def cache_key(kind, source_graphs, query, content_type):
+    """Key a query by its normalized text, the set of source graphs and the content type."""
+    normalized = re.sub(r'\s+', ' ', query).strip()
+    graphs = '\n'.join(sorted(set(source_graphs)))
+    return hashlib.sha1(u'\0'.join([kind, normalized, graphs, content_type]).encode('utf-8')).hexdigest()
+
+
+def _graph_file(graph):
+    """File name for a graph generation token."""
+    return hashlib.sha1(graph.encode('utf-8')).hexdigest()
+
+
+def _write_atomic(path, content):
+    """Write a file so readers see either the old or the new content."""
+    temp = '{0}.{1}.tmp'.format(path, uuid.uuid4().hex)
+    with open(temp, 'wb') as f:
+        f.write(content)
+    os.rename(temp, path)
+
+
+class QueryCache(object):
+    """Size bounded LRU/TTL cache for query results.
+
+    Each entry remembers the generation token of the graphs it was computed
+    from; writing a graph changes its token, which invalidates the entries
+    depending on it. With a directory, entries and tokens are also kept on
+    disk so the API workers and the RPC server see the same cache.
+    """
+
+    def __init__(self, size, entry_size, ttl, directory=None, disk_size=None):
+        """Set up the memory tier and the optional disk tier."""
+        self.size = size
+        self.entry_size = min(entry_size, size)
+        self.ttl = ttl
+        self.directory = directory
+        self.disk_size = disk_size
+        self._entries = OrderedDict()
+        self._generations = dict()
+        self._bytes = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        if directory is not None:
+            for folder in ('entries', 'generations'):
+                path = os.path.join(directory, folder)
+                if not os.path.exists(path):
+                    os.makedirs(path)
+
+    def _tokens(self, source_graphs):
+        """Current generation tokens of the graphs a query depends on."""
+        graphs = sorted(set(source_graphs)) or [ANY_GRAPH]
+        if self.directory is None:
+            return dict((graph, self._generations.get(graph)) for graph in graphs)
+        tokens = dict()
+        for graph in graphs:
+            try:
+                with open(os.path.join(self.directory, 'generations', _graph_file(graph)), 'rb') as f:
+                    tokens[graph] = f.read()
+            except IOError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+                tokens[graph] = None
+        return tokens
+
+    def tokens(self, source_graphs):
+        """Snapshot the generation tokens before running a query."""
+        with self._lock:
+            return self._tokens(source_graphs)
+
+    def get(self, key, source_graphs):
+        """Return the cached result or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self.directory is not None:
+                entry = self._disk_get(key)
+                if entry is not None:
+                    self._memory_put(key, entry)
+            if entry is None:
+                return None
+            created, tokens, content = entry
+            if now - created > self.ttl or tokens != self._tokens(source_graphs):
+                self._remove(key)
+                return None
+            self._entries[key] = self._entries.pop(key)
+            return content
+
+    def put(self, key, tokens, content):
+        """Cache a result computed while the graphs had the given tokens."""
+        if len(content) > self.entry_size:
+            return
+        entry = (time.time(), tokens, content)
+        with self._lock:
+            self._memory_put(key, entry)
+            if self.directory is not None:
+                self._disk_put(key, entry)
+
+    def invalidate(self, named_graph):
+        """Invalidate entries depending on a graph that has been written."""
+        with self._lock:
+            for graph in (named_graph, ANY_GRAPH):
+                token = uuid.uuid4().hex
+                if self.directory is None:
+                    self._generations[graph] = token
+                else:
+                    _write_atomic(os.path.join(self.directory, 'generations', _graph_file(graph)), token)
+
+    def _memory_put(self, key, entry):
+        """Add to the memory tier evicting least recently used entries."""
+        if key in self._entries:
+            self._bytes -= len(self._entries.pop(key)[2])
+        self._entries[key] = entry
+        self._bytes += len(entry[2])
+        while self._bytes > self.size:
+            self._bytes -= len(self._entries.popitem(last=False)[1][2])
+
+    def _remove(self, key):
+        """Remove an entry from both tiers."""
+        if key in self._entries:
+            self._bytes -= len(self._entries.pop(key)[2])
+        if self.directory is not None:
+            try:
+                os.remove(os.path.join(self.directory, 'entries', key))
+            except OSError:
+                pass
+
+    def _disk_get(self, key):
+        """Read an entry from the disk tier."""
+        try:
+            with open(os.path.join(self.directory, 'entries', key), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _disk_put(self, key, entry):
+        """Write an entry to the disk tier and prune it every so often."""
+        _write_atomic(os.path.join(self.directory, 'entries', key), pickle.dumps(entry, pickle.HIGHEST_PROTOCOL))
+        self._puts += 1
+        if self._puts % 100 == 0:
+            self._disk_prune()
+
+    def _disk_prune(self):
+        """Remove the oldest disk entries until the disk tier fits its size."""
+        folder = os.path.join(self.directory, 'entries')
+        files = []
+        for name in os.listdir(folder):
+            try:
+                stat = os.stat(os.path.join(folder, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(f[1] for f in files)
+        for mtime, size, name in sorted(files):
+            if total <= self.disk_size:
+                break
+            try:
+                os.remove(os.path.join(folder, name))
+            except OSError:
+                pass
+            total -= size
+        app_logger.info('Pruned query cache directory to {0} bytes.'.format(total))
+
+
+def shared_cache():
+    """Return the process wide query cache, or None if it is disabled.
+
+    Without GCACHEDIR the generation tokens live in the memory of each
+    process, so a process never sees the graphs another one writes. The
+    cache is then only used when a single process serves and writes the
+    graphs; once the API workers and the RPC server run it stays off until
+    GCACHEDIR gives them shared tokens.
+    """
+    if cache['size'] <= 0:
+        return None
+    pid = os.getpid()
+    if _cache['pid'] != pid:
+        with _lock:
+            if _cache['pid'] != pid:
+                if cache['directory'] is None and cache['multiProcess']:
+                    app_logger.warning('Query cache disabled: GCACHESIZE is set without GCACHEDIR, '
+                                       'other processes would not invalidate the entries of this one.')
+                    _cache['cache'] = None
+                else:
+                    _cache['cache'] = QueryCache(cache['size'], cache['entrySize'], cache['ttl'],
+                                                 cache['directory'], cache['diskSize'])
+                _cache['pid'] = pid
+    return _cache['cache']
@@ -0,0 +1,114 @@
+import os
+import time
+import errno
+import signal
+from os import environ
+from graph_manager.utils.logs import app_logger
+
+supervision = {'drain': float(environ['RPCDRAINTIMEOUT']) if 'RPCDRAINTIMEOUT' in environ else 30.0}
+
+
+class ProcessSupervisor(object):
+    """Run a target in several forked worker processes.
+
+    Workers that exit without being asked to are started again, after a
+    delay growing with the crashes that follow each other quickly. SIGTERM
+    or SIGINT are passed on to the workers, which get a few seconds more
+    than drain_timeout to finish before they are killed.
+    """
+
+    def __init__(self, target, processes=2, drain_timeout=None):
+        """Supervisor init function."""
+        self.target = target
+        self.processes = processes
+        self.drain_timeout = supervision['drain'] if drain_timeout is None else drain_timeout
+        self.restarts = 0
+        self._workers = dict()
+        self._pending = []
+        self._crashes = 0
+        self._stopping = None
+
+    def start(self):
+        """Start the workers and supervise them until they are stopped.
+
+        :return:
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.processes):
+            self._spawn()
+        self._supervise()
+
+    def stop(self, signum=None, frame=None):
+        """Ask the workers to drain and stop.
+
+        :return:
+        """
+        if self._stopping is not None:
+            return
+        self._stopping = time.time()
+        app_logger.info('Stopping {0} RPC worker process(es).'.format(len(self._workers)))
+        self._signal(signal.SIGTERM)
+
+    def _signal(self, signum):
+        """Send a signal to every worker."""
+        for pid in list(self._workers):
+            try:
+                os.kill(pid, signum)
+            except OSError as error:
+                if error.errno != errno.ESRCH:
+                    raise
+
+    def _spawn(self):
+        """Fork a worker process running the target."""
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # The supervisor passes Ctrl-C on as SIGTERM, so workers can drain.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            code = 0
+            try:
+                self.target()
+            except BaseException as error:
+                app_logger.error('RPC worker failed: {0}'.format(error))
+                code = 1
+            finally:
+                os._exit(code)
+        self._workers[pid] = time.time()
+        app_logger.info('Started RPC worker process {0}.'.format(pid))
+
+    def _reap(self):
+        """Collect workers that exited, schedule a restart for those that crashed."""
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                raise
+            if pid == 0:
+                return
+            started = self._workers.pop(pid, None)
+            if started is None or self._stopping is not None:
+                continue
+            self._crashes = self._crashes + 1 if time.time() - started < 10 else 0
+            delay = min(2 ** self._crashes - 1, 30)
+            app_logger.error('RPC worker process {0} exited with status {1}, restarting in {2}s.'.format(pid, status, delay))
+            self._pending.append(time.time() + delay)
+
+    def _supervise(self):
+        """Reap and restart workers until stopped and all have exited."""
+        while self._workers or (self._pending and self._stopping is None):
+            self._reap()
+            now = time.time()
+            if self._stopping is not None:
+                if now - self._stopping > self.drain_timeout + 5:
+                    app_logger.error('RPC workers did not drain in time, killing them.')
+                    self._signal(signal.SIGKILL)
+            else:
+                for due in [due for due in self._pending if due <= now]:
+                    self._pending.remove(due)
+                    self.restarts += 1
+                    self._spawn()
+            time.sleep(0.2)
+        app_logger.info('All RPC worker processes stopped.')
@@ -0,0 +1,21 @@
+import sys
+
+
+def cooperative_requested(argv):
+    """Whether the command line asks for the cooperative RPC server."""
+    args = argv[1:]
+    if 'rpc' not in args:
+        return False
+    return '--mode=cooperative' in args or any(a == '--mode' and b == 'cooperative' for a, b in zip(args, args[1:]))
+
+
+# Imported first by the entry point: gevent has to patch the standard library
+# before any lock, thread pool, session or socket is created.
+if cooperative_requested(sys.argv):
+    try:
+        from gevent import monkey
+    except ImportError:
+        # The rpc command reports that gevent is missing.
+        pass
+    else:
+        monkey.patch_all()
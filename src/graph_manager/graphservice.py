@@ -1,9 +1,15 @@
+import graph_manager.cooperative_patch  # noqa: F401 - has to come before every other import
 import click
+import signal
 import multiprocessing
 import gunicorn.app.base
 from graph_manager.app import init_api
 from graph_manager.applib.messaging import ScalableRpcServer
+from graph_manager.applib.messaging_publish import close_publishers
+from graph_manager.applib.query_cache import cache
+from graph_manager.applib.supervisor import ProcessSupervisor, supervision
 from graph_manager.utils.broker import broker
+from graph_manager.utils.session import pool
 from gunicorn.six import iteritems
 
 
@@ -16,31 +22,95 @@ def cli():
 @cli.command('server')
 @click.option('--host', default='127.0.0.1', help='gmAPI host.')
 @click.option('--port', default=4302, help='gmAPI server port.')
-@click.option('--workers', default=2, help='gmAPI server workers.')
+@click.option('--workers', default='2', help='gmAPI server workers, auto for two per CPU core plus one.')
+@click.option('--worker-class', default='sync', type=click.Choice(['sync', 'gthread', 'gevent']),
+              help='sync workers, threaded workers (requires futures on Python 2) or cooperative workers (requires gevent).')
+@click.option('--threads', default=1, help='requests each gthread worker handles at a time.')
+@click.option('--max-requests', default=0, help='requests after which a worker is restarted, 0 never restarts it.')
+@click.option('--preload/--no-preload', default=False, help='load the application before forking the workers.')
 @click.option('--log', default='logs/server.log', help='log file for app.')
-def server(host, port, log, workers):
+def server(host, port, log, workers, worker_class, threads, max_requests, preload):
     """Run the server with options."""
+    if worker_class == 'gthread':
+        try:
+            import concurrent.futures  # noqa: F401
+        except ImportError:
+            raise click.UsageError('Threaded workers require futures to be installed.')
+    elif worker_class == 'gevent':
+        try:
+            import gevent  # noqa: F401
+        except ImportError:
+            raise click.UsageError('Cooperative workers require gevent to be installed.')
+    # Keep a Graph Store connection for every thread of a worker.
+    pool['size'] = max(pool['size'], threads)
+    # The workers and the RPC server write graphs from separate processes.
+    cache['multiProcess'] = True
     options = {
         'bind': '{0}:{1}'.format(host, port),
-        'workers': workers,
+        'workers': worker_count(workers),
+        'worker_class': worker_class,
+        'threads': threads,
+        'max_requests': max_requests,
+        'max_requests_jitter': max_requests // 10,
+        'preload_app': preload,
         'daemon': 'True',
         'errorlog': log
     }
-    GMApplication(init_api(), options).run()
+    GMApplication(init_api() if preload else None, options).run()
 
 
 @cli.command('rpc')
-def rpc():
+@click.option('--mode', default='threaded', type=click.Choice(['threaded', 'cooperative']),
+              help='threaded consumers or one gevent loop (requires gevent).')
+@click.option('--inflight', default=100, help='messages in flight in cooperative mode.')
+@click.option('--workers', default=None, type=int, help='messages each consumer handles at a time in threaded mode.')
+@click.option('--prefetch', default=None, type=int, help='unacknowledged messages per consumer in threaded mode.')
+@click.option('--processes', default=1, help='RPC server processes, more than one are supervised and restarted.')
+def rpc(mode, inflight, workers, prefetch, processes):
     """RPC server."""
-    RPC_SERVER = ScalableRpcServer(broker['host'], broker['user'], broker['pass'], broker['rpcqueue'])
-    RPC_SERVER.start_server()
+    # The RPC server and the API workers write graphs from separate processes.
+    cache['multiProcess'] = True
+    if mode == 'cooperative':
+        try:
+            import gevent  # noqa: F401
+        except ImportError:
+            raise click.UsageError('Cooperative mode requires gevent to be installed.')
+
+    def run_rpc():
+        """Run one RPC server, draining it on SIGTERM."""
+        if mode == 'cooperative':
+            from graph_manager.applib import cooperative
+            cooperative.patch()
+            RPC_SERVER = cooperative.CooperativeRpcServer(broker['host'], broker['user'], broker['pass'], broker['rpcqueue'],
+                                                          in_flight=inflight)
+        else:
+            RPC_SERVER = ScalableRpcServer(broker['host'], broker['user'], broker['pass'], broker['rpcqueue'],
+                                           workers=workers, prefetch=prefetch)
+        # The handler only asks for the drain, the server loop does it.
+        if mode == 'cooperative':
+            from gevent import signal_handler
+            signal_handler(signal.SIGTERM, RPC_SERVER.request_drain, supervision['drain'])
+        else:
+            signal.signal(signal.SIGTERM, lambda signum, frame: RPC_SERVER.request_drain(supervision['drain']))
+        try:
+            RPC_SERVER.start_server()
+        finally:
+            close_publishers()
+
+    if processes > 1:
+        ProcessSupervisor(run_rpc, processes).start()
+    else:
+        run_rpc()
 
 
 class GMApplication(gunicorn.app.base.BaseApplication):
     """Create Standalone Application GM-API."""
 
     def __init__(self, app, options=None):
-        """The init."""
+        """The init.
+
+        Without an app each worker creates its own when it is loaded.
+        """
         self.options = options or {}
         self.application = app
         super(GMApplication, self).__init__()
@@ -54,6 +124,8 @@ class GMApplication(gunicorn.app.base.BaseApplication):
 
     def load(self):
         """Load configuration."""
+        if self.application is None:
+            self.application = init_api()
         return self.application
 
 
@@ -63,6 +135,16 @@ def number_of_workers():
     return (multiprocessing.cpu_count() * 2) + 1
 
 
+def worker_count(workers):
+    """Number of workers from the server option, auto uses number_of_workers."""
+    if workers == 'auto':
+        return number_of_workers()
+    try:
+        return int(workers)
+    except ValueError:
+        raise click.BadParameter('Must be a number or auto.', param_hint='--workers')
+
+
 def main():
     """Main function."""
     cli()
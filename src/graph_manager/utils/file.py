@@ -1,8 +1,14 @@
 import uuid
 import os
+import zlib
 from graph_manager.utils.logs import app_logger
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-data = {'directory': os.environ['DATADIR'] if 'DATADIR' in os.environ else "/attx-sb-shared"}
+data = {'directory': os.environ['DATADIR'] if 'DATADIR' in os.environ else "/attx-sb-shared",
+        'compression': os.environ['RESULTSCOMPRESSION'] if 'RESULTSCOMPRESSION' in os.environ else "none"}
 
 
 def file_extension(mime_type):
@@ -10,27 +16,113 @@ def file_extension(mime_type):
     return {
         'text/turtle': "ttl",
         'application/n-triples': "nt",
+        'application/n-quads': "nq",
         'text/n3': "n3",
         'application/trig': "trig",
         'application/rdf+xml': "xml",
+        'application/ld+json': "jsonld",
         'application/sparql-results+xml': 'xml',
         'application/sparql-results+json': 'json',
+        'text/csv': "csv",
+        'text/tab-separated-values': "tsv",
     }[str(mime_type)]
 
 
-def results_path(content, extension):
-    """Write results to specific file."""
+def compressor(compression):
+    """Compression object and file suffix for the results compression."""
+    if compression == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 31), ".gz"
+    elif compression == "zstd":
+        if zstandard is None:
+            raise ValueError('zstd compression requires the zstandard package.')
+        return zstandard.ZstdCompressor().compressobj(), ".zst"
+    return None, ""
+
+
+# Results compression of each file suffix.
+suffixes = {'.gz': "gzip", '.zst': "zstd"}
+
+
+def decompressor(compression):
+    """Decompression object for the results compression."""
+    if compression == "gzip":
+        return zlib.decompressobj(31)
+    elif compression == "zstd":
+        if zstandard is None:
+            raise ValueError('zstd compression requires the zstandard package.')
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+
+class DecompressedFile(object):
+    """Read a compressed results file as it is decompressed.
+
+    It can be read or iterated over in chunks and has no fileno, so it is
+    sent in chunks rather than with the size of the compressed file.
+    """
+
+    def __init__(self, raw, compression, chunk_size=65536):
+        """Wrap an open compressed file."""
+        self.raw = raw
+        self.chunk_size = chunk_size
+        self._decompress = decompressor(compression)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        """Read up to size decompressed bytes, all of them by default."""
+        while size < 0 or len(self._buffer) < size:
+            chunk = self.raw.read(self.chunk_size)
+            if not chunk:
+                if hasattr(self._decompress, 'flush'):
+                    self._buffer += self._decompress.flush()
+                break
+            self._buffer += self._decompress.decompress(chunk)
+        if size < 0:
+            size = len(self._buffer)
+        content, self._buffer = self._buffer[:size], self._buffer[size:]
+        return content
+
+    def __iter__(self):
+        """Yield the decompressed content in chunks."""
+        for chunk in iter(lambda: self.read(self.chunk_size), b''):
+            yield chunk
+
+    def close(self):
+        """Close the compressed file."""
+        self.raw.close()
+
+
+def open_results(raw, path):
+    """Decompress an open results file if its suffix says it is compressed."""
+    compression = suffixes.get(os.path.splitext(path)[1])
+    return DecompressedFile(raw, compression) if compression else raw
+
+
+def results_path(content, extension, compression=None):
+    """Write results to specific file.
+
+    The content is a string or an iterable of chunks, written as it comes
+    into a temporary file renamed to its final name once complete.
+    """
+    path = "{0}/graphmanager/{1}".format(data["directory"], uuid.uuid4().hex)
+    compress, suffix = compressor(compression or data["compression"])
+    full_path = "{0}/{1}.{2}{3}".format(path, uuid.uuid1().hex, extension, suffix)
+    temp_path = "{0}.part".format(full_path)
     try:
-        path = "{0}/graphmanager/{1}".format(data["directory"], uuid.uuid4().hex)
         if not os.path.exists(path):
             os.makedirs(path)
-        full_path = "{0}/{1}.{2}".format(path, uuid.uuid1().hex, extension)
-        f = open(full_path, "w+")
-        f.write(content)
+        with open(temp_path, "wb") as f:
+            for chunk in ([content] if isinstance(content, basestring) else content):
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode('utf-8')
+                f.write(compress.compress(chunk) if compress else chunk)
+            if compress:
+                f.write(compress.flush())
+        os.rename(temp_path, full_path)
         app_logger.info('Content available in path: {0}'.format(full_path))
         return "file://{0}".format(full_path)
     except Exception as error:
         app_logger.error('Something is wrong: {0}'.format(error))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
         raise
-    finally:
-        f.close()
@@ -0,0 +1,298 @@
+import os
+import re
+import json
+import time
+import uuid
+import errno
+import fcntl
+import threading
+from os import environ
+from functools import wraps
+from collections import OrderedDict
+from graph_manager.utils.logs import app_logger
+
+metrics = {'directory': environ['METRICSDIR'] if 'METRICSDIR' in environ else None,
+           'interval': float(environ['METRICSINTERVAL']) if 'METRICSINTERVAL' in environ else 5.0}
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# Every metric the service records, so any process can describe all of them.
+families = OrderedDict([
+    ('graphmanager_http_requests_total', ('counter', 'HTTP requests by resource, method and status.')),
+    ('graphmanager_http_request_seconds', ('histogram', 'HTTP request latency by resource and method.')),
+    ('graphmanager_graph_store_seconds', ('histogram', 'Graph Store request latency by operation.')),
+    ('graphmanager_graph_store_errors_total', ('counter', 'Failed Graph Store requests by operation.')),
+    ('graphmanager_rpc_tasks_total', ('counter', 'RPC tasks by task and status.')),
+    ('graphmanager_rpc_task_seconds', ('histogram', 'RPC task latency by task.')),
+    ('graphmanager_rpc_consumers', ('gauge', 'RPC consumers running.')),
+    ('graphmanager_rpc_in_flight', ('gauge', 'RPC messages being handled.'))])
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_values = {'pid': None, 'values': dict()}
+
+
+def _process_values():
+    """Values recorded by this process, reset after a fork.
+
+    The first use in a process starts the thread writing them to the
+    metrics directory. Call with the lock held.
+    """
+    pid = os.getpid()
+    if _values['pid'] != pid:
+        _values['pid'] = pid
+        _values['values'] = dict((name, dict()) for name in families)
+        if metrics['directory']:
+            thread = threading.Thread(target=_flush_loop)
+            thread.daemon = True
+            thread.start()
+    return _values['values']
+
+
+def _key(labels):
+    """Hashable, ordered form of a label set."""
+    return tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    """Increase a counter."""
+    with _lock:
+        values = _process_values()[name]
+        key = _key(labels)
+        values[key] = values.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    """Set a gauge."""
+    with _lock:
+        _process_values()[name][_key(labels)] = value
+
+
+def observe(name, value, **labels):
+    """Add an observation to a histogram."""
+    with _lock:
+        values = _process_values()[name]
+        key = _key(labels)
+        if key not in values:
+            values[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        counts = values[key]
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                counts[index] += 1
+                break
+        else:
+            counts[len(BUCKETS)] += 1
+        counts[-1] += value
+
+
+def timed(histogram, errors=None, **labels):
+    """Observe how long the function takes, and count its failures in errors.
+
+    A result with an on_close list, a streamed response, is observed
+    once it has been read and closed.
+    """
+    def decorator(func):
+        """Decorator function."""
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            """Wrap it nicely."""
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                if errors:
+                    inc(errors, **labels)
+                observe(histogram, time.time() - start, **labels)
+                raise
+            if isinstance(getattr(result, 'on_close', None), list):
+                result.on_close.append(lambda: observe(histogram, time.time() - start, **labels))
+            else:
+                observe(histogram, time.time() - start, **labels)
+            return result
+        return wrapper
+    return decorator
+
+
+def _snapshot():
+    """This process' values in the form written to the metrics directory."""
+    with _lock:
+        values = _process_values()
+        return dict((name, [[list(key), value if not isinstance(value, list) else list(value)] for key, value in values[name].items()])
+                    for name in values)
+
+
+def _pid_path(pid):
+    """File holding the values of a process."""
+    return os.path.join(metrics['directory'], "pid-{0}.json".format(pid))
+
+
+def flush():
+    """Write this process' values to the metrics directory.
+
+    Flushes are serialized, so an older snapshot never replaces a newer one.
+    """
+    directory = metrics['directory']
+    path = _pid_path(os.getpid())
+    with _flush_lock:
+        content = json.dumps(_snapshot())
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        temp = "{0}.{1}.tmp".format(path, uuid.uuid4().hex)
+        with open(temp, "wb") as f:
+            f.write(content)
+        os.rename(temp, path)
+
+
+def _flush_loop():
+    """Write this process' values every interval and compact those of exited processes.
+
+    A file left by an earlier process with the same pid is kept under
+    another name first, so its counters are not lost.
+    """
+    pid = os.getpid()
+    try:
+        os.rename(_pid_path(pid), os.path.join(metrics['directory'], "dead-{0}.json".format(uuid.uuid4().hex)))
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            app_logger.error('Could not keep earlier metrics: {0}'.format(error))
+    while _values['pid'] == pid:
+        time.sleep(metrics['interval'])
+        try:
+            flush()
+            compact()
+        except (IOError, OSError) as error:
+            app_logger.error('Could not write metrics: {0}'.format(error))
+
+
+def _alive(pid):
+    """Whether a process is still running."""
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
+
+
+def _flock(operation):
+    """Lock the metrics directory, readers share it and compaction holds it alone."""
+    handle = open(os.path.join(metrics['directory'], "lock"), "a")
+    fcntl.flock(handle.fileno(), operation)
+    return handle
+
+
+def _read_files(skip_pid=None):
+    """Snapshots in the metrics directory as (name, pid or None, snapshot) tuples."""
+    directory = metrics['directory']
+    names = os.listdir(directory) if directory and os.path.isdir(directory) else []
+    files = []
+    for name in names:
+        match = re.match(r'^(pid-(\d+)|dead(-\w+)?)\.json$', name)
+        if match is None or (match.group(2) and int(match.group(2)) == skip_pid):
+            continue
+        try:
+            with open(os.path.join(directory, name), "rb") as f:
+                files.append((name, int(match.group(2)) if match.group(2) else None, json.load(f)))
+        except (IOError, ValueError):
+            continue
+    return files
+
+
+def _without_gauges(snapshot):
+    """A snapshot without the gauges, which only count while their process runs."""
+    return dict((metric, values) for metric, values in snapshot.items() if families.get(metric, ('gauge',))[0] != 'gauge')
+
+
+def _merge(snapshots):
+    """Add up the values of snapshots, by metric and label set."""
+    merged = dict((name, dict()) for name in families)
+    for snapshot in snapshots:
+        for name, values in snapshot.items():
+            if name not in merged:
+                continue
+            for labels, value in values:
+                key = tuple(tuple(label) for label in labels)
+                if isinstance(value, list):
+                    current = merged[name].get(key, [0] * len(value))
+                    merged[name][key] = [a + b for a, b in zip(current, value)]
+                else:
+                    merged[name][key] = merged[name].get(key, 0) + value
+    return merged
+
+
+def compact():
+    """Add the values of exited processes up into dead.json and remove their files.
+
+    Keeps the number of files each scrape reads bounded when workers are
+    restarted, for example with gunicorn max_requests.
+    """
+    directory = metrics['directory']
+    if not directory or not os.path.isdir(directory):
+        return
+    handle = _flock(fcntl.LOCK_EX)
+    try:
+        files = [(name, snapshot) for name, pid, snapshot in _read_files() if pid is None or not _alive(pid)]
+        if not [name for name, _ in files if name != "dead.json"]:
+            return
+        merged = _merge(_without_gauges(snapshot) for _, snapshot in files)
+        content = json.dumps(dict((name, [[list(key), value] for key, value in values.items()]) for name, values in merged.items()))
+        path = os.path.join(directory, "dead.json")
+        temp = "{0}.{1}.tmp".format(path, uuid.uuid4().hex)
+        with open(temp, "wb") as f:
+            f.write(content)
+        os.rename(temp, path)
+        for name, _ in files:
+            if name != "dead.json":
+                os.remove(os.path.join(directory, name))
+    finally:
+        handle.close()
+
+
+def _collect():
+    """Values of all processes from their files in the metrics directory.
+
+    This process writes its own file first, so every scrape reads flushed
+    values only and counters never go down between scrapes served by
+    different workers. Without a directory only this process is reported.
+    Gauges only count for processes still running.
+    """
+    if not metrics['directory']:
+        return _merge([_snapshot()])
+    flush()
+    handle = _flock(fcntl.LOCK_SH)
+    try:
+        snapshots = [snapshot if pid is not None and _alive(pid) else _without_gauges(snapshot)
+                     for name, pid, snapshot in _read_files()]
+    finally:
+        handle.close()
+    return _merge(snapshots)
+
+
+def _labels(key, extra=()):
+    """Prometheus label text."""
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+
+def exposition():
+    """All metrics in the Prometheus text format."""
+    lines = []
+    merged = _collect()
+    for name, (kind, description) in families.items():
+        lines.append('# HELP {0} {1}'.format(name, description))
+        lines.append('# TYPE {0} {1}'.format(name, kind))
+        for key in sorted(merged[name]):
+            value = merged[name][key]
+            if kind != 'histogram':
+                lines.append('{0}{1} {2}'.format(name, _labels(key), value))
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS, value):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(name, _labels(key, [('le', bound)]), cumulative))
+            cumulative += value[len(BUCKETS)]
+            lines.append('{0}_bucket{1} {2}'.format(name, _labels(key, [('le', '+Inf')]), cumulative))
+            lines.append('{0}_sum{1} {2}'.format(name, _labels(key), value[-1]))
+            lines.append('{0}_count{1} {2}'.format(name, _labels(key), cumulative))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,60 @@
+import re
+import falcon
+import mimeparse
+
+# Formats offered for graphs and CONSTRUCT or DESCRIBE results, the first is the default.
+rdf_types = ('text/turtle', 'application/n-triples', 'application/n-quads', 'application/ld+json',
+             'application/rdf+xml', 'application/trig')
+
+# Formats offered for SELECT and ASK results, the first is the default.
+result_types = ('application/sparql-results+json', 'application/sparql-results+xml', 'text/csv',
+                'text/tab-separated-values')
+
+
+def negotiate(req, offered):
+    """Pick the offered content type the Accept header prefers.
+
+    The first offered type is used without an Accept header and wins ties.
+    """
+    accept = req.get_header('Accept')
+    if not accept:
+        return offered[0]
+    # best_match prefers the last of equally good types.
+    chosen = mimeparse.best_match(list(reversed(offered)), accept)
+    if not chosen:
+        raise falcon.HTTPNotAcceptable('Available content types: {0}.'.format(', '.join(offered)))
+    return chosen
+
+
+def query_form(query):
+    """The query form of a SPARQL query, SELECT, ASK, CONSTRUCT or DESCRIBE."""
+    text = re.sub(r'<[^>]*>|#[^\n]*', ' ', query)
+    match = re.search(r'\b(SELECT|ASK|CONSTRUCT|DESCRIBE)\b', text, re.IGNORECASE)
+    return match.group(1).upper() if match else 'SELECT'
+
+
+def query_content_type(req, parsed):
+    """Content type of the query results, the contentType in the body or negotiated for the query form."""
+    if parsed.get('contentType'):
+        return parsed['contentType']
+    if query_form(parsed['query']) in ('CONSTRUCT', 'DESCRIBE'):
+        return negotiate(req, [content_type for content_type in rdf_types if content_type != 'application/n-quads'])
+    return negotiate(req, result_types)
+
+
+def ntriples_to_nquads(chunks, named_graph):
+    """Stream N-Triples chunks as N-Quads in a named graph."""
+    graph = u' <{0}> .\n'.format(named_graph).encode('utf-8')
+    remainder = b''
+    try:
+        for chunk in chunks:
+            lines = (remainder + chunk).split(b'\n')
+            remainder = lines.pop()
+            quads = [line.rstrip()[:-1].rstrip() + graph for line in lines if line.strip() and not line.lstrip().startswith(b'#')]
+            if quads:
+                yield b''.join(quads)
+        if remainder.strip() and not remainder.lstrip().startswith(b'#'):
+            yield remainder.rstrip()[:-1].rstrip() + graph
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
@@ -0,0 +1,60 @@
+import os
+import threading
+import requests
+from os import environ
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from graph_manager.utils.logs import app_logger
+
+pool = {'size': int(environ['GPOOLSIZE']) if 'GPOOLSIZE' in environ else 20,
+        'connectTimeout': float(environ['GCONNECTTIMEOUT']) if 'GCONNECTTIMEOUT' in environ else 5.0,
+        'readTimeout': float(environ['GREADTIMEOUT']) if 'GREADTIMEOUT' in environ else 300.0,
+        'retries': int(environ['GRETRIES']) if 'GRETRIES' in environ else 3,
+        'backoff': float(environ['GBACKOFF']) if 'GBACKOFF' in environ else 0.3,
+        'chunkSize': int(environ['GCHUNKSIZE']) if 'GCHUNKSIZE' in environ else 65536}
+
+_lock = threading.Lock()
+_sessions = {'pid': None, 'sessions': dict()}
+
+
+def request_timeout():
+    """Default (connect, read) timeout for calls to the Graph Store."""
+    return (pool['connectTimeout'], pool['readTimeout'])
+
+
+def create_session(retries=None):
+    """Create a keep-alive session with a bounded connection pool and retries.
+
+    Only reads are retried on read errors or gateway statuses, writes may
+    stream a file that cannot be sent again. Connection errors are retried
+    for all methods. Without retries every request is a single attempt.
+    """
+    retries = pool['retries'] if retries is None else retries
+    retries = Retry(total=retries, connect=retries, read=retries,
+                    method_whitelist=frozenset(['HEAD', 'GET', 'OPTIONS']),
+                    status_forcelist=(502, 503, 504), backoff_factor=pool['backoff'],
+                    raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool['size'],
+                          max_retries=retries)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def shared_session(name='graphStore', retries=None):
+    """Return the process wide session registered under name, shared by all threads.
+
+    The sessions are recreated after a fork, so gunicorn workers and
+    the RPC server processes never share sockets with their parent.
+    """
+    pid = os.getpid()
+    if _sessions['pid'] != pid or name not in _sessions['sessions']:
+        with _lock:
+            if _sessions['pid'] != pid:
+                _sessions['sessions'] = dict()
+                _sessions['pid'] = pid
+            if name not in _sessions['sessions']:
+                _sessions['sessions'][name] = create_session(retries)
+                app_logger.info('Created HTTP connection pool {0} of size {1}.'.format(name, pool['size']))
+    return _sessions['sessions'][name]
@@ -4,6 +4,13 @@ import jsonschema
 from functools import wraps
 
 
+def compiled_validator(schema):
+    """Check a schema and build its validator once, to be reused for every document."""
+    validator = jsonschema.validators.validator_for(schema)
+    validator.check_schema(schema)
+    return validator(schema)
+
+
 def validate(schema):
     """
     Validate against JSON schema an return something.
@@ -11,6 +18,8 @@ def validate(schema):
     Return a parsed object if there is a POST.
     If there is a get do not return anything just validate.
     """
+    validator = compiled_validator(schema)
+
     def decorator(func):
         """Decorator function."""
         @wraps(func)
@@ -26,7 +35,7 @@ def validate(schema):
                         'Could not properly parse the provided data as JSON'
                     )
                 try:
-                    jsonschema.validate(obj, schema)
+                    validator.validate(obj)
                 except jsonschema.ValidationError as e:
                     raise falcon.HTTPBadRequest(
                         'Failed data validation',
@@ -41,28 +50,34 @@ def validate(schema):
 
 
 def valid_message(schema):
-    """Validate messages against JSON schema an return something."""
+    """Validate messages against JSON schema an return something.
+
+    The body is parsed once, the function gets it as parsed. A body
+    already parsed by the caller can be passed the same way.
+    """
+    validator = compiled_validator(schema)
+
     def decorator(func):
         """Decorator function."""
         @wraps(func)
         def wrapper(self, message, *args, **kwargs):
             """Wrap it nicely."""
+            obj = kwargs.pop('parsed', None)
+            if obj is None:
+                try:
+                    obj = json.loads(message.body)
+                except Exception:
+                    raise ValueError(
+                        'Invalid data',
+                        'Could not properly parse the provided data as JSON'
+                    )
             try:
-                # raw_json = message.stream.read()
-                # obj = json.loads(raw_json.decode('utf-8'))
-                obj = json.loads(message.body)
-            except Exception:
-                raise ValueError(
-                    'Invalid data',
-                    'Could not properly parse the provided data as JSON'
-                )
-            try:
-                jsonschema.validate(obj, schema)
+                validator.validate(obj)
             except jsonschema.ValidationError as e:
                 raise falcon.HTTPBadRequest(
                     'Failed data validation',
                     e.message
                 )
-            return func(self, message, *args, **kwargs)
+            return func(self, message, *args, parsed=obj, **kwargs)
         return wrapper
     return decorator
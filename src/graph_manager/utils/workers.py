@@ -0,0 +1,22 @@
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+_lock = threading.Lock()
+_pools = {'pid': None, 'pools': dict()}
+
+
+def thread_pool(name, size):
+    """Return the process wide thread pool registered under name.
+
+    Pools are created on first use and recreated after a fork,
+    threads do not survive it.
+    """
+    pid = os.getpid()
+    with _lock:
+        if _pools['pid'] != pid:
+            _pools['pid'] = pid
+            _pools['pools'] = dict()
+        if name not in _pools['pools']:
+            _pools['pools'][name] = ThreadPool(size)
+        return _pools['pools'][name]
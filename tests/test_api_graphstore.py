@@ -1,3 +1,4 @@
+import zlib
 import unittest
 from urllib import quote
 import responses
@@ -120,6 +121,23 @@ class GraphTestCase(GraphStoreTest):
         assert(result.status == falcon.HTTP_200)
         assert(result.json == response_data)
 
+    @responses.activate
+    def test_api_graph_bulk(self):
+        """Test api bulk update of several graphs."""
+        with open('tests/resources/graph_add_response.json') as datafile:
+            response_data = json.load(datafile)
+        for url in ["http://test.com/1", "http://test.com/2"]:
+            responses.add(responses.POST, "{0}/data?graph={1}".format(self.request_address, url), json=response_data, status=200)
+        lines = [json.dumps({"targetGraph": "http://test.com/1", "triples": "<a:b> <a:c> <a:d> .", "contentType": "text/turtle"}),
+                 json.dumps({"targetGraph": "http://test.com/2", "triples": "<a:b> <a:c> <a:d> .", "contentType": "text/turtle"}),
+                 "",
+                 json.dumps({"targetGraph": "http://test.com/3"})]
+        result = self.simulate_post("/{0}/graph/bulk".format(self.version), body="\n".join(lines))
+        assert(result.status == falcon.HTTP_200)
+        assert(result.json['graphsCount'] == 3)
+        assert(result.json['failedCount'] == 1)
+        assert([r['status'] for r in result.json['results']] == ["success", "success", "error"])
+
     @responses.activate
     def test_api_graph_drop(self):
         """Test api drop graph."""
@@ -149,15 +167,52 @@ class GraphTestCase(GraphStoreTest):
             graph_data = datafile.read()
         with open('tests/resources/graph_query_request.json') as datafile:
             graph_query = datafile.read().replace('\n', '')
-        list_query = "select ?g (count(*) as ?count) {graph ?g {?s ?p ?o}} group by ?g"
-        url = "default"
-        request_url = "{0}/query?default-graph-uri=%s&query={1}&output=xml&results=xml&format=xml".format(self.request_address, url, list_query)
-        httpretty.register_uri(httpretty.GET, request_url, graph_data, status=200, content_type="application/sparql-results+xml")
+        httpretty.register_uri(httpretty.POST, "{0}/query".format(self.request_address), graph_data, status=200, content_type="application/sparql-results+xml")
         result = self.simulate_post('/{0}/graph/query'.format(self.version), body=graph_query)
         assert(result.text == graph_data)
         httpretty.disable()
         httpretty.reset()
 
+    @responses.activate
+    def test_api_graph_retrieve_nquads(self):
+        """Test api graph retrieve as N-Quads made from N-Triples."""
+        url = "http://test.com/graph"
+        triples = '<http://test.com/s> <http://test.com/p> "one" .\n<http://test.com/s> <http://test.com/p> "two" .\n'
+        responses.add(responses.GET, "{0}/data?graph={1}".format(self.request_address, url), body=triples, status=200)
+        result = self.simulate_get("/{0}/graph".format(self.version), params={"uri": url}, headers={'Accept': 'application/n-quads'})
+        assert(result.status == falcon.HTTP_200)
+        self.assertEqual(responses.calls[0].request.headers['accept'], 'application/n-triples')
+        self.assertEqual(result.headers['content-type'], 'application/n-quads')
+        self.assertEqual(result.text.splitlines()[1], '<http://test.com/s> <http://test.com/p> "two" <http://test.com/graph> .')
+
+    def test_api_graph_not_acceptable(self):
+        """Test api graph retrieve in a format that is not offered."""
+        result = self.simulate_get("/{0}/graph".format(self.version), params={"uri": "http://test.com"}, headers={'Accept': 'image/png'})
+        assert(result.status == falcon.HTTP_406)
+
+    @responses.activate
+    def test_api_graph_retrieve_gzip(self):
+        """Test api graph retrieve compressed for clients accepting gzip."""
+        with open('tests/resources/graph_strategy.ttl') as datafile:
+            graph_data = datafile.read()
+        url = "http://data.hulib.helsinki.fi/attx/strategy"
+        responses.add(responses.GET, "{0}/data?graph={1}".format(self.request_address, url), body=graph_data, status=200)
+        hdrs = {'Accept': 'text/turtle', 'Accept-Encoding': 'gzip, deflate'}
+        result = self.simulate_get("/{0}/graph".format(self.version), params={"uri": url}, headers=hdrs)
+        self.assertEqual(result.headers['content-encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(result.content, 16 + zlib.MAX_WBITS), graph_data)
+
+    @responses.activate
+    def test_api_graph_sparql_accept(self):
+        """Test api query results format negotiated from the Accept header."""
+        responses.add(responses.POST, "{0}/query".format(self.request_address), body="s\nhttp://test.com/s\n", status=200)
+        query = json.dumps({"targetGraph": ["http://test.com/graph"], "query": "SELECT ?s WHERE {?s ?p ?o}"})
+        hdrs = {'Accept': 'text/csv;q=0.9, application/sparql-results+xml;q=0.5', 'Accept-Encoding': 'deflate'}
+        result = self.simulate_post('/{0}/graph/query'.format(self.version), body=query, headers=hdrs)
+        self.assertEqual(responses.calls[0].request.headers['accept'], 'text/csv')
+        self.assertEqual(result.headers['content-type'], 'text/csv')
+        self.assertEqual(zlib.decompress(result.content), "s\nhttp://test.com/s\n")
+
     @responses.activate
     def test_api_update_no_data(self):
         """Test prov validate no data."""
@@ -2,8 +2,14 @@ import json
 import unittest
 import httpretty
 from rdflib import Graph
+import os
+import shutil
+import tempfile
 from graph_manager.applib.construct_message import replace_message, add_message, retrieve_message, query_message
-from mock import patch
+from graph_manager.applib.construct_message import retrieve_data, batch_message, load_sources
+from graph_manager.applib.envelope import Envelope
+from mock import patch, MagicMock
+from graph_manager.applib.messaging_publish import BackgroundPublisher
 from graph_manager.applib.graph_store import GraphStore
 from amqpstorm import AMQPConnectionError
 
@@ -25,9 +31,23 @@ class ConstructGraphTestCase(unittest.TestCase):
         with open('tests/resources/message_data_retrieve.json') as datafile:
             message = json.load(datafile)
         mock.return_value = graph_data
-        retrieve_message(message)
+        retrieve_message(Envelope(message))
         self.assertTrue(mock.called)
 
+    @patch.object(GraphStore, '_graph_retrieve')
+    def test_retrieve_ntriples_streamed(self, mock):
+        """Test N-Triples of several graphs are concatenated without rdflib."""
+        with open('tests/resources/message_data_retrieve.json') as datafile:
+            message = json.load(datafile)
+        message["payload"]["graphManagerInput"]["outputContentType"] = "application/n-triples"
+        message["payload"]["graphManagerInput"]["sourceGraphs"] = ["http://test.com/1", "http://test.com/2"]
+        mock.side_effect = [iter(["<a:s> <a:p> <a:o1> .\n"]), iter(["<a:s> <a:p> ", "<a:o2> ."])]
+        with patch('graph_manager.applib.construct_message.Graph') as graph_mock:
+            result = json.loads(retrieve_message(Envelope(message)))
+            self.assertFalse(graph_mock.called)
+        self.assertEqual(result["payload"]["graphManagerOutput"], "<a:s> <a:p> <a:o1> .\n<a:s> <a:p> <a:o2> .\n")
+        mock.assert_called_with("http://test.com/2", stream=True, content_type='application/n-triples')
+
     @patch('graph_manager.applib.construct_message.results_path')
     @patch.object(GraphStore, '_graph_sparql')
     @httpretty.activate
@@ -45,23 +65,23 @@ class ConstructGraphTestCase(unittest.TestCase):
         request_url2 = "{0}/query?default-graph-uri=%s&query={1}&output=xml&results=xml&format=xml".format(self.request_address, url2, list_query)
         httpretty.register_uri(httpretty.GET, request_url2, graph_data, status=200, content_type="application/sparql-results+xml")
         mock.return_value = graph_data
-        query_message(message)
+        query_message(Envelope(message))
         self.assertTrue(mock.called)
         httpretty.disable()
         httpretty.reset()
 
-    @patch('graph_manager.applib.construct_message.Publisher.push')
+    @patch('graph_manager.applib.messaging_publish.BackgroundPublisher.emit')
     # @patch.object(GraphStore, 'graph_add')
     @patch.object(GraphStore, '_graph_replace')
     def test_replace_called(self, mock1, publish_mock):
         """Test if replace graph data was called."""
         with open('tests/resources/message_data.json') as datafile:
             message = json.load(datafile)
-        replace_message(message)
+        replace_message(Envelope(message))
         self.assertTrue(mock1.called)
         # self.assertTrue(mock2.called)
 
-    @patch('graph_manager.applib.construct_message.Publisher.push')
+    @patch('graph_manager.applib.messaging_publish.BackgroundPublisher.emit')
     @patch.object(GraphStore, '_graph_add')
     @patch.object(GraphStore, '_graph_replace')
     def test_replace_called_file_fail(self, mock1, mock2, publish_mock):
@@ -69,32 +89,152 @@ class ConstructGraphTestCase(unittest.TestCase):
         with open('tests/resources/message_data_file.json') as datafile:
             message = json.load(datafile)
         with self.assertRaises(IOError):
-            replace_message(message)
+            replace_message(Envelope(message))
 
     @patch.object(GraphStore, '_graph_replace')
-    def test_replace_error(self, mock):
-        """Test if replace raises an error was called."""
+    def test_replace_broker_down(self, mock):
+        """Test replace replies without waiting on an unreachable broker."""
         with open('tests/resources/message_data.json') as datafile:
             message = json.load(datafile)
-        with self.assertRaises(AMQPConnectionError):
-            replace_message(message)
+        publisher = MagicMock()
+        publisher.push_batch.side_effect = AMQPConnectionError('down')
+        background = BackgroundPublisher(publisher, size=10, overflow="drop")
+        with patch('graph_manager.applib.construct_message.background_publisher', return_value=background):
+            result = json.loads(replace_message(Envelope(message)))
+        self.assertEqual(result["payload"]["status"], "success")
+        background.close(timeout=0)
+
+    @patch.object(GraphStore, '_graph_add')
+    def test_store_error(self, mock):
+        """Test if store raises an error was called."""
+        with open('tests/resources/message_data_add.json') as datafile:
+            message = json.load(datafile)
+        mock.side_effect = IOError('store down')
+        background = MagicMock()
+        with patch('graph_manager.applib.construct_message.background_publisher', return_value=background):
+            with self.assertRaises(IOError):
+                add_message(Envelope(message))
+        prov = json.loads(background.emit.call_args[0][0])
+        self.assertEqual(prov["provenance"]["activity"]["status"], "error")
 
-    @patch('graph_manager.applib.construct_message.Publisher.push')
+    @patch('graph_manager.applib.messaging_publish.BackgroundPublisher.emit')
     @patch.object(GraphStore, '_graph_add')
     def test_store_called(self, mock, publish_mock):
         """Test if store graph data was called."""
         with open('tests/resources/message_data_add.json') as datafile:
             message = json.load(datafile)
-        add_message(message)
+        add_message(Envelope(message))
         self.assertTrue(mock.called)
 
+    @patch('graph_manager.applib.construct_message.retrieve_data')
+    @patch('graph_manager.applib.messaging_publish.BackgroundPublisher.emit')
     @patch.object(GraphStore, '_graph_add')
-    def test_store_error(self, mock):
-        """Test if store raises an error was called."""
-        with open('tests/resources/message_data_add.json') as datafile:
+    @patch.object(GraphStore, '_graph_replace')
+    def test_replace_pipelined(self, replace_mock, add_mock, publish_mock, retrieve_mock):
+        """Test sources are uploaded in order and timed in the provenance message."""
+        with open('tests/resources/message_data.json') as datafile:
             message = json.load(datafile)
-        with self.assertRaises(AMQPConnectionError):
-            add_message(message)
+        source = message["payload"]["graphManagerInput"]["sourceData"][0]
+        message["payload"]["graphManagerInput"]["sourceData"] = [dict(source, input=str(i)) for i in range(6)]
+        retrieve_mock.side_effect = lambda input_type, input_data: input_data
+        replace_message(Envelope(message))
+        replace_mock.assert_called_once_with("default", "0", source["contentType"])
+        self.assertEqual([c[0][1] for c in add_mock.call_args_list], ["1", "2", "3", "4", "5"])
+        prov = json.loads(publish_mock.call_args[0][0])
+        timings = prov["provenance"]["activity"]["sourceTimings"]
+        self.assertEqual([t["key"] for t in timings], ["inputGraphs_{0}".format(i) for i in range(6)])
+
+    @patch('graph_manager.applib.construct_message.retrieve_data')
+    @patch.object(GraphStore, '_graph_add')
+    def test_load_sources_upload_fail(self, add_mock, retrieve_mock):
+        """Test downloads queued behind a failed upload are closed."""
+        class Source(object):
+            def __init__(self):
+                self.closed = False
+
+            def close(self):
+                self.closed = True
+        opened = []
+
+        def retrieve(input_type, input_data):
+            opened.append(Source())
+            return opened[-1]
+        retrieve_mock.side_effect = retrieve
+        add_mock.side_effect = IOError('store down')
+        graphs = [{'inputType': 'URI', 'input': str(i), 'contentType': 'text/turtle'} for i in range(3)]
+        self.assertRaises(IOError, load_sources, GraphStore(), "default", graphs, [])
+        self.assertEqual(add_mock.call_count, 1)
+        self.assertEqual(len(opened), 3)
+        self.assertTrue(all(source.closed for source in opened))
+
+    @patch('graph_manager.applib.messaging_publish.BackgroundPublisher.emit')
+    @patch.object(GraphStore, '_graph_construct')
+    @patch.object(GraphStore, '_graph_add')
+    @patch.object(GraphStore, '_graph_replace')
+    def test_batch_compressed(self, replace_mock, add_mock, construct_mock, publish_mock):
+        """Test a compressed output file is decompressed when a later operation loads it."""
+        with open('tests/resources/message_data_batch.json') as datafile:
+            message = json.load(datafile)
+        message["payload"]["graphManagerInput"]["operations"][2]["outputType"] = "URI"
+        triples = "<http://example.org/#s> <http://example.org/#p> <http://example.org/#o> .\n"
+        construct_mock.return_value = iter([triples])
+        received = []
+        replace_mock.side_effect = lambda graph, data, content_type: received.append(b''.join(data))
+        directory = tempfile.mkdtemp()
+        try:
+            with patch.dict('graph_manager.utils.file.data', {'directory': directory, 'compression': "gzip"}):
+                result = json.loads(batch_message(Envelope(message)))
+        finally:
+            shutil.rmtree(directory)
+        self.assertTrue(result["payload"]["graphManagerOutput"][2]["graphManagerOutput"].endswith(".ttl.gz"))
+        self.assertEqual(received, [triples])
+
+    @patch('graph_manager.applib.messaging_publish.BackgroundPublisher.emit')
+    @patch.object(GraphStore, '_graph_construct')
+    @patch.object(GraphStore, '_graph_add')
+    @patch.object(GraphStore, '_graph_replace')
+    def test_batch(self, replace_mock, add_mock, construct_mock, publish_mock):
+        """Test batch groups writes, passes outputs on and aggregates the results."""
+        with open('tests/resources/message_data_batch.json') as datafile:
+            message = json.load(datafile)
+        construct_mock.return_value = "constructed"
+        result = json.loads(batch_message(Envelope(message)))
+        outputs = result["payload"]["graphManagerOutput"]
+        self.assertEqual([o["task"] for o in outputs], ["add", "add", "construct", "replace"])
+        self.assertEqual(outputs[2]["graphManagerOutput"], "constructed")
+        add_mock.assert_called_once()
+        self.assertEqual(add_mock.call_args[0][1].count("\n"), 1)
+        replace_mock.assert_called_once_with("http://work/dataset2", "constructed", "text/turtle")
+        self.assertEqual(publish_mock.call_count, 1)
+        prov = json.loads(publish_mock.call_args[0][0])
+        self.assertEqual(prov["payload"]["outputGraph_1"], "http://work/dataset2")
+
+    @patch('graph_manager.applib.messaging_publish.BackgroundPublisher.emit')
+    @patch.object(GraphStore, '_graph_add')
+    def test_batch_bad_reference(self, add_mock, publish_mock):
+        """Test a reference to an operation without output fails the batch."""
+        with open('tests/resources/message_data_batch.json') as datafile:
+            message = json.load(datafile)
+        operations = message["payload"]["graphManagerInput"]["operations"]
+        operations[3]["sourceData"][0]["input"] = "0"
+        del operations[2]
+        with self.assertRaises(ValueError):
+            batch_message(Envelope(message))
+        prov = json.loads(publish_mock.call_args[0][0])
+        self.assertEqual(prov["provenance"]["activity"]["status"], "error")
+
+    def test_retrieve_file_streamed(self):
+        """Test local files are returned open instead of read into memory."""
+        handle, path = tempfile.mkstemp(suffix='.nt')
+        os.write(handle, "<a:s> <a:p> <a:o> .\n")
+        os.close(handle)
+        try:
+            data = retrieve_data("URI", "file://{0}".format(path))
+            self.assertTrue(hasattr(data, 'read'))
+            self.assertEqual(data.read(), "<a:s> <a:p> <a:o> .\n")
+            data.close()
+        finally:
+            os.remove(path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,98 @@
+import json
+import shutil
+import tempfile
+import unittest
+from mock import patch
+from rdflib import ConjunctiveGraph
+from graph_manager.applib import embedded_store
+from graph_manager.applib.graph_store import GraphStore
+from graph_manager.applib.embedded_store import EmbeddedDataset, EmbeddedGraphStore
+from graph_manager.utils.negotiation import rdf_types
+
+TRIPLES = '<http://test.com/s> <http://test.com/p> "one" .\n_:b <http://test.com/p> "two" .\n'
+
+
+class EmbeddedStoreTestCase(unittest.TestCase):
+    """Test for the embedded Graph Store backend."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        self.directory = tempfile.mkdtemp()
+        self.patcher = patch.dict(embedded_store.embedded, {'directory': self.directory})
+        self.patcher.start()
+        with patch.dict('graph_manager.applib.graph_store.store', {'backend': 'embedded'}):
+            self.store = GraphStore()
+
+    def tearDown(self):
+        """Tear down test fixtures."""
+        self.patcher.stop()
+        embedded_store._datasets['datasets'] = dict()
+        shutil.rmtree(self.directory)
+
+    def test_backend_switch(self):
+        """Test the backend setting picks the store class."""
+        self.assertIsInstance(self.store, EmbeddedGraphStore)
+        self.assertNotIsInstance(GraphStore(), EmbeddedGraphStore)
+        with patch.dict('graph_manager.applib.graph_store.store', {'backend': 'other'}):
+            self.assertRaises(ValueError, GraphStore)
+
+    def test_add_retrieve_drop(self):
+        """Test writes to a named graph."""
+        result = self.store._graph_add("http://test.com/1", TRIPLES, "application/n-triples")
+        self.assertEqual(result['tripleCount'], 2)
+        self.store._graph_add("http://test.com/1", '<http://test.com/s> <http://test.com/p> "three" .', "application/n-triples")
+        self.store._graph_replace("http://test.com/2", TRIPLES, "application/n-triples")
+        self.assertEqual(sorted(self.store._graph_counts()), [("http://test.com/1", "3"), ("http://test.com/2", "2")])
+        self.assertIn('"three"', b''.join(self.store._graph_retrieve("http://test.com/1", stream=True, content_type='application/n-triples')))
+        self.store._drop_graph("http://test.com/1")
+        self.assertIsNone(self.store._graph_retrieve("http://test.com/1"))
+        self.assertEqual(self.store._graph_statistics()['totalTriples'], 2)
+
+    def test_query(self):
+        """Test queries only see their source graphs."""
+        self.store._graph_add("http://test.com/1", TRIPLES, "application/n-triples")
+        self.store._graph_add("http://test.com/2", '<http://test.com/x> <http://test.com/p> "other" .', "application/n-triples")
+        result = json.loads(self.store._graph_sparql(["http://test.com/1"], "SELECT ?o WHERE {?s ?p ?o}", "application/sparql-results+json"))
+        self.assertEqual(sorted(b['o']['value'] for b in result['results']['bindings']), ["one", "two"])
+        tsv = self.store._graph_sparql(["http://test.com/2"], "SELECT ?o WHERE {?s ?p ?o}", "text/tab-separated-values")
+        self.assertEqual(tsv, '?o\n"other"\n')
+        data = self.store._graph_construct(["http://test.com/2"], "CONSTRUCT {?s ?p ?o} WHERE {?s ?p ?o}", "application/n-triples")
+        self.assertEqual(data.strip(), '<http://test.com/x> <http://test.com/p> "other" .')
+
+    def test_rdf_types(self):
+        """Test every negotiated RDF format is served for graphs and construct results."""
+        self.store._graph_add("http://test.com/1", TRIPLES, "application/n-triples")
+        query = "CONSTRUCT {?s ?p ?o} WHERE {?s ?p ?o}"
+        for content_type in rdf_types:
+            graph = ConjunctiveGraph()
+            graph.parse(data=self.store._graph_retrieve("http://test.com/1", content_type=content_type), format=embedded_store.rdf_formats[content_type])
+            self.assertEqual(len(graph), 2, content_type)
+            if content_type in ('application/n-quads', 'application/trig'):
+                self.assertEqual([str(c.identifier) for c in graph.contexts() if len(c)], ["http://test.com/1"])
+            graph = ConjunctiveGraph()
+            graph.parse(data=self.store._graph_construct(["http://test.com/1"], query, content_type), format=embedded_store.rdf_formats[content_type])
+            self.assertEqual(len(graph), 2, content_type)
+            graph = ConjunctiveGraph()
+            graph.parse(data=self.store._graph_sparql(["http://test.com/1"], query, content_type), format=embedded_store.rdf_formats[content_type])
+            self.assertEqual(len(graph), 2, content_type)
+
+    def test_persistence(self):
+        """Test another process sees the graphs written to the directory."""
+        self.store._graph_add("http://test.com/1", TRIPLES, "application/n-triples")
+        other = EmbeddedDataset(self.directory)
+        with other.lock:
+            other.sync()
+        self.assertEqual(len(other.graph), 2)
+        self.store._graph_replace("http://test.com/1", '<http://test.com/s> <http://test.com/p> "new" .', "text/turtle")
+        self.store._graph_add("http://test.com/2", TRIPLES, "application/n-triples")
+        with other.lock:
+            other.sync()
+        self.assertEqual(len(other.graph), 3)
+        self.store._drop_graph("http://test.com/2")
+        with other.lock:
+            other.sync()
+        self.assertEqual(len(other.graph), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
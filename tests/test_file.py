@@ -0,0 +1,77 @@
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+from mock import patch
+from graph_manager.utils.file import results_path, data, open_results, file_extension
+from graph_manager.utils.negotiation import rdf_types, result_types
+
+
+class ResultsPathTestCase(unittest.TestCase):
+    """Test for writing results to the shared directory."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures."""
+        shutil.rmtree(self.directory)
+
+    def test_results_chunks(self):
+        """Test chunks are written and the file is renamed when complete."""
+        with patch.dict(data, {'directory': self.directory}):
+            uri = results_path(iter(["<a:s> ", "<a:p> ", "<a:o> ."]), "nt")
+        path = uri[len("file://"):]
+        self.assertTrue(path.endswith(".nt"))
+        with open(path) as f:
+            self.assertEqual(f.read(), "<a:s> <a:p> <a:o> .")
+        self.assertEqual(os.listdir(os.path.dirname(path)), [os.path.basename(path)])
+
+    def test_results_gzip(self):
+        """Test results compressed with gzip."""
+        with patch.dict(data, {'directory': self.directory}):
+            uri = results_path("<a:s> <a:p> <a:o> .", "nt", compression="gzip")
+        path = uri[len("file://"):]
+        self.assertTrue(path.endswith(".nt.gz"))
+        with gzip.open(path) as f:
+            self.assertEqual(f.read(), "<a:s> <a:p> <a:o> .")
+
+    def test_file_extension(self):
+        """Test every negotiated content type can be written to a results file."""
+        for content_type in rdf_types + result_types:
+            self.assertTrue(file_extension(content_type), content_type)
+        self.assertEqual(file_extension('text/csv'), "csv")
+        self.assertEqual(file_extension('text/tab-separated-values'), "tsv")
+        self.assertEqual(file_extension('application/ld+json'), "jsonld")
+
+    def test_open_results_gzip(self):
+        """Test compressed results are read decompressed."""
+        content = "<a:s> <a:p> <a:o> .\n" * 10000
+        with patch.dict(data, {'directory': self.directory}):
+            uri = results_path(content, "nt", compression="gzip")
+        path = uri[len("file://"):]
+        reader = open_results(open(path, "rb"), path)
+        self.assertFalse(hasattr(reader, 'fileno'))
+        self.assertEqual(reader.read(5), "<a:s>")
+        self.assertEqual(reader.read(), content[5:])
+        reader.close()
+        reader = open_results(open(path, "rb"), path)
+        self.assertEqual(b''.join(reader), content)
+        reader.close()
+
+    def test_results_failed(self):
+        """Test no partial file is left when the content fails."""
+        def failing():
+            yield "<a:s> "
+            raise IOError("connection lost")
+        with patch.dict(data, {'directory': self.directory}):
+            with self.assertRaises(IOError):
+                results_path(failing(), "nt")
+        for root, dirs, files in os.walk(self.directory):
+            self.assertEqual(files, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
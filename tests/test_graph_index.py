@@ -0,0 +1,67 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import responses
+from urllib import quote
+from mock import patch
+from graph_manager.applib.graph_index import GraphIndex
+from graph_manager.applib.graph_store import GraphStore
+
+
+class GraphIndexTestCase(unittest.TestCase):
+    """Test for the named graph statistics index."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        self.directory = tempfile.mkdtemp()
+        self.index = GraphIndex(os.path.join(self.directory, 'index.db'))
+        self.request_address = "http://localhost:3030/ds"
+
+    def tearDown(self):
+        """Tear down test fixtures."""
+        shutil.rmtree(self.directory)
+
+    def test_add_replace_drop(self):
+        """Test index follows writes to named graphs."""
+        self.index.graph_added("http://test.com/1", 10, 100)
+        self.index.graph_added("http://test.com/1", 5, 50)
+        self.index.graph_replaced("http://test.com/2", 7, 70)
+        graphs = dict((g[0], g[1:3]) for g in self.index.graphs())
+        self.assertEqual(graphs, {"http://test.com/1": (15, 150), "http://test.com/2": (7, 70)})
+        self.index.graph_dropped("http://test.com/1")
+        self.assertEqual(self.index.total_triples(), 7)
+
+    def test_reconcile(self):
+        """Test reconcile keeps graphs written after the count started."""
+        self.index.graph_added("http://test.com/1", 10)
+        self.index.graph_added("http://test.com/2", 10)
+        self.assertFalse(self.index.reconciled())
+        self.index.reconcile({"http://test.com/1": 8, "http://test.com/3": 3}, 0)
+        graphs = dict((g[0], g[1]) for g in self.index.graphs())
+        self.assertEqual(graphs, {"http://test.com/1": 10, "http://test.com/2": 10, "http://test.com/3": 3})
+        self.assertTrue(self.index.reconciled())
+
+    def test_claim_reconcile(self):
+        """Test only one claim per interval."""
+        self.assertTrue(self.index.claim_reconcile(60))
+        self.assertFalse(self.index.claim_reconcile(60))
+
+    @responses.activate
+    def test_graph_list_from_index(self):
+        """Test graph list served from the index after the first reconcile."""
+        list_query = quote("select ?g (count(*) as ?count) {graph ?g {?s ?p ?o}} group by ?g")
+        with open('tests/resources/graph_list_request.json') as datafile:
+            graph_data = json.load(datafile)
+        responses.add(responses.GET, "{0}/sparql?query={1}".format(self.request_address, list_query), json=graph_data, status=200)
+        with patch('graph_manager.applib.graph_store.shared_index', return_value=self.index):
+            fuseki = GraphStore()
+        result = fuseki._graph_list()
+        self.assertEqual(result['graphsCount'], 2)
+        fuseki._graph_list()
+        self.assertEqual(len(responses.calls), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,8 +3,9 @@ import unittest
 from graph_manager.app import init_api
 from click.testing import CliRunner
 from graph_manager.applib.messaging import ScalableRpcServer
-from graph_manager.graphservice import GMApplication, number_of_workers, main, rpc
+from graph_manager.graphservice import GMApplication, number_of_workers, main, rpc, server
 from mock import patch
+from graph_manager.cooperative_patch import cooperative_requested
 
 
 class TestAPIStart(unittest.TestCase):
@@ -53,6 +54,41 @@ class TestAPIStart(unittest.TestCase):
         result = runner.invoke(rpc)
         assert not result.exception
 
+    def test_worker_options(self):
+        """Test the worker settings reach the gunicorn configuration."""
+        options = {'workers': 3, 'worker_class': 'gthread', 'threads': 8, 'max_requests': 1000, 'preload_app': True}
+        app = GMApplication(None, options)
+        self.assertEqual(app.cfg.worker_class_str, 'gthread')
+        self.assertEqual(app.cfg.threads, 8)
+        self.assertEqual(app.cfg.max_requests, 1000)
+        self.assertTrue(app.cfg.preload_app)
+        self.assertIsNotNone(app.load())
+
+    @patch.object(GMApplication, 'load_config')
+    @patch.object(GMApplication, 'run')
+    def test_command_server_options(self, mock_run, mock_config):
+        """Test the server builds the gunicorn options from the command line."""
+        with patch('graph_manager.graphservice.GMApplication.__init__', return_value=None) as mock_init:
+            runner = CliRunner()
+            result = runner.invoke(server, ['--workers', 'auto', '--worker-class', 'gthread', '--threads', '8', '--max-requests', '1000'])
+            assert not result.exception
+            app, options = mock_init.call_args[0]
+        self.assertIsNone(app)
+        self.assertEqual(options['workers'], number_of_workers())
+        self.assertEqual(options['worker_class'], 'gthread')
+        self.assertEqual(options['threads'], 8)
+        self.assertEqual(options['max_requests_jitter'], 100)
+        self.assertFalse(options['preload_app'])
+        result = CliRunner().invoke(server, ['--workers', 'many'])
+        self.assertEqual(result.exit_code, 2)
+
+    def test_cooperative_requested(self):
+        """Test the cooperative RPC mode is recognised before the command line is parsed."""
+        self.assertTrue(cooperative_requested(['graphservice', 'rpc', '--mode', 'cooperative']))
+        self.assertTrue(cooperative_requested(['graphservice', 'rpc', '--inflight', '10', '--mode=cooperative']))
+        self.assertFalse(cooperative_requested(['graphservice', 'rpc', '--mode', 'threaded']))
+        self.assertFalse(cooperative_requested(['graphservice', 'server', '--worker-class', 'gevent']))
+
     @patch('graph_manager.graphservice.cli')
     def test_cli(self, mock):
         """Test if cli was called."""
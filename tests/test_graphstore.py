@@ -1,6 +1,8 @@
+import time
+import socket
 import unittest
+import threading
 from urllib import quote
-from urllib2 import URLError
 import responses
 # import requests
 from requests.exceptions import ConnectionError
@@ -46,6 +48,38 @@ class GraphTestCase(GraphStoreTest):
         result = fuseki._graph_health()
         self.assertTrue(result)
 
+    def test_ping_hung_server(self):
+        """Test the health check gives up on a server that never replies after one attempt."""
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(8)
+        connections = []
+
+        def accept():
+            while True:
+                try:
+                    connections.append(server.accept()[0])
+                except socket.error:
+                    return
+        thread = threading.Thread(target=accept)
+        thread.daemon = True
+        thread.start()
+        fuseki = GraphStore()
+        fuseki.server_address = "http://127.0.0.1:{0}/$/".format(server.getsockname()[1])
+        start = time.time()
+        try:
+            self.assertRaises(ConnectionError, fuseki._graph_health, timeout=0.5)
+            self.assertLess(time.time() - start, 1.5)
+            self.assertEqual(len(connections), 1)
+        finally:
+            server.close()
+            for connection in connections:
+                connection.close()
+
+    def test_shared_session(self):
+        """Test Graph Store instances share one pooled session."""
+        self.assertIs(GraphStore().session, GraphStore().session)
+
     @responses.activate
     def test_graph_list(self):
         """Test graph list on graph endpoint."""
@@ -108,6 +142,17 @@ class GraphTestCase(GraphStoreTest):
         result = fuseki._graph_retrieve("http://data.hulib.helsinki.fi/attx/strategy")
         assert(result == graph_data)
 
+    @responses.activate
+    def test_graph_retrieve_stream(self):
+        """Test graph retrieve a specific graph as a stream."""
+        with open('tests/resources/graph_strategy.ttl') as datafile:
+            graph_data = datafile.read()
+        url = "http://data.hulib.helsinki.fi/attx/strategy"
+        responses.add(responses.GET, "{0}/data?graph={1}".format(self.request_address, url), body=graph_data, status=200)
+        fuseki = GraphStore()
+        result = fuseki._graph_retrieve(url, stream=True)
+        assert(b''.join(result) == graph_data)
+
     @responses.activate
     def test_graph_retrieve_bad(self):
         """Test ConnectionError graph retrieve on graph endpoint."""
@@ -204,21 +249,33 @@ class GraphTestCase(GraphStoreTest):
             graph_data = datafile.read()
         list_query = "select ?g (count(*) as ?count) {graph ?g {?s ?p ?o}} group by ?g"
         url = "http://data.hulib.helsinki.fi/attx/strategy"
-        request_url = "{0}/query?default-graph-uri=%s&query={1}&output=xml&results=xml&format=xml".format(self.request_address, url, list_query)
-        httpretty.register_uri(httpretty.GET, request_url, graph_data, status=200, content_type="application/sparql-results+xml")
+        httpretty.register_uri(httpretty.POST, "{0}/query".format(self.request_address), graph_data, status=200, content_type="application/sparql-results+xml")
         fuseki = GraphStore()
-        result = fuseki._graph_sparql(url, list_query, 'application/sparql-results+xml')
+        result = fuseki._graph_sparql([url], list_query, 'application/sparql-results+xml')
         assert(result == graph_data)
+        assert(httpretty.last_request().headers['accept'] == 'application/sparql-results+xml')
         httpretty.disable()
         httpretty.reset()
 
+    @responses.activate
+    def test_graph_construct(self):
+        """Test construct asks for the content type and passes the bytes through."""
+        triples = '<http://test.com/s> <http://test.com/p> "one" .\n'
+        responses.add(responses.POST, "{0}/query".format(self.request_address), body=triples, status=200, content_type="application/n-triples")
+        fuseki = GraphStore()
+        query = "CONSTRUCT {?s ?p ?o} WHERE {?s ?p ?o}"
+        self.assertEqual(fuseki._graph_construct(["http://test.com/graph"], query, 'application/n-triples'), triples)
+        self.assertEqual(responses.calls[0].request.headers['accept'], 'application/n-triples')
+        self.assertIn('default-graph-uri=http%3A%2F%2Ftest.com%2Fgraph', responses.calls[0].request.body)
+        self.assertEqual(b''.join(fuseki._graph_construct(["http://test.com/graph"], query, 'application/n-triples', stream=True)), triples)
+
     @responses.activate
     def test_graph_sparql_bad(self):
         """Test ConnectionError SPARQL on graph endpoint."""
         list_query = quote("select ?g (count(*) as ?count) {graph ?g {?s ?p ?o}} group by ?g")
         fuseki = GraphStore()
-        with self.assertRaises(URLError):
-            fuseki._graph_sparql("default", list_query, 'application/sparql-results+xml')
+        with self.assertRaises(ConnectionError):
+            fuseki._graph_sparql(["default"], list_query, 'application/sparql-results+xml')
 
 
 if __name__ == "__main__":
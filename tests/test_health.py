@@ -2,10 +2,13 @@ import falcon
 import unittest
 import httpretty
 import json
+import time
+import threading
+from mock import patch
 from falcon import testing
 from graph_manager.app import init_api
 from graph_manager.applib.graph_store import GraphStore
-from graph_manager.api.healthcheck import healthcheck_response
+from graph_manager.api.healthcheck import healthcheck_response, health, HealthCheck
 
 
 class appHealthTest(testing.TestCase):
@@ -47,11 +50,54 @@ class TestGM(appHealthTest):
         response = healthcheck_response("Running", fuseki)
         result = self.simulate_get('/health')
         json_response = {"graphManagerService": "Running", "messageBroker": "Running", "graphStore": "Running"}
-        assert(json_response == json.loads(response))
-        assert(result.content == response)
+        latency = json.loads(response).pop('latency')
+        assert(set(latency.keys()) == set(["graphStore", "messageBroker"]))
+        assert(json_response == dict((k, v) for k, v in json.loads(response).items() if k != 'latency'))
+        assert(json.loads(result.content)['graphStore'] == "Running")
         httpretty.disable()
         httpretty.reset()
 
+    @patch('graph_manager.api.healthcheck.healthcheck_response')
+    def test_health_cached(self, mock):
+        """Test repeated health requests are served from the cache."""
+        mock.return_value = '{"graphManagerService": "Running"}'
+        self.simulate_get('/health')
+        result = self.simulate_get('/health')
+        assert(result.status == falcon.HTTP_200)
+        assert(mock.call_count == 1)
+
+    @patch('graph_manager.api.healthcheck.graph_store_probe')
+    @patch('graph_manager.api.healthcheck.message_broker_probe')
+    def test_health_deadline(self, broker_mock, graph_mock):
+        """Test a hanging backend is reported within the deadline."""
+        graph_mock.side_effect = lambda graph: time.sleep(health['timeout'] * 2)
+        start = time.time()
+        response = json.loads(healthcheck_response("Running", GraphStore()))
+        assert(time.time() - start < health['timeout'] * 1.5)
+        assert(response['graphStore'] == "Not Running")
+        assert(response['messageBroker'] == "Running")
+
+    @patch('graph_manager.api.healthcheck.healthcheck_response')
+    def test_health_single_refresh(self, mock):
+        """Test requests arriving during a refresh get the cached status instead of probing again."""
+        probing, release = threading.Event(), threading.Event()
+
+        def probe(api_status, graph):
+            probing.set()
+            release.wait(5)
+            return '{"graphStore": "Running"}'
+        mock.side_effect = probe
+        check = HealthCheck()
+        check._status['response'] = '{"graphStore": "Not Running"}'
+        thread = threading.Thread(target=check._refresh)
+        thread.start()
+        self.assertTrue(probing.wait(5))
+        self.assertEqual(check._refresh(), '{"graphStore": "Not Running"}')
+        release.set()
+        thread.join()
+        self.assertEqual(mock.call_count, 1)
+        self.assertEqual(check._status['response'], '{"graphStore": "Running"}')
+
 
 if __name__ == "__main__":
     unittest.main()
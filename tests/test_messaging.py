@@ -1,8 +1,15 @@
+import json
+import time
 import unittest
+import threading
 # from rdflib import Graph
-from mock import patch
+from mock import patch, MagicMock
 from graph_manager.applib.messaging import ScalableRpcServer, Consumer
 from graph_manager.applib.messaging_publish import Publisher
+try:
+    from graph_manager.applib.cooperative import CooperativeRpcServer
+except ImportError:
+    CooperativeRpcServer = None
 # from amqpstorm import Connection
 # from amqpstorm.tests.utility import FakeConnection
 # from amqpstorm import Channel
@@ -39,3 +46,223 @@ class MessagingTestCase(unittest.TestCase):
         CONSUMER = Publisher()
         CONSUMER.push()
         self.assertTrue(mock.called)
+
+    @patch('graph_manager.applib.messaging_publish.Connection')
+    def test_publisher_persistent(self, connection_mock):
+        """Test the publisher reuses its connection and confirms every message."""
+        channel = connection_mock.return_value.channel.return_value
+        PUBLISHER = Publisher(queue='prov.queue')
+        with patch('graph_manager.applib.messaging_publish.Message') as message_mock:
+            message_mock.create.return_value.publish.return_value = True
+            PUBLISHER.push('{}')
+            PUBLISHER.push_batch(['{}', '{}'])
+            self.assertEqual(message_mock.create.return_value.publish.call_count, 3)
+        self.assertEqual(connection_mock.call_count, 1)
+        self.assertEqual(channel.confirm_deliveries.call_count, 1)
+        self.assertEqual(channel.queue.declare.call_count, 1)
+        self.assertFalse(channel.tx.select.called)
+
+    @patch('graph_manager.applib.messaging_publish.Connection')
+    def test_publisher_nack(self, connection_mock):
+        """Test after a refused message only the messages not yet confirmed are published again."""
+        channel = connection_mock.return_value.channel.return_value
+        PUBLISHER = Publisher(queue='prov.queue', max_retries=1)
+        with patch('graph_manager.applib.messaging_publish.Message') as message_mock, \
+                patch('graph_manager.applib.messaging_publish.time.sleep'):
+            message_mock.create.return_value.publish.side_effect = [True, False, True, True]
+            PUBLISHER.push_batch(['1', '2', '3'])
+            self.assertEqual([c[0][1] for c in message_mock.create.call_args_list], ['1', '2', '2', '3'])
+        self.assertEqual(channel.close.call_count, 1)
+        self.assertEqual(channel.confirm_deliveries.call_count, 2)
+
+    @patch.object(Consumer, '_process')
+    def test_consumer_spawn(self, mock):
+        """Test messages are handed to the spawn function."""
+        spawn = MagicMock()
+        CONSUMER = Consumer('base.rpc_queue', prefetch=10, spawn=spawn)
+        message = MagicMock()
+        CONSUMER(message)
+        spawn.assert_called_once_with(CONSUMER._process, message)
+        self.assertFalse(mock.called)
+
+    @patch.dict('graph_manager.applib.messaging.scaling', {'checks': 2, 'backlog': 5, 'idle': 0.5})
+    def test_autoscale(self):
+        """Test consumers follow the queue depth with hysteresis and bounds."""
+        SERVER = ScalableRpcServer(number_of_consumers=2, min_consumers=1, max_consumers=3)
+        SERVER._consumers = [Consumer('base.rpc_queue'), Consumer('base.rpc_queue')]
+        with patch.object(ScalableRpcServer, 'queue_depth', return_value=50):
+            SERVER._autoscale()
+            self.assertEqual(SERVER.number_of_consumers, 2)
+            SERVER._autoscale()
+            self.assertEqual(SERVER.number_of_consumers, 3)
+            SERVER._autoscale()
+            SERVER._autoscale()
+            self.assertEqual(SERVER.number_of_consumers, 3)
+        with patch.object(ScalableRpcServer, 'queue_depth', return_value=0):
+            SERVER._consumers[0].busy = 1
+            SERVER._autoscale()
+            SERVER._autoscale()
+            self.assertEqual(SERVER.number_of_consumers, 3)
+            SERVER._consumers[0].busy = 0
+            SERVER._autoscale()
+            SERVER._autoscale()
+            self.assertEqual(SERVER.number_of_consumers, 2)
+            self.assertEqual(SERVER.last_scaling['queueDepth'], 0)
+
+    def test_scale_down_idle_first(self):
+        """Test scaling down drains an idle consumer and keeps it until it stopped."""
+        SERVER = ScalableRpcServer(number_of_consumers=1, min_consumers=1)
+        idle, busy = MagicMock(active=True, busy=0), MagicMock(active=True, busy=1)
+        SERVER._consumers = [idle, busy]
+        SERVER._update_consumers()
+        idle.drain.assert_called_once_with()
+        busy.drain.assert_not_called()
+        self.assertEqual(SERVER._consumers, [idle, busy])
+        idle.active = False
+        SERVER._update_consumers()
+        self.assertEqual(SERVER._consumers, [busy])
+        self.assertFalse(idle.stop.called)
+
+    def test_scale_down_busy(self):
+        """Test a busy consumer retired by scaling down acknowledges its message once."""
+        handling, release = threading.Event(), threading.Event()
+
+        class FakeDelivery(object):
+            """Count acknowledgements."""
+
+            body, correlation_id, reply_to, channel = '{}', '1', 'reply', None
+            acks = 0
+
+            def ack(self):
+                self.acks += 1
+
+        class FakeChannel(object):
+            """Deliver one message and consume until cancelled, mocks are not thread safe."""
+
+            def __init__(self):
+                self.consumer_tags = ['tag']
+                self.basic, self.queue = MagicMock(), MagicMock()
+                self.closed = False
+
+            def start_consuming(self, to_tuple=False):
+                CONSUMER(delivery)
+                while self.consumer_tags:
+                    time.sleep(0.01)
+
+            def stop_consuming(self):
+                self.consumer_tags = []
+
+            def close(self):
+                self.closed = True
+
+        def handle(message, parsed=None):
+            handling.set()
+            release.wait(5)
+            return '{}'
+        delivery, channel = FakeDelivery(), FakeChannel()
+        SERVER = ScalableRpcServer(number_of_consumers=1, min_consumers=0)
+        SERVER._connection = MagicMock()
+        SERVER._connection.channel.return_value = channel
+        CONSUMER = SERVER._create_consumer()
+        SERVER._consumers = [CONSUMER]
+        with patch.object(Consumer, '_handle_message', side_effect=handle), \
+                patch('graph_manager.applib.messaging.Message'):
+            SERVER._start_consumer(CONSUMER)
+            self.assertTrue(handling.wait(5))
+            SERVER.number_of_consumers = 0
+            SERVER._update_consumers()
+            self.assertEqual(SERVER._consumers, [CONSUMER])
+            self.assertFalse(channel.closed)
+            release.set()
+            deadline = time.time() + 5
+            while CONSUMER.active and time.time() < deadline:
+                time.sleep(0.01)
+            SERVER._update_consumers()
+        self.assertEqual(SERVER._consumers, [])
+        self.assertEqual(delivery.acks, 1)
+        self.assertTrue(channel.closed)
+
+    def test_consumer_stats(self):
+        """Test consumers record the messages handled and the time spent."""
+        CONSUMER = Consumer('base.rpc_queue')
+        with patch.object(Consumer, '_reply'):
+            CONSUMER._process(MagicMock())
+        handled, handling = CONSUMER.take_stats()
+        self.assertEqual(handled, 1)
+        self.assertEqual(CONSUMER.busy, 0)
+        self.assertEqual(CONSUMER.take_stats(), (0, 0.0))
+
+    def test_consumer_workers(self):
+        """Test pooled consumers reply and acknowledge each delivery from the workers."""
+        SERVER = ScalableRpcServer(workers=4)
+        CONSUMER = SERVER._create_consumer()
+        self.assertEqual((CONSUMER.prefetch, CONSUMER.capacity), (4, 4))
+        connection = MagicMock()
+        connection.channel.return_value.start_consuming.side_effect = lambda **kwargs: [CONSUMER(m) for m in messages]
+        messages = [MagicMock(delivery_tag=tag, correlation_id=str(tag), body='{}') for tag in range(8)]
+        replies = []
+
+        class FakeMessage(object):
+            """Record replies, mocks are not thread safe."""
+
+            @staticmethod
+            def create(channel, body, properties):
+                replies.append(properties['correlation_id'])
+                return MagicMock()
+
+        with patch.object(Consumer, '_handle_message', return_value='{}'), \
+                patch('graph_manager.applib.messaging.Message', FakeMessage):
+            CONSUMER.start(connection)
+        connection.channel.return_value.basic.qos.assert_called_once_with(4)
+        for message in messages:
+            message.ack.assert_called_once_with()
+        correlations = sorted(replies)
+        self.assertEqual(correlations, sorted(m.correlation_id for m in messages))
+
+    def test_drain(self):
+        """Test drain stops consuming and waits for messages in progress."""
+        SERVER = ScalableRpcServer()
+        SERVER._connection = MagicMock()
+        consumer = MagicMock(active=False)
+        SERVER._consumers = [consumer]
+        SERVER.drain(timeout=1)
+        consumer.drain.assert_called_once_with()
+        consumer.stop.assert_called_once_with()
+        self.assertTrue(SERVER._stopped.is_set())
+
+    def test_request_drain(self):
+        """Test a requested drain is done by the server loop."""
+        SERVER = ScalableRpcServer()
+        SERVER._connection = MagicMock(is_closed=False)
+        consumer = MagicMock(active=False)
+        SERVER._consumers = [consumer]
+        SERVER.request_drain(timeout=1)
+        consumer.drain.assert_not_called()
+        SERVER.start_server()
+        consumer.drain.assert_called_once_with()
+        self.assertTrue(SERVER._stopped.is_set())
+
+    @patch('graph_manager.applib.messaging.add_message', return_value='{}')
+    @patch('graph_manager.applib.messaging.json.loads', wraps=json.loads)
+    def test_message_parsed_once(self, loads_mock, add_mock):
+        """Test the body is parsed once and the task gets the envelope."""
+        with open('tests/resources/message_data_add.json') as datafile:
+            data = json.load(datafile)
+        data["provenance"]["context"]["activityID"] = "1"
+        message = MagicMock(body=json.dumps(data))
+        loads_mock.reset_mock()
+        with patch('graph_manager.applib.messaging.Message'):
+            Consumer('base.rpc_queue')._reply(message)
+        self.assertEqual(loads_mock.call_count, 1)
+        envelope = add_mock.call_args[0][0]
+        self.assertEqual(envelope.task_input.target_graph, "http://work/dataset1")
+        self.assertEqual(len(envelope.task_input.source_data), 2)
+        message.ack.assert_called_once_with()
+
+    @unittest.skipIf(CooperativeRpcServer is None, 'gevent is not installed')
+    def test_cooperative_consumer(self):
+        """Test cooperative consumers share the greenlet pool."""
+        SERVER = CooperativeRpcServer(in_flight=20)
+        CONSUMER = SERVER._create_consumer()
+        self.assertEqual(CONSUMER.prefetch, 20)
+        self.assertEqual(CONSUMER.spawn, SERVER._pool.spawn)
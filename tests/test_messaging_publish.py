@@ -0,0 +1,81 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from mock import MagicMock
+from amqpstorm import AMQPConnectionError
+from graph_manager.applib.messaging_publish import BackgroundPublisher
+
+
+class BackgroundPublisherTestCase(unittest.TestCase):
+    """Test for the background provenance publisher."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures."""
+        shutil.rmtree(self.directory)
+
+    def test_background_overflow_drop(self):
+        """Test messages beyond the buffer are dropped and counted."""
+        publisher = MagicMock()
+        publisher.push_batch.side_effect = lambda messages: time.sleep(0.2)
+        background = BackgroundPublisher(publisher, size=1, batch=1, overflow="drop")
+        for message in ["1", "2", "3", "4"]:
+            background.emit(message)
+        background.close()
+        self.assertGreater(background.dropped, 0)
+        self.assertEqual(background.sent + background.dropped, 4)
+
+    def test_background_overflow_spill(self):
+        """Test refused batches are spilled and sent again later."""
+        publisher = MagicMock()
+        sent = []
+
+        def push_batch(messages):
+            if not publisher.push_batch.call_count > 1:
+                raise AMQPConnectionError('down')
+            sent.extend(messages)
+        publisher.push_batch.side_effect = push_batch
+        background = BackgroundPublisher(publisher, size=10, overflow="spill", directory=self.directory)
+        background.emit("1")
+        time.sleep(1.5)
+        background.close()
+        self.assertEqual(sent, ["1"])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_spill_replay_fail(self):
+        """Test claimed spill files are put back when sending them fails."""
+        publisher = MagicMock()
+        publisher.push_batch.side_effect = AMQPConnectionError('down')
+        background = BackgroundPublisher(publisher, size=10, overflow="spill", directory=self.directory)
+        background.close()
+        background._spill(["1", "2"])
+        names = sorted(os.listdir(self.directory))
+        background._send_spilled()
+        self.assertEqual(sorted(os.listdir(self.directory)), names)
+        self.assertEqual(publisher.push_batch.call_args[0][0], ["1", "2"])
+        publisher.push_batch.side_effect = None
+        background._send_spilled()
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertEqual(background.sent, 2)
+
+    def test_release_claims(self):
+        """Test spill files claimed by a process that is gone are sent again."""
+        with open(os.path.join(self.directory, "1.json.999999999"), "wb") as f:
+            f.write("1")
+        with open(os.path.join(self.directory, "2.json.{0}".format(os.getppid())), "wb") as f:
+            f.write("2")
+        publisher = MagicMock()
+        background = BackgroundPublisher(publisher, size=10, overflow="spill", directory=self.directory)
+        time.sleep(1)
+        background.close()
+        publisher.push_batch.assert_called_once_with(["1"])
+        self.assertEqual(os.listdir(self.directory), ["2.json.{0}".format(os.getppid())])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+import os
+import time
+import json
+import shutil
+import tempfile
+import unittest
+from mock import patch
+from falcon import testing
+from graph_manager.app import init_api
+from graph_manager.utils import metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Test for the metrics registry."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        self.directory = tempfile.mkdtemp()
+        self.patch = patch.dict(metrics.metrics, {'directory': self.directory, 'interval': 3600})
+        self.patch.start()
+        # The tests flush themselves, the background writer would race with them.
+        self.flush_loop = patch.object(metrics, '_flush_loop')
+        self.flush_loop.start()
+        metrics._values['pid'] = None
+
+    def tearDown(self):
+        """Tear down test fixtures."""
+        metrics._values['pid'] = None
+        self.flush_loop.stop()
+        self.patch.stop()
+        shutil.rmtree(self.directory)
+
+    def test_histogram(self):
+        """Test observations land in cumulative buckets."""
+        metrics.observe('graphmanager_rpc_task_seconds', 0.02, task="add")
+        metrics.observe('graphmanager_rpc_task_seconds', 400, task="add")
+        text = metrics.exposition()
+        self.assertIn('graphmanager_rpc_task_seconds_bucket{task="add",le="0.025"} 1', text)
+        self.assertIn('graphmanager_rpc_task_seconds_bucket{task="add",le="+Inf"} 2', text)
+        self.assertIn('graphmanager_rpc_task_seconds_count{task="add"} 2', text)
+
+    def test_aggregate_processes(self):
+        """Test values of other processes are added, gauges only while they run."""
+        metrics.inc('graphmanager_rpc_tasks_total', task="add", status="success")
+        metrics.set_gauge('graphmanager_rpc_consumers', 2)
+        metrics.flush()
+        own = os.path.join(self.directory, "pid-{0}.json".format(os.getpid()))
+        with open(own) as f:
+            snapshot = json.load(f)
+        # Written by a process that has exited.
+        shutil.copy(own, os.path.join(self.directory, "pid-999999.json"))
+        with open(os.path.join(self.directory, "dead-1.json"), "w") as f:
+            json.dump(snapshot, f)
+        text = metrics.exposition()
+        self.assertIn('graphmanager_rpc_tasks_total{status="success",task="add"} 3', text)
+        self.assertIn('graphmanager_rpc_consumers 2', text)
+
+    def test_scrape_flushed(self):
+        """Test a scrape writes this process' values and reports every process from the files."""
+        metrics.inc('graphmanager_rpc_tasks_total', task="add", status="success")
+        metrics.flush()
+        own = os.path.join(self.directory, "pid-{0}.json".format(os.getpid()))
+        # Another worker, still running, that last wrote one task.
+        shutil.copy(own, os.path.join(self.directory, "pid-{0}.json".format(os.getppid())))
+        metrics.inc('graphmanager_rpc_tasks_total', task="add", status="success")
+        text = metrics.exposition()
+        self.assertIn('graphmanager_rpc_tasks_total{status="success",task="add"} 3', text)
+        with open(own) as f:
+            self.assertEqual(json.load(f)['graphmanager_rpc_tasks_total'], [[[["status", "success"], ["task", "add"]], 2]])
+
+    def test_timed(self):
+        """Test timed functions record latency and failures."""
+        @metrics.timed('graphmanager_graph_store_seconds', 'graphmanager_graph_store_errors_total', operation="test")
+        def fail():
+            raise ValueError('failed')
+        self.assertRaises(ValueError, fail)
+        text = metrics.exposition()
+        self.assertIn('graphmanager_graph_store_errors_total{operation="test"} 1', text)
+        self.assertIn('graphmanager_graph_store_seconds_count{operation="test"} 1', text)
+
+    def test_timed_stream(self):
+        """Test streamed results are observed once they are closed."""
+        class Stream(object):
+            def __init__(self):
+                self.on_close = []
+
+            def close(self):
+                for callback in self.on_close:
+                    callback()
+
+        @metrics.timed('graphmanager_graph_store_seconds', operation="stream")
+        def stream():
+            return Stream()
+        result = stream()
+        self.assertNotIn('graphmanager_graph_store_seconds_count{operation="stream"}', metrics.exposition())
+        result.close()
+        self.assertIn('graphmanager_graph_store_seconds_count{operation="stream"} 1', metrics.exposition())
+
+    def test_compact(self):
+        """Test files of exited processes are added up into one file."""
+        metrics.inc('graphmanager_rpc_tasks_total', task="add", status="success")
+        metrics.set_gauge('graphmanager_rpc_consumers', 2)
+        metrics.flush()
+        own = os.path.join(self.directory, "pid-{0}.json".format(os.getpid()))
+        for name in ("pid-999999.json", "dead-1.json", "dead-2.json"):
+            shutil.copy(own, os.path.join(self.directory, name))
+        metrics.compact()
+        self.assertEqual(sorted(name for name in os.listdir(self.directory) if name.endswith(".json")),
+                         ["dead.json", "pid-{0}.json".format(os.getpid())])
+        shutil.copy(own, os.path.join(self.directory, "dead-3.json"))
+        metrics.compact()
+        text = metrics.exposition()
+        self.assertIn('graphmanager_rpc_tasks_total{status="success",task="add"} 5', text)
+        self.assertIn('graphmanager_rpc_consumers 2', text)
+
+
+class MetricsEndpointTest(testing.TestCase):
+    """Testing the GM metrics endpoint."""
+
+    def setUp(self):
+        """Setting the app up."""
+        self.app = init_api()
+        metrics._values['pid'] = None
+
+    def test_metrics(self):
+        """Test requests are counted per resource and method."""
+        self.simulate_get('/metrics')
+        result = self.simulate_get('/metrics')
+        self.assertEqual(result.headers['content-type'], 'text/plain; version=0.0.4')
+        self.assertIn('graphmanager_http_requests_total{method="GET",resource="Metrics",status="200"} 1', result.text)
+
+    def test_streamed_latency(self):
+        """Test streamed responses are timed until the body has been sent."""
+        class Slow(object):
+            def on_get(self, req, resp):
+                def body():
+                    yield "a"
+                    time.sleep(0.3)
+                    yield "b"
+                resp.stream = body()
+        self.app.add_route('/slow', Slow())
+        self.assertEqual(self.simulate_get('/slow').text, "ab")
+        text = self.simulate_get('/metrics').text
+        self.assertIn('graphmanager_http_request_seconds_bucket{method="GET",resource="Slow",le="0.25"} 0', text)
+        self.assertIn('graphmanager_http_request_seconds_count{method="GET",resource="Slow"} 1', text)
+
+
+if __name__ == "__main__":
+    unittest.main()
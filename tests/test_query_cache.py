@@ -0,0 +1,96 @@
+import shutil
+import tempfile
+import unittest
+import responses
+from mock import patch
+from graph_manager.applib import query_cache
+from graph_manager.applib.query_cache import QueryCache, cache_key
+from graph_manager.applib.graph_store import GraphStore
+
+
+class QueryCacheTestCase(unittest.TestCase):
+    """Test for the query result cache."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        self.directory = tempfile.mkdtemp()
+        self.request_address = "http://localhost:3030/ds"
+        self.query = "SELECT ?s WHERE { ?s ?p ?o }"
+
+    def tearDown(self):
+        """Tear down test fixtures."""
+        shutil.rmtree(self.directory)
+
+    def test_key_normalized(self):
+        """Test key ignores whitespace and source graph order."""
+        key1 = cache_key('query', ["http://a", "http://b"], self.query, 'application/sparql-results+json')
+        key2 = cache_key('query', ["http://b", "http://a"], "SELECT ?s  WHERE {\n ?s ?p ?o }", 'application/sparql-results+json')
+        key3 = cache_key('query', ["http://a"], self.query, 'application/sparql-results+json')
+        self.assertEqual(key1, key2)
+        self.assertNotEqual(key1, key3)
+
+    def test_invalidate(self):
+        """Test a write invalidates only dependent entries."""
+        cache = QueryCache(1024, 1024, 60)
+        cache.put('a', cache.tokens(["http://a"]), 'result a')
+        cache.put('b', cache.tokens(["http://b"]), 'result b')
+        cache.put('any', cache.tokens([]), 'result any')
+        cache.invalidate("http://a")
+        self.assertIsNone(cache.get('a', ["http://a"]))
+        self.assertEqual(cache.get('b', ["http://b"]), 'result b')
+        self.assertIsNone(cache.get('any', []))
+
+    def test_lru_eviction(self):
+        """Test the least recently used entry is evicted."""
+        cache = QueryCache(10, 10, 60)
+        cache.put('a', cache.tokens([]), '12345')
+        cache.put('b', cache.tokens([]), '12345')
+        cache.get('a', [])
+        cache.put('c', cache.tokens([]), '12345')
+        self.assertIsNone(cache.get('b', []))
+        self.assertEqual(cache.get('a', []), '12345')
+
+    def test_ttl(self):
+        """Test expired entries are not served."""
+        cache = QueryCache(1024, 1024, -1)
+        cache.put('a', cache.tokens([]), 'result')
+        self.assertIsNone(cache.get('a', []))
+
+    def test_disk_shared(self):
+        """Test entries and invalidations are shared through the directory."""
+        cache1 = QueryCache(1024, 1024, 60, self.directory, 1024)
+        cache2 = QueryCache(1024, 1024, 60, self.directory, 1024)
+        cache1.put('a', cache1.tokens(["http://a"]), 'result a')
+        self.assertEqual(cache2.get('a', ["http://a"]), 'result a')
+        cache1.invalidate("http://a")
+        self.assertIsNone(cache2.get('a', ["http://a"]))
+
+    def test_multi_process_requires_directory(self):
+        """Test the memory only cache is turned off when other processes write graphs."""
+        settings = dict(size=1024, directory=None, multiProcess=True)
+        with patch.dict(query_cache.cache, settings), patch.dict(query_cache._cache, {'pid': None, 'cache': None}):
+            self.assertIsNone(query_cache.shared_cache())
+        settings['directory'] = self.directory
+        with patch.dict(query_cache.cache, settings), patch.dict(query_cache._cache, {'pid': None, 'cache': None}):
+            self.assertIsInstance(query_cache.shared_cache(), QueryCache)
+        settings.update(directory=None, multiProcess=False)
+        with patch.dict(query_cache.cache, settings), patch.dict(query_cache._cache, {'pid': None, 'cache': None}):
+            self.assertIsInstance(query_cache.shared_cache(), QueryCache)
+
+    @responses.activate
+    def test_graph_sparql_cached(self):
+        """Test repeated queries are served from the cache until a write."""
+        responses.add(responses.POST, "{0}/query".format(self.request_address), body="result", status=200)
+        responses.add(responses.POST, "{0}/update".format(self.request_address), body="dropped", status=200)
+        with patch('graph_manager.applib.graph_store.shared_cache', return_value=QueryCache(1024, 1024, 60)):
+            fuseki = GraphStore()
+        self.assertEqual(''.join(fuseki._graph_sparql(["http://a"], self.query, 'text/csv', stream=True)), "result")
+        self.assertEqual(fuseki._graph_sparql(["http://a"], self.query, 'text/csv'), "result")
+        self.assertEqual(len(responses.calls), 1)
+        fuseki._drop_graph("http://a")
+        fuseki._graph_sparql(["http://a"], self.query, 'text/csv')
+        self.assertEqual(len(responses.calls), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
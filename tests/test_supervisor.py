@@ -0,0 +1,47 @@
+import os
+import time
+import unittest
+import threading
+from graph_manager.applib.supervisor import ProcessSupervisor
+
+
+def crash():
+    """Exit at once with an error."""
+    raise ValueError('crashed')
+
+
+def wait():
+    """Run until terminated."""
+    time.sleep(30)
+
+
+class SupervisorTestCase(unittest.TestCase):
+    """Test for the RPC process supervisor."""
+
+    def test_restart_crashed(self):
+        """Test crashed workers are started again."""
+        supervisor = ProcessSupervisor(crash, processes=2, drain_timeout=1)
+        for _ in range(supervisor.processes):
+            supervisor._spawn()
+        threading.Timer(1.5, supervisor.stop).start()
+        supervisor._supervise()
+        self.assertTrue(supervisor.restarts >= 1)
+        self.assertEqual(supervisor._workers, {})
+
+    def test_stop(self):
+        """Test stop terminates the workers."""
+        supervisor = ProcessSupervisor(wait, processes=2, drain_timeout=1)
+        for _ in range(supervisor.processes):
+            supervisor._spawn()
+        pids = list(supervisor._workers)
+        threading.Timer(0.5, supervisor.stop).start()
+        start = time.time()
+        supervisor._supervise()
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(supervisor.restarts, 0)
+        for pid in pids:
+            self.assertRaises(OSError, os.kill, pid, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()